@@ -6,13 +6,58 @@ import copy
 import numpy as np
 from scipy.special import comb
 
-from Attribute import Angle, Color, Number, Position, Size, Type, Uniformity
+from Attribute import (
+    Angle,
+    Color,
+    NoNewValueError,
+    Number,
+    Position,
+    Size,
+    Type,
+    Uniformity,
+    get_position_mask,
+    get_slots,
+)
 from constraints import rule_constraint
 
 
+def copy_constraint(constraint, memo):
+    """Copy a constraint such that nodes sharing it before the copy share its copy,
+    like copy.deepcopy does. Lists of positions are never modified, hence they are
+    shared with the original constraint.
+    Arguments:
+        constraint(dict): a layout or entity constraint
+        memo(dict): memo of the ongoing copy.deepcopy
+    """
+    ret = memo.get(id(constraint))
+    if ret is None:
+        ret = {key: list(value) for key, value in constraint.items()}
+        memo[id(constraint)] = ret
+    return ret
+
+
+def get_rule_group_signature(rule_group):
+    """Signature of a group of rules, which determines how they constrain a layout.
+    Arguments:
+        rule_group(list of Rule): rules applied to a component
+    Returns:
+        signature(tuple): name, attribute and value of each rule
+    """
+    return tuple((rule.name, rule.attr, rule.value) for rule in rule_group)
+
+
 class AoTNode(object):
     """Superclass of AoT."""
 
+    __slots__ = (
+        "name",
+        "level",
+        "node_type",
+        "children",
+        "is_pg",
+        "modified_attr",
+    )
+
     levels_next = {
         "Root": "Structure",
         "Structure": "Component",
@@ -48,18 +93,35 @@ class AoTNode(object):
         assert node.level == self.levels_next[self.level]
         self.children.append(node)
 
-    def _resample(self, change_number):
+    def _resample(self, rng, change_number):
         """Resample the layout. If the number of entities change, resample also the
         position distribution; otherwise only resample each attribute for each entity.
         Arugments:
+            rng(np.random.Generator): source of randomness
             change_number(bool): whether to the number has been reset
         """
         assert self.is_pg
         if self.node_type == "and":
             for child in self.children:
-                child._resample(change_number)
+                child._resample(rng, change_number)
         else:
-            self.children[0]._resample(change_number)
+            self.children[0]._resample(rng, change_number)
+
+    def __deepcopy__(self, memo):
+        """Copy the node and its subtree. Copying is the most frequent operation during
+        generation, so instead of copying everything, parts of the nodes which are
+        never modified are shared between the copies.
+        """
+        cls = self.__class__
+        new_node = cls.__new__(cls)
+        memo[id(self)] = new_node
+        for name in get_slots(cls):
+            setattr(new_node, name, getattr(self, name))
+        if hasattr(self, "__dict__"):
+            new_node.__dict__.update(self.__dict__)
+        new_node.children = [copy.deepcopy(child, memo) for child in self.children]
+        new_node.modified_attr = [list(attr) for attr in self.modified_attr]
+        return new_node
 
     def __repr__(self):
         return self.level + "." + self.name
@@ -73,27 +135,30 @@ class Root(AoTNode):
     def __init__(self, name, is_pg=False):
         super(Root, self).__init__(name, level="Root", node_type="or", is_pg=is_pg)
 
-    def sample(self):
+    def sample(self, rng):
         """The function returns a separate AoT that is correctly parsed.
         Note that a new node is needed so that modification does not alter settings
         in the original tree.
+        Arguments:
+            rng(np.random.Generator): source of randomness
         Returns:
             new_node(Root): a newly instantiated node
         """
         if self.is_pg:
             raise ValueError("Could not sample on a PG")
         new_node = Root(self.name, True)
-        selected = np.random.choice(self.children)
-        new_node.insert(selected._sample())
+        selected = rng.choice(self.children)
+        new_node.insert(selected._sample(rng))
         return new_node
 
-    def resample(self, change_number=False):
-        self._resample(change_number)
+    def resample(self, rng, change_number=False):
+        self._resample(rng, change_number)
 
-    def prune(self, rule_groups):
+    def prune(self, rule_groups, rng):
         """Prune the AoT such that all branches satisfy the constraints.
         Arguments:
             rule_groups(list of list of Rule): each list of Rule applies to a component
+            rng(np.random.Generator): source of randomness for the initial values of new layouts
         Returns:
             new_node(Root): a newly instantiated node with branches all satisfying the constraints;
                 None if no branches satisfy all the constraints
@@ -101,7 +166,7 @@ class Root(AoTNode):
         new_node = Root(self.name)
         for structure in self.children:
             if len(structure.children) == len(rule_groups):
-                new_child = structure._prune(rule_groups)
+                new_child = structure._prune(rule_groups, rng)
                 if new_child is not None:
                     new_node.insert(new_child)
         # during real execution, this should never happens
@@ -115,21 +180,30 @@ class Root(AoTNode):
             structure.name(str): used for rendering structure
             entities(list of Entity): used for rendering each entity
         """
+        structure_name, components = self.prepare_components()
+        entities = []
+        for component_entities in components:
+            entities += component_entities
+        return structure_name, entities
+
+    def prepare_components(self):
+        """This function prepares the AoT for rendering each component separately.
+        Returns:
+            structure.name(str): used for rendering structure
+            components(list of list of Entity): entities of each component
+        """
         assert self.is_pg
         assert self.level == "Root"
         structure = self.children[0]
         components = []
-        for child in structure.children:
-            components.append(child)
-        entities = []
-        for component in components:
-            for child in component.children[0].children:
-                entities.append(child)
-        return structure.name, entities
+        for component in structure.children:
+            components.append(list(component.children[0].children))
+        return structure.name, components
 
-    def sample_new(self, component_idx, attr_name, min_level, max_level, root):
+    def sample_new(self, rng, component_idx, attr_name, min_level, max_level, root):
         """Sample a new configuration. This is used for generating answers.
         Arguments:
+            rng(np.random.Generator): source of randomness
             component_idx(int): the component we will sample
             attr_name(str): name of the attribute to sample
             min_level(int): lower bound of value level for the attribute
@@ -138,15 +212,15 @@ class Root(AoTNode):
         """
         assert self.is_pg
         self.children[0]._sample_new(
-            component_idx, attr_name, min_level, max_level, root.children[0]
+            rng, component_idx, attr_name, min_level, max_level, root.children[0]
         )
 
     def sample_new_value(
-        self, component_idx, attr_name, min_level, max_level, attr_uni, mode_3
+        self, rng, component_idx, attr_name, min_level, max_level, attr_uni, mode_3
     ):
         assert self.is_pg
         return self.children[0]._sample_new_value(
-            component_idx, attr_name, min_level, max_level, attr_uni, mode_3
+            rng, component_idx, attr_name, min_level, max_level, attr_uni, mode_3
         )
 
     def apply_new_value(self, component_idx, attr_name, value):
@@ -163,36 +237,38 @@ class Structure(AoTNode):
             name, level="Structure", node_type="and", is_pg=is_pg
         )
 
-    def _sample(self):
+    def _sample(self, rng):
         if self.is_pg:
             raise ValueError("Could not sample on a PG")
         new_node = Structure(self.name, True)
         for child in self.children:
-            new_node.insert(child._sample())
+            new_node.insert(child._sample(rng))
         return new_node
 
-    def _prune(self, rule_groups):
+    def _prune(self, rule_groups, rng):
         new_node = Structure(self.name)
         for i in range(len(self.children)):
             child = self.children[i]
             # if any of the components fails to satisfy the constraint
             # the structure could not be chosen
-            new_child = child._prune(rule_groups[i])
+            new_child = child._prune(rule_groups[i], rng)
             if new_child is None:
                 return None
             new_node.insert(new_child)
         return new_node
 
-    def _sample_new(self, component_idx, attr_name, min_level, max_level, structure):
+    def _sample_new(
+        self, rng, component_idx, attr_name, min_level, max_level, structure
+    ):
         self.children[component_idx]._sample_new(
-            attr_name, min_level, max_level, structure.children[component_idx]
+            rng, attr_name, min_level, max_level, structure.children[component_idx]
         )
 
     def _sample_new_value(
-        self, component_idx, attr_name, min_level, max_level, attr_uni, mode_3
+        self, rng, component_idx, attr_name, min_level, max_level, attr_uni, mode_3
     ):
         return self.children[component_idx]._sample_new_value(
-            attr_name, min_level, max_level, attr_uni, mode_3
+            rng, attr_name, min_level, max_level, attr_uni, mode_3
         )
 
     def _apply_new_value(self, component_idx, attr_name, value):
@@ -206,32 +282,32 @@ class Component(AoTNode):
             name, level="Component", node_type="or", is_pg=is_pg
         )
 
-    def _sample(self):
+    def _sample(self, rng):
         if self.is_pg:
             raise ValueError("Could not sample on a PG")
         new_node = Component(self.name, True)
-        selected = np.random.choice(self.children)
-        new_node.insert(selected._sample())
+        selected = rng.choice(self.children)
+        new_node.insert(selected._sample(rng))
         return new_node
 
-    def _prune(self, rule_group):
+    def _prune(self, rule_group, rng):
         new_node = Component(self.name)
         for child in self.children:
-            new_child = child._update_constraint(rule_group)
+            new_child = child._update_constraint(rule_group, rng)
             if new_child is not None:
                 new_node.insert(new_child)
         if len(new_node.children) == 0:
             new_node = None
         return new_node
 
-    def _sample_new(self, attr_name, min_level, max_level, component):
+    def _sample_new(self, rng, attr_name, min_level, max_level, component):
         self.children[0]._sample_new(
-            attr_name, min_level, max_level, component.children[0]
+            rng, attr_name, min_level, max_level, component.children[0]
         )
 
-    def _sample_new_value(self, attr_name, min_level, max_level, attr_uni, mode_3):
+    def _sample_new_value(self, rng, attr_name, min_level, max_level, attr_uni, mode_3):
         return self.children[0]._sample_new_value(
-            attr_name, min_level, max_level, attr_uni, mode_3
+            rng, attr_name, min_level, max_level, attr_uni, mode_3
         )
 
     def _apply_new_value(self, attr_name, value):
@@ -252,6 +328,7 @@ class Layout(AoTNode):
         orig_entity_constraint=None,
         sample_new_num_count=None,
         is_pg=False,
+        rng=None,
     ):
         super(Layout, self).__init__(name, level="Layout", node_type="and", is_pg=is_pg)
         self.layout_constraint = layout_constraint
@@ -267,9 +344,13 @@ class Layout(AoTNode):
         self.uniformity = Uniformity(
             min_level=layout_constraint["Uni"][0], max_level=layout_constraint["Uni"][1]
         )
-        self.number.sample()
-        self.position.sample(self.number.get_value())
-        self.uniformity.sample()
+        # layouts of the configuration trees are only used as templates for pruning,
+        # hence their initial values may come from an unseeded generator
+        if rng is None:
+            rng = np.random.default_rng()
+        self.number.sample(rng)
+        self.position.sample(rng, self.number.get_value())
+        self.uniformity.sample(rng)
         # store initial layout_constraint and entity_constraint for answer generation
         if orig_layout_constraint is None:
             self.orig_layout_constraint = copy.deepcopy(self.layout_constraint)
@@ -285,21 +366,44 @@ class Layout(AoTNode):
             for i in range(
                 layout_constraint["Number"][0], layout_constraint["Number"][1] + 1
             ):
-                self.sample_new_num_count[i] = [comb(most_num, i + 1), []]
+                # remaining count and bitmasks of the sampled sets of positions
+                self.sample_new_num_count[i] = [comb(most_num, i + 1), set()]
         else:
             self.sample_new_num_count = sample_new_num_count
         self.num_count = dict()
         for i in self.sample_new_num_count.keys():
             self.num_count[i] = 1
+        # constraints updated by _update_constraint, keyed by signatures of rule groups
+        self.pruned_constraints = dict()
+
+    def __deepcopy__(self, memo):
+        # orig_layout_constraint and orig_entity_constraint are never modified
+        new_node = super(Layout, self).__deepcopy__(memo)
+        new_node.layout_constraint = copy_constraint(self.layout_constraint, memo)
+        new_node.entity_constraint = copy_constraint(self.entity_constraint, memo)
+        new_node.number = self.number.__deepcopy__(memo)
+        new_node.position = self.position.__deepcopy__(memo)
+        new_node.uniformity = self.uniformity.__deepcopy__(memo)
+        sample_new_num_count = memo.get(id(self.sample_new_num_count))
+        if sample_new_num_count is None:
+            sample_new_num_count = {
+                key: [count, set(masks)]
+                for key, (count, masks) in self.sample_new_num_count.items()
+            }
+            memo[id(self.sample_new_num_count)] = sample_new_num_count
+        new_node.sample_new_num_count = sample_new_num_count
+        new_node.num_count = dict(self.num_count)
+        return new_node
 
     def reset_num_count(self):
         for i in self.num_count.keys():
             if self.sample_new_num_count[i][0] > 0:
                 self.num_count[i] = 1
 
-    def add_new(self, *bboxes):
+    def add_new(self, rng, *bboxes):
         """Add new entities into this level.
         Arguments:
+            rng(np.random.Generator): source of randomness
             *bboxes(tuple of bbox): bboxes of new entities
         """
         name = self.number.get_value()
@@ -311,16 +415,18 @@ class Layout(AoTNode):
             new_entity.name = str(name)
             new_entity.bbox = bbox
             if not uni:
-                new_entity.resample()
+                new_entity.resample(rng)
             self._insert(new_entity)
 
-    def resample(self, change_number=False):
-        self._resample(change_number)
+    def resample(self, rng, change_number=False):
+        self._resample(rng, change_number)
 
-    def _sample(self):
+    def _sample(self, rng):
         """Though Layout is an "and" node, we do not enumerate all possible configurations, but rather
         we treat it as a sampling process such that different configurtions are sampled. After the
         sampling, the lower level Entities are instantiated.
+        Arguments:
+            rng(np.random.Generator): source of randomness
         Returns:
             new_node(Layout): a separated node with independent attributes
         """
@@ -329,7 +435,10 @@ class Layout(AoTNode):
         new_node.is_pg = True
         if self.uniformity.get_value():
             node = Entity(
-                name=str(0), bbox=pos[0], entity_constraint=self.entity_constraint
+                name=str(0),
+                bbox=pos[0],
+                entity_constraint=self.entity_constraint,
+                rng=rng,
             )
             new_node._insert(node)
             for i in range(1, len(pos)):
@@ -342,25 +451,32 @@ class Layout(AoTNode):
             for i in range(len(pos)):
                 bbox = pos[i]
                 node = Entity(
-                    name=str(i), bbox=bbox, entity_constraint=self.entity_constraint
+                    name=str(i),
+                    bbox=bbox,
+                    entity_constraint=self.entity_constraint,
+                    rng=rng,
                 )
                 new_node._insert(node)
         return new_node
 
-    def _resample(self, change_number):
+    def _resample(self, rng, change_number):
         """Resample each attribute for every child.
         This function is called across rows.
         Arguments:
+            rng(np.random.Generator): source of randomness
             change_number(bool): whether to resample a number
         """
         if change_number:
-            self.number.sample()
+            self.number.sample(rng)
         del self.children[:]
-        self.position.sample(self.number.get_value())
+        self.position.sample(rng, self.number.get_value())
         pos = self.position.get_value()
         if self.uniformity.get_value():
             node = Entity(
-                name=str(0), bbox=pos[0], entity_constraint=self.entity_constraint
+                name=str(0),
+                bbox=pos[0],
+                entity_constraint=self.entity_constraint,
+                rng=rng,
             )
             self._insert(node)
             for i in range(1, len(pos)):
@@ -373,18 +489,54 @@ class Layout(AoTNode):
             for i in range(len(pos)):
                 bbox = pos[i]
                 node = Entity(
-                    name=str(i), bbox=bbox, entity_constraint=self.entity_constraint
+                    name=str(i),
+                    bbox=bbox,
+                    entity_constraint=self.entity_constraint,
+                    rng=rng,
                 )
                 self._insert(node)
 
-    def _update_constraint(self, rule_group):
+    def _update_constraint(self, rule_group, rng):
         """Update the constraint of the layout. If one constraint is not satisfied, return None
         such that this structure is disgarded.
         Arguments:
             rule_group(list of Rule): all rules to apply to this layout
+            rng(np.random.Generator): source of randomness for the initial values of the new layout
         Returns:
             Layout(Layout): a new Layout node with independent attributes
         """
+        pruned_constraints = self.get_pruned_constraints(rule_group)
+        if pruned_constraints is None:
+            return None
+        new_layout_constraint, new_entity_constraint = pruned_constraints
+        return Layout(
+            self.name,
+            copy_constraint(new_layout_constraint, {}),
+            copy_constraint(new_entity_constraint, {}),
+            self.orig_layout_constraint,
+            self.orig_entity_constraint,
+            self.sample_new_num_count,
+            rng=rng,
+        )
+
+    def get_pruned_constraints(self, rule_group):
+        """Constraints of the layout updated by the rules. They depend only on the rules,
+        hence they are computed once for each combination of rules; the returned
+        constraints are shared and should be copied before being modified.
+        Arguments:
+            rule_group(list of Rule): all rules to apply to this layout
+        Returns:
+            new_layout_constraint(dict): updated layout constraint
+            new_entity_constraint(dict): updated entity constraint;
+            None if one of the constraints is not satisfied
+        """
+        key = get_rule_group_signature(rule_group)
+        if key not in self.pruned_constraints:
+            self.pruned_constraints[key] = self._prune_constraints(rule_group)
+        return self.pruned_constraints[key]
+
+    def _prune_constraints(self, rule_group):
+        """Compute the constraints returned by get_pruned_constraints."""
         num_min = self.layout_constraint["Number"][0]
         num_max = self.layout_constraint["Number"][1]
         uni_min = self.layout_constraint["Uni"][0]
@@ -438,36 +590,91 @@ class Layout(AoTNode):
         new_entity_constraint["Type"][:] = [new_type_min, new_type_max]
         new_entity_constraint["Size"][:] = [new_size_min, new_size_max]
         new_entity_constraint["Color"][:] = [new_color_min, new_color_max]
-        return Layout(
-            self.name,
-            new_layout_constraint,
-            new_entity_constraint,
-            self.orig_layout_constraint,
-            self.orig_entity_constraint,
-            self.sample_new_num_count,
+        return new_layout_constraint, new_entity_constraint
+
+    def get_value_levels(self, attr):
+        """Value levels of an entity attribute of all the entities in the layout.
+        The layout doesn't store them: entities hold their attributes, and the array
+        is gathered from them on each call, so this only spares callers the loop.
+        Arguments:
+            attr(str): one of "Type", "Size", "Color" or "Angle"
+        Returns:
+            value_levels(np.ndarray): value level of each entity
+        """
+        attr_name = attr.lower()
+        return np.array(
+            [getattr(entity, attr_name).value_level for entity in self.children]
         )
 
+    def set_value_levels(self, attr, value_levels):
+        """Set value levels of an entity attribute of all the entities in the layout,
+        which are assigned to the entities one by one.
+        Arguments:
+            attr(str): one of "Type", "Size", "Color" or "Angle"
+            value_levels(int or sequence): a value level shared by all the entities
+                or value levels of the entities, repeated if shorter than the layout
+        """
+        attr_name = attr.lower()
+        if np.ndim(value_levels) == 0:
+            for entity in self.children:
+                getattr(entity, attr_name).value_level = value_levels
+        else:
+            num_levels = len(value_levels)
+            for index, entity in enumerate(self.children):
+                getattr(entity, attr_name).value_level = value_levels[
+                    index % num_levels
+                ]
+
+    def is_consistent(self, attr):
+        """Whether all the entities in the layout share the value of an attribute,
+        see get_value_levels.
+        Arguments:
+            attr(str): one of "Type", "Size", "Color" or "Angle"
+        """
+        value_levels = self.get_value_levels(attr)
+        return bool(np.all(value_levels == value_levels[0]))
+
     def reset_constraint(self, attr):
         attr_name = attr.lower()
         instance = getattr(self, attr_name)
         instance.min_level = self.layout_constraint[attr][0]
         instance.max_level = self.layout_constraint[attr][1]
 
-    def _sample_new(self, attr_name, min_level, max_level, layout):
+    def _count_new_positions(self, value_level, layout):
+        """Number of the new sets of positions of a candidate with a value of Number.
+        Arguments:
+            value_level(int): value level of Number
+            layout(Layout): the layout recording the sets of positions already sampled
+        """
+        return self.position.count_new(
+            self.number.get_value(value_level),
+            masks=layout.sample_new_num_count[value_level][1],
+        )
+
+    def _choose_value_level(self, rng, value_levels):
+        if not value_levels:
+            raise NoNewValueError(
+                "No new value of Number with unused positions remains in "
+                "layout {}".format(self.name)
+            )
+        return rng.choice(value_levels)
+
+    def _sample_new(self, rng, attr_name, min_level, max_level, layout):
         if attr_name == "Number":
-            while True:
-                value_level = self.number.sample_new(min_level, max_level)
-                if layout.sample_new_num_count[value_level][0] == 0:
-                    continue
-                new_num = self.number.get_value(value_level)
-                new_value_idx = self.position.sample_new(new_num)
-                set_new_value_idx = set(new_value_idx)
-                if set_new_value_idx not in layout.sample_new_num_count[value_level][1]:
-                    layout.sample_new_num_count[value_level][0] -= 1
-                    layout.sample_new_num_count[value_level][1].append(
-                        set_new_value_idx
-                    )
-                    break
+            value_levels = [
+                value_level
+                for value_level in self.number.get_new_levels(min_level, max_level)
+                if self._count_new_positions(value_level, layout) > 0
+            ]
+            value_level = self._choose_value_level(rng, value_levels)
+            new_num = self.number.get_value(value_level)
+            new_value_idx = self.position.sample_new(
+                rng, new_num, masks=layout.sample_new_num_count[value_level][1]
+            )
+            layout.sample_new_num_count[value_level][0] -= 1
+            layout.sample_new_num_count[value_level][1].add(
+                get_position_mask(new_value_idx)
+            )
             self.number.set_value_level(value_level)
             self.position.set_value_idx(new_value_idx)
             pos = self.position.get_value()
@@ -475,11 +682,14 @@ class Layout(AoTNode):
             for i in range(len(pos)):
                 bbox = pos[i]
                 node = Entity(
-                    name=str(i), bbox=bbox, entity_constraint=self.entity_constraint
+                    name=str(i),
+                    bbox=bbox,
+                    entity_constraint=self.entity_constraint,
+                    rng=rng,
                 )
                 self._insert(node)
         elif attr_name == "Position":
-            new_value_idx = self.position.sample_new(self.number.get_value())
+            new_value_idx = self.position.sample_new(rng, self.number.get_value())
             layout.position.previous_values.append(new_value_idx)
             self.position.set_value_idx(new_value_idx)
             pos = self.position.get_value()
@@ -489,45 +699,47 @@ class Layout(AoTNode):
         elif attr_name == "Type":
             for index in range(len(self.children)):
                 new_value_level = self.children[index].type.sample_new(
-                    min_level, max_level
+                    rng, min_level, max_level
                 )
                 self.children[index].type.set_value_level(new_value_level)
                 layout.children[index].type.previous_values.append(new_value_level)
         elif attr_name == "Size":
             for index in range(len(self.children)):
                 new_value_level = self.children[index].size.sample_new(
-                    min_level, max_level
+                    rng, min_level, max_level
                 )
                 self.children[index].size.set_value_level(new_value_level)
                 layout.children[index].size.previous_values.append(new_value_level)
         elif attr_name == "Color":
             for index in range(len(self.children)):
                 new_value_level = self.children[index].color.sample_new(
-                    min_level, max_level
+                    rng, min_level, max_level
                 )
                 self.children[index].color.set_value_level(new_value_level)
                 layout.children[index].color.previous_values.append(new_value_level)
         else:
             raise ValueError("Unsupported operation")
 
-    def _sample_new_value(self, attr_name, min_level, max_level, attr_uni, mode_3):
+    def _sample_new_value(self, rng, attr_name, min_level, max_level, attr_uni, mode_3):
 
         ret = []
         if attr_name == "Number":
             previous_num = self.number.get_value()
-            while True:
-                value_level = self.number.sample_new(min_level, max_level)
-                if (
-                    mode_3 == "3-Position-Number"
-                    and self.sample_new_num_count[value_level][0] == 1
-                ):
-                    continue
-                if self.num_count[value_level] == 1:
-                    self.num_count[value_level] = 0
-                    break
+            t = 1
+            if mode_3 == "3-Position-Number":
+                t += 1
+            # values of Number not taken by other candidates, with enough new positions
+            value_levels = [
+                value_level
+                for value_level in self.number.get_new_levels(min_level, max_level)
+                if self.num_count[value_level] == 1
+                and self._count_new_positions(value_level, self) >= t
+            ]
+            value_level = self._choose_value_level(rng, value_levels)
+            self.num_count[value_level] = 0
             new_num = self.number.get_value(value_level)
             if previous_num >= new_num:
-                select = list(np.random.choice(previous_num, new_num, replace=False))
+                select = list(rng.choice(previous_num, new_num, replace=False))
             else:
                 rest = new_num
                 select = []
@@ -535,65 +747,61 @@ class Layout(AoTNode):
                     select += range(previous_num)
                     rest -= previous_num
                 if rest > 0:
-                    select += list(np.random.choice(previous_num, rest, replace=False))
+                    select += list(rng.choice(previous_num, rest, replace=False))
             ret = [value_level, select]
 
-            t = 1
-            if mode_3 == "3-Position-Number":
-                t += 1
             for i in range(t):
-                while True:
-                    new_value_idx = self.position.sample_new(new_num)
-                    set_new_value_idx = set(new_value_idx)
-                    if (
-                        set_new_value_idx
-                        not in self.sample_new_num_count[value_level][1]
-                    ):
-                        self.sample_new_num_count[value_level][0] -= 1
-                        self.sample_new_num_count[value_level][1].append(
-                            set_new_value_idx
-                        )
-                        ret.append(new_value_idx)
-                        break
+                new_value_idx = self.position.sample_new(
+                    rng, new_num, masks=self.sample_new_num_count[value_level][1]
+                )
+                self.sample_new_num_count[value_level][0] -= 1
+                self.sample_new_num_count[value_level][1].add(
+                    get_position_mask(new_value_idx)
+                )
+                ret.append(new_value_idx)
             if sum(self.num_count.values()) == 1:
                 self.reset_num_count()
 
         elif attr_name == "Position":
-            new_value_idx = self.position.sample_new(self.number.get_value())
+            new_value_idx = self.position.sample_new(rng, self.number.get_value())
             ret = [new_value_idx]
 
         elif attr_name == "Type":
             if attr_uni:
-                new_value_level = self.children[0].type.sample_new(min_level, max_level)
+                new_value_level = self.children[0].type.sample_new(
+                    rng, min_level, max_level
+                )
                 ret = [new_value_level]
             else:
                 for index in range(len(self.children)):
                     new_value_level = self.children[index].type.sample_new(
-                        min_level, max_level
+                        rng, min_level, max_level
                     )
                     ret.append(new_value_level)
 
         elif attr_name == "Size":
             if attr_uni:
-                new_value_level = self.children[0].size.sample_new(min_level, max_level)
+                new_value_level = self.children[0].size.sample_new(
+                    rng, min_level, max_level
+                )
                 ret = [new_value_level]
             else:
                 for index in range(len(self.children)):
                     new_value_level = self.children[index].size.sample_new(
-                        min_level, max_level
+                        rng, min_level, max_level
                     )
                     ret.append(new_value_level)
 
         elif attr_name == "Color":
             if attr_uni:
                 new_value_level = self.children[0].color.sample_new(
-                    min_level, max_level
+                    rng, min_level, max_level
                 )
                 ret = [new_value_level]
             else:
                 for index in range(len(self.children)):
                     new_value_level = self.children[index].color.sample_new(
-                        min_level, max_level
+                        rng, min_level, max_level
                     )
                     ret.append(new_value_level)
         else:
@@ -628,24 +836,18 @@ class Layout(AoTNode):
                 if i < len(self.children):
                     self.children[i].bbox = bbox
 
-        elif attr_name == "Type":
-            for index in range(len(self.children)):
-                self.children[index].type.set_value_level(value[index % L])
-
-        elif attr_name == "Size":
-            for index in range(len(self.children)):
-                self.children[index].size.set_value_level(value[index % L])
-
-        elif attr_name == "Color":
-            for index in range(len(self.children)):
-                self.children[index].color.set_value_level(value[index % L])
+        elif attr_name in ["Type", "Size", "Color"]:
+            self.set_value_levels(attr_name, value)
         else:
             raise ValueError("Unsupported operation")
 
 
 class Entity(AoTNode):
 
-    def __init__(self, name, bbox, entity_constraint):
+    # entities are the most numerous nodes, hence they don't have a __dict__
+    __slots__ = ("entity_constraint", "bbox", "type", "size", "color", "angle")
+
+    def __init__(self, name, bbox, entity_constraint, rng):
         super(Entity, self).__init__(name, level="Entity", node_type="leaf", is_pg=True)
         # Attributes
         # Sample each attribute such that the value lies in the admissible range
@@ -656,22 +858,32 @@ class Entity(AoTNode):
             min_level=entity_constraint["Type"][0],
             max_level=entity_constraint["Type"][1],
         )
-        self.type.sample()
+        self.type.sample(rng)
         self.size = Size(
             min_level=entity_constraint["Size"][0],
             max_level=entity_constraint["Size"][1],
         )
-        self.size.sample()
+        self.size.sample(rng)
         self.color = Color(
             min_level=entity_constraint["Color"][0],
             max_level=entity_constraint["Color"][1],
         )
-        self.color.sample()
+        self.color.sample(rng)
         self.angle = Angle(
             min_level=entity_constraint["Angle"][0],
             max_level=entity_constraint["Angle"][1],
         )
-        self.angle.sample()
+        self.angle.sample(rng)
+
+    def __deepcopy__(self, memo):
+        # bbox is never modified, only replaced
+        new_node = super(Entity, self).__deepcopy__(memo)
+        new_node.entity_constraint = copy_constraint(self.entity_constraint, memo)
+        new_node.type = self.type.__deepcopy__(memo)
+        new_node.size = self.size.__deepcopy__(memo)
+        new_node.color = self.color.__deepcopy__(memo)
+        new_node.angle = self.angle.__deepcopy__(memo)
+        return new_node
 
     def reset_constraint(self, attr, min_level, max_level):
         attr_name = attr.lower()
@@ -680,8 +892,8 @@ class Entity(AoTNode):
         instance.min_level = min_level
         instance.max_level = max_level
 
-    def resample(self):
-        self.type.sample()
-        self.size.sample()
-        self.color.sample()
-        self.angle.sample()
+    def resample(self, rng):
+        self.type.sample(rng)
+        self.size.sample(rng)
+        self.color.sample(rng)
+        self.angle.sample(rng)
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 
+import functools
+from math import comb
+
 import numpy as np
 
 from const import (
@@ -25,6 +28,71 @@ from const import (
 )
 
 
+@functools.lru_cache(maxsize=None)
+def get_slots(cls):
+    """Names of the slots of a class, including inherited ones.
+    Arguments:
+        cls(type): a class whose instances are copied slot by slot
+    """
+    return tuple(
+        name for base in cls.__mro__ for name in base.__dict__.get("__slots__", ())
+    )
+
+
+def get_position_mask(value_idx):
+    """Bitmask of a set of positions, with the idx-th bit set for each position idx in the set.
+    Unlike Python sets, bitmasks are compared, combined with | and & ~ and hashed in constant time.
+    Arguments:
+        value_idx(iterable of int): indices of positions
+    """
+    mask = 0
+    for idx in value_idx:
+        mask |= 1 << int(idx)
+    return mask
+
+
+def get_position_idx(mask):
+    """Indices of the positions in a bitmask, the inverse of get_position_mask.
+    Returns:
+        value_idx(np.ndarray): indices of the positions in ascending order
+    """
+    return np.array(
+        [idx for idx in range(mask.bit_length()) if mask >> idx & 1], dtype=np.int64
+    )
+
+
+def count_positions(mask):
+    """Number of positions in a bitmask."""
+    return bin(mask).count("1")
+
+
+def rank_combination(value_idx):
+    """Rank of a set of positions in the colexicographic order of the sets of its size.
+    Arguments:
+        value_idx(iterable of int): indices of distinct positions
+    """
+    return sum(comb(int(idx), i + 1) for i, idx in enumerate(sorted(value_idx)))
+
+
+def unrank_combination(rank, num):
+    """Set of num positions with the given rank, the inverse of rank_combination.
+    Returns:
+        value_idx(np.ndarray): sorted indices of the positions
+    """
+    value_idx = []
+    for i in range(num, 0, -1):
+        idx = i - 1
+        while comb(idx + 1, i) <= rank:
+            idx += 1
+        rank -= comb(idx, i)
+        value_idx.append(idx)
+    return np.array(value_idx[::-1])
+
+
+class NoNewValueError(ValueError):
+    """Raised when an attribute has no value left for a new answer candidate."""
+
+
 class Attribute(object):
     """Super-class for all attributes. This should not be instantiated.
     In the sub-class, each attribute should have a pre-defined value set
@@ -37,15 +105,66 @@ class Attribute(object):
     the sample function.
     """
 
+    # attributes are instantiated for every entity of every panel, hence they
+    # don't have a __dict__ to make creating and copying them cheaper
+    __slots__ = ("name", "level", "previous_values")
+
     def __init__(self, name):
         self.name = name
         self.level = "Attribute"
         # memory to store previous values
         self.previous_values = []
 
-    def sample(self):
+    def __deepcopy__(self, memo):
+        # values of an attribute are never modified, only replaced, hence the copy
+        # shares them with the original; previous values are only appended to
+        cls = self.__class__
+        new_attr = cls.__new__(cls)
+        memo[id(self)] = new_attr
+        for name in get_slots(cls):
+            setattr(new_attr, name, getattr(self, name))
+        new_attr.previous_values = list(self.previous_values)
+        return new_attr
+
+    def sample(self, rng):
         pass
 
+    def get_new_levels(self, min_level=None, max_level=None, previous_values=None):
+        """Value levels that sample_new may return.
+        Arguments:
+            min_level(int): lower bound of the value levels; self.min_level by default
+            max_level(int): upper bound of the value levels; self.max_level by default
+            previous_values(list of int): value levels to avoid besides the current one;
+                self.previous_values by default
+        Returns:
+            new_levels(list of int): value levels other than the current and previous ones
+        """
+        if min_level is None or max_level is None:
+            values = range(self.min_level, self.max_level + 1)
+        else:
+            values = range(min_level, max_level + 1)
+        if not previous_values:
+            previous_values = self.previous_values
+        return list(set(values) - set(previous_values) - set([self.value_level]))
+
+    def sample_new(self, rng, min_level=None, max_level=None, previous_values=None):
+        """Sample new values for generating the answer set.
+        Arguments:
+            others: as in get_new_levels
+        Returns:
+            new_idx(int): a new value_level
+        """
+        new_levels = self.get_new_levels(min_level, max_level, previous_values)
+        if not new_levels:
+            raise NoNewValueError(
+                "No new value of {} remains between levels {} and {}".format(
+                    self.name,
+                    self.min_level if min_level is None else min_level,
+                    self.max_level if max_level is None else max_level,
+                )
+            )
+        return rng.choice(new_levels)
+
     def get_value(self):
         pass
 
@@ -61,6 +180,8 @@ class Attribute(object):
 
 class Number(Attribute):
 
+    __slots__ = ("value_level", "values", "min_level", "max_level")
+
     def __init__(self, min_level=NUM_MIN, max_level=NUM_MAX):
         super(Number, self).__init__("Number")
         self.value_level = 0
@@ -68,30 +189,12 @@ class Number(Attribute):
         self.min_level = min_level
         self.max_level = max_level
 
-    def sample(self, min_level=NUM_MIN, max_level=NUM_MAX):
+    def sample(self, rng, min_level=NUM_MIN, max_level=NUM_MAX):
         # min_level: min level index
         # max_level: max level index
         min_level = max(self.min_level, min_level)
         max_level = min(self.max_level, max_level)
-        self.value_level = np.random.choice(range(int(min_level), max_level + 1))
-
-    def sample_new(self, min_level=None, max_level=None, previous_values=None):
-        """Sample new values for generating the answer set.
-        Returns:
-            new_idx(int): a new value_level
-        """
-        if min_level is None or max_level is None:
-            values = range(self.min_level, self.max_level + 1)
-        else:
-            values = range(min_level, max_level + 1)
-        if not previous_values:
-            available = (
-                set(values) - set(self.previous_values) - set([self.value_level])
-            )
-        else:
-            available = set(values) - set(previous_values) - set([self.value_level])
-        new_idx = np.random.choice(list(available))
-        return new_idx
+        self.value_level = rng.choice(range(int(min_level), max_level + 1))
 
     def get_value_level(self):
         return self.value_level
@@ -107,6 +210,8 @@ class Number(Attribute):
 
 class Type(Attribute):
 
+    __slots__ = ("value_level", "values", "min_level", "max_level")
+
     def __init__(self, min_level=TYPE_MIN, max_level=TYPE_MAX):
         super(Type, self).__init__("Type")
         self.value_level = 0
@@ -114,26 +219,12 @@ class Type(Attribute):
         self.min_level = min_level
         self.max_level = max_level
 
-    def sample(self, min_level=TYPE_MIN, max_level=TYPE_MAX):
+    def sample(self, rng, min_level=TYPE_MIN, max_level=TYPE_MAX):
         min_level = max(self.min_level, min_level)
         max_level = min(self.max_level, max_level)
         if min_level == max_level + 1:
             max_level = max_level + 1
-        self.value_level = np.random.choice(range(min_level, max_level + 1))
-
-    def sample_new(self, min_level=None, max_level=None, previous_values=None):
-        if min_level is None or max_level is None:
-            values = range(self.min_level, self.max_level + 1)
-        else:
-            values = range(min_level, max_level + 1)
-        if not previous_values:
-            available = (
-                set(values) - set(self.previous_values) - set([self.value_level])
-            )
-        else:
-            available = set(values) - set(previous_values) - set([self.value_level])
-        new_idx = np.random.choice(list(available))
-        return new_idx
+        self.value_level = rng.choice(range(min_level, max_level + 1))
 
     def get_value_level(self):
         return self.value_level
@@ -149,6 +240,8 @@ class Type(Attribute):
 
 class Size(Attribute):
 
+    __slots__ = ("value_level", "values", "min_level", "max_level")
+
     def __init__(self, min_level=SIZE_MIN, max_level=SIZE_MAX):
         super(Size, self).__init__("Size")
         self.value_level = 3
@@ -156,24 +249,10 @@ class Size(Attribute):
         self.min_level = min_level
         self.max_level = max_level
 
-    def sample(self, min_level=SIZE_MIN, max_level=SIZE_MAX):
+    def sample(self, rng, min_level=SIZE_MIN, max_level=SIZE_MAX):
         min_level = max(self.min_level, min_level)
         max_level = min(self.max_level, max_level)
-        self.value_level = np.random.choice(range(min_level, max_level + 1))
-
-    def sample_new(self, min_level=None, max_level=None, previous_values=None):
-        if min_level is None or max_level is None:
-            values = range(self.min_level, self.max_level + 1)
-        else:
-            values = range(min_level, max_level + 1)
-        if not previous_values:
-            available = (
-                set(values) - set(self.previous_values) - set([self.value_level])
-            )
-        else:
-            available = set(values) - set(previous_values) - set([self.value_level])
-        new_idx = np.random.choice(list(available))
-        return new_idx
+        self.value_level = rng.choice(range(min_level, max_level + 1))
 
     def get_value_level(self):
         return self.value_level
@@ -189,6 +268,8 @@ class Size(Attribute):
 
 class Color(Attribute):
 
+    __slots__ = ("value_level", "values", "min_level", "max_level")
+
     def __init__(self, min_level=COLOR_MIN, max_level=COLOR_MAX):
         super(Color, self).__init__("Color")
         self.value_level = 0
@@ -196,24 +277,10 @@ class Color(Attribute):
         self.min_level = min_level
         self.max_level = max_level
 
-    def sample(self, min_level=COLOR_MIN, max_level=COLOR_MAX):
+    def sample(self, rng, min_level=COLOR_MIN, max_level=COLOR_MAX):
         min_level = max(self.min_level, min_level)
         max_level = min(self.max_level, max_level)
-        self.value_level = np.random.choice(range(min_level, max_level + 1))
-
-    def sample_new(self, min_level=None, max_level=None, previous_values=None):
-        if min_level is None or max_level is None:
-            values = range(self.min_level, self.max_level + 1)
-        else:
-            values = range(min_level, max_level + 1)
-        if not previous_values:
-            available = (
-                set(values) - set(self.previous_values) - set([self.value_level])
-            )
-        else:
-            available = set(values) - set(previous_values) - set([self.value_level])
-        new_idx = np.random.choice(list(available))
-        return new_idx
+        self.value_level = rng.choice(range(min_level, max_level + 1))
 
     def get_value_level(self):
         return self.value_level
@@ -229,6 +296,8 @@ class Color(Attribute):
 
 class Angle(Attribute):
 
+    __slots__ = ("value_level", "values", "min_level", "max_level")
+
     def __init__(self, min_level=ANGLE_MIN, max_level=ANGLE_MAX):
         super(Angle, self).__init__("Angle")
         self.value_level = 3
@@ -236,24 +305,10 @@ class Angle(Attribute):
         self.min_level = min_level
         self.max_level = max_level
 
-    def sample(self, min_level=ANGLE_MIN, max_level=ANGLE_MAX):
+    def sample(self, rng, min_level=ANGLE_MIN, max_level=ANGLE_MAX):
         min_level = max(self.min_level, min_level)
         max_level = min(self.max_level, max_level)
-        self.value_level = np.random.choice(range(min_level, max_level + 1))
-
-    def sample_new(self, min_level=None, max_level=None, previous_values=None):
-        if min_level is None or max_level is None:
-            values = range(self.min_level, self.max_level + 1)
-        else:
-            values = range(min_level, max_level + 1)
-        if not previous_values:
-            available = (
-                set(values) - set(self.previous_values) - set([self.value_level])
-            )
-        else:
-            available = set(values) - set(previous_values) - set([self.value_level])
-        new_idx = np.random.choice(list(available))
-        return new_idx
+        self.value_level = rng.choice(range(min_level, max_level + 1))
 
     def get_value_level(self):
         return self.value_level
@@ -269,6 +324,8 @@ class Angle(Attribute):
 
 class Uniformity(Attribute):
 
+    __slots__ = ("value_level", "values", "min_level", "max_level")
+
     def __init__(self, min_level=UNI_MIN, max_level=UNI_MAX):
         super(Uniformity, self).__init__("Uniformity")
         self.value_level = 0
@@ -276,10 +333,10 @@ class Uniformity(Attribute):
         self.min_level = min_level
         self.max_level = max_level
 
-    def sample(self):
-        self.value_level = np.random.choice(range(self.min_level, self.max_level + 1))
+    def sample(self, rng):
+        self.value_level = rng.choice(range(self.min_level, self.max_level + 1))
 
-    def sample_new(self):
+    def sample_new(self, rng):
         # Should not resample uniformity
         pass
 
@@ -301,6 +358,8 @@ class Position(Attribute):
     while angular Position performs roration around an axis penperdicular to the plane.
     """
 
+    __slots__ = ("pos_type", "values", "value_idx", "isChanged")
+
     def __init__(self, pos_type, pos_list):
         """Instantiate the Position attribute by passing a position type
         and a pre-defined position distribution on the plane. This attribute
@@ -319,45 +378,86 @@ class Position(Attribute):
         self.value_idx = None
         self.isChanged = False
 
-    def sample(self, num):
+    def sample(self, rng, num):
         """Sample multiple positions at the same time.
         Arguments:
+            rng(np.random.Generator): source of randomness
             num(int): the number of positions to sample
         """
         length = len(self.values)
         assert num <= length
-        self.value_idx = np.random.choice(range(length), num, False)
+        self.value_idx = rng.choice(range(length), num, False)
 
-    def sample_new(self, num, previous_values=None):
-        # Here sample new relies on probability
-        length = len(self.values)
+    def get_used_ranks(self, num, previous_values=None, masks=()):
+        """Ranks of the sets of num positions that sample_new avoids.
+        Arguments:
+            num(int): the number of positions
+            previous_values(list of np.ndarray): sets of positions to avoid besides
+                the current one; self.previous_values by default
+            masks(iterable of int): further sets of positions to avoid, as bitmasks
+        Returns:
+            used_ranks(list of int): sorted ranks of the sets of positions
+        """
         if not previous_values:
             constraints = self.previous_values
         else:
             constraints = previous_values
-        while True:
-            finished = True
-            new_value_idx = np.random.choice(length, num, False)
-            if set(new_value_idx) == set(self.value_idx):
-                continue
-            for previous_value in constraints:
-                if set(new_value_idx) == set(previous_value):
-                    finished = False
-                    break
-            if finished:
+        used_ranks = {
+            rank_combination(value_idx)
+            for value_idx in [self.value_idx] + list(constraints)
+            if len(value_idx) == num
+        }
+        used_ranks.update(
+            rank_combination(get_position_idx(mask))
+            for mask in masks
+            if count_positions(mask) == num
+        )
+        return sorted(used_ranks)
+
+    def count_new(self, num, previous_values=None, masks=()):
+        """Number of the sets of num positions that sample_new may return.
+        Arguments:
+            others: as in get_used_ranks
+        """
+        used_ranks = self.get_used_ranks(num, previous_values, masks)
+        return comb(len(self.values), num) - len(used_ranks)
+
+    def sample_new(self, rng, num, previous_values=None, masks=()):
+        """Sample new positions for generating the answer set. The set of positions is drawn
+        uniformly among the sets of num positions other than the current one and the previous
+        values, and the positions are returned in a random order.
+        Arguments:
+            rng(np.random.Generator): source of randomness
+            others: as in get_used_ranks
+        Returns:
+            new_value_idx(np.ndarray): indices of the new positions
+        """
+        length = len(self.values)
+        used_ranks = self.get_used_ranks(num, previous_values, masks)
+        num_available = comb(length, num) - len(used_ranks)
+        if num_available <= 0:
+            raise NoNewValueError(
+                "No new sets of {} positions out of {} remain".format(num, length)
+            )
+        # the rank-th set of positions that is not used
+        rank = int(rng.integers(num_available))
+        for used_rank in used_ranks:
+            if used_rank > rank:
                 break
-        return new_value_idx
+            rank += 1
+        return rng.permutation(unrank_combination(rank, num))
 
-    def sample_add(self, num):
+    def sample_add(self, rng, num):
         """Sample additional number of positions.
         Arguments:
+            rng(np.random.Generator): source of randomness
             num(int): the number of additional positions to sample
         Returns:
             ret(tuple of position): new positions to add to the layout
         """
         ret = []
         available = set(range(len(self.values))) - set(self.value_idx)
-        idxes_2_add = np.random.choice(list(available), num, False)
+        idxes_2_add = rng.choice(list(available), num, False)
         for index in idxes_2_add:
             self.value_idx = np.insert(self.value_idx, 0, index)
             ret.append(self.values[index])
@@ -366,6 +466,9 @@ class Position(Attribute):
     def get_value_idx(self):
         return self.value_idx
 
+    def get_value_mask(self):
+        return get_position_mask(self.value_idx)
+
     def set_value_idx(self, value_idx):
         # Note that after sampling self.value_idx is a Numpy array
         self.value_idx = value_idx
@@ -5,19 +5,20 @@ import copy
 
 import numpy as np
 
+from Attribute import count_positions, get_position_idx
 from const import COLOR_MAX, COLOR_MIN
 
 
-def Rule_Wrapper(name, attr, param, component_idx):
+def Rule_Wrapper(name, attr, param, component_idx, rng, value=None):
     ret = None
     if name == "Constant":
-        ret = Constant(name, attr, param, component_idx)
+        ret = Constant(name, attr, param, component_idx, rng, value)
     elif name == "Progression":
-        ret = Progression(name, attr, param, component_idx)
+        ret = Progression(name, attr, param, component_idx, rng, value)
     elif name == "Arithmetic":
-        ret = Arithmetic(name, attr, param, component_idx)
+        ret = Arithmetic(name, attr, param, component_idx, rng, value)
     elif name == "Distribute_Three":
-        ret = Distribute_Three(name, attr, param, component_idx)
+        ret = Distribute_Three(name, attr, param, component_idx, rng, value)
     else:
         raise ValueError("Unsupported Rule")
     return ret
@@ -28,7 +29,7 @@ class Rule(object):
     Priority order: Rule on Number/Position always comes first
     """
 
-    def __init__(self, name, attr, params, component_idx=0):
+    def __init__(self, name, attr, params, component_idx=0, rng=None, value=None):
         """Instantiate a rule by its name, attribute, paramter list and the component it applies to.
         Each rule should be applied to all entities in a component.
         Arguments:
@@ -36,18 +37,25 @@ class Rule(object):
             attr(str): pre-defined name of the attribute
             params(list): a list of possible parameters for it to sample
             component_idx(int): the index of the component to apply the rule
+            rng(np.random.Generator): source of randomness of the sample the rule belongs to;
+                used for sampling the parameter and whenever applying the rule requires sampling
+            value(int): the parameter of the rule; sampled from params if not given
         """
         self.name = name
         self.attr = attr
         self.params = params
         self.component_idx = component_idx
+        self.rng = rng
         self.value = 0
-        self.sample()
+        if value is None:
+            self.sample()
+        else:
+            self.value = value
 
     def sample(self):
         """Sample a parameter from the parameter list."""
         if self.params is not None:
-            self.value = np.random.choice(self.params)
+            self.value = self.rng.choice(self.params)
 
     def apply_rule(self, aot, in_aot=None):
         """Apply the rule to a component in the AoT.
@@ -64,20 +72,22 @@ class Rule(object):
 class Constant(Rule):
     """Unary operator. Nothing changes."""
 
-    def __init__(self, name, attr, param, component_idx):
-        super(Constant, self).__init__(name, attr, param, component_idx)
+    def __init__(self, name, attr, param, component_idx, rng, value=None):
+        super(Constant, self).__init__(name, attr, param, component_idx, rng, value)
 
     def apply_rule(self, aot, in_aot=None):
+        # in_aot is the result of applying the previous rules of the group,
+        # hence it can be returned as is
         if in_aot is None:
-            in_aot = aot
-        return copy.deepcopy(in_aot)
+            return copy.deepcopy(aot)
+        return in_aot
 
 
 class Progression(Rule):
     """Unary operator. Attribute difference on two consequetive Panels remains the same."""
 
-    def __init__(self, name, attr, param, component_idx):
-        super(Progression, self).__init__(name, attr, param, component_idx)
+    def __init__(self, name, attr, param, component_idx, rng, value=None):
+        super(Progression, self).__init__(name, attr, param, component_idx, rng, value)
         # Flag to trigger consistency of the attribute in the first column
         self.first_col = True
 
@@ -91,7 +101,7 @@ class Progression(Rule):
             second_layout.number.set_value_level(
                 second_layout.number.get_value_level() + self.value
             )
-            second_layout.position.sample(second_layout.number.get_value())
+            second_layout.position.sample(self.rng, second_layout.number.get_value())
             pos = second_layout.position.get_value()
             del second_layout.children[:]
             for i in range(len(pos)):
@@ -99,7 +109,7 @@ class Progression(Rule):
                 entity.name = str(i)
                 entity.bbox = pos[i]
                 if not current_layout.uniformity.get_value():
-                    entity.resample()
+                    entity.resample(self.rng)
                 second_layout.insert(entity)
         elif self.attr == "Position":
             change_value = self.value
@@ -115,30 +125,15 @@ class Progression(Rule):
             second_bbox = second_layout.position.get_value()
             for i in range(len(second_bbox)):
                 second_layout.children[i].bbox = second_bbox[i]
-        elif self.attr == "Type":
-            old_value_level = current_layout.children[0].type.get_value_level()
-            # enforce value consistency
-            if self.first_col and not current_layout.uniformity.get_value():
-                for entity in current_layout.children:
-                    entity.type.set_value_level(old_value_level)
-            for entity in second_layout.children:
-                entity.type.set_value_level(old_value_level + self.value)
-        elif self.attr == "Size":
-            old_value_level = current_layout.children[0].size.get_value_level()
-            # enforce value consistency
-            if self.first_col and not current_layout.uniformity.get_value():
-                for entity in current_layout.children:
-                    entity.size.set_value_level(old_value_level)
-            for entity in second_layout.children:
-                entity.size.set_value_level(old_value_level + self.value)
-        elif self.attr == "Color":
-            old_value_level = current_layout.children[0].color.get_value_level()
+        elif self.attr in ["Type", "Size", "Color"]:
+            attr_name = self.attr.lower()
+            old_value_level = getattr(
+                current_layout.children[0], attr_name
+            ).get_value_level()
             # enforce value consistency
             if self.first_col and not current_layout.uniformity.get_value():
-                for entity in current_layout.children:
-                    entity.color.set_value_level(old_value_level)
-            for entity in second_layout.children:
-                entity.color.set_value_level(old_value_level + self.value)
+                current_layout.set_value_levels(self.attr, old_value_level)
+            second_layout.set_value_levels(self.attr, old_value_level + self.value)
         else:
             raise ValueError("Unsupported attriubute")
         self.first_col = not self.first_col
@@ -150,8 +145,8 @@ class Arithmetic(Rule):
     For Position: + means SET_UNION and - SET_DIFF.
     """
 
-    def __init__(self, name, attr, param, component_idx):
-        super(Arithmetic, self).__init__(name, attr, param, component_idx)
+    def __init__(self, name, attr, param, component_idx, rng, value=None):
+        super(Arithmetic, self).__init__(name, attr, param, component_idx, rng, value)
         self.memory = []
         self.color_count = 0
         self.color_white_alarm = False
@@ -199,8 +194,8 @@ class Arithmetic(Rule):
                         new_num_max_level,
                     ]
                 second_layout.reset_constraint("Number")
-                second_layout.number.sample()
-            second_layout.position.sample(second_layout.number.get_value())
+                second_layout.number.sample(self.rng)
+            second_layout.position.sample(self.rng, second_layout.number.get_value())
             pos = second_layout.position.get_value()
             del second_layout.children[:]
             for i in range(len(pos)):
@@ -208,43 +203,37 @@ class Arithmetic(Rule):
                 entity.name = str(i)
                 entity.bbox = pos[i]
                 if not current_layout.uniformity.get_value():
-                    entity.resample()
+                    entity.resample(self.rng)
                 second_layout.insert(entity)
         elif self.attr == "Position":
             # ADD is interpreted as SET_UNION; SUB is interpreted as SET_DIFF
             # the third col
             if len(self.memory) > 0:
-                first_layout_value_idx = self.memory.pop()
+                first_layout_value_mask = self.memory.pop()
+                current_layout_value_mask = current_layout.position.get_value_mask()
                 if self.value > 0:
-                    new_pos_idx = set(first_layout_value_idx) | set(
-                        current_layout.position.get_value_idx()
-                    )
+                    new_pos_mask = first_layout_value_mask | current_layout_value_mask
                 else:
-                    new_pos_idx = set(first_layout_value_idx) - set(
-                        current_layout.position.get_value_idx()
-                    )
-                second_layout.number.set_value_level(len(new_pos_idx) - 1)
-                second_layout.position.set_value_idx(np.array(list(new_pos_idx)))
+                    new_pos_mask = first_layout_value_mask & ~current_layout_value_mask
+                second_layout.number.set_value_level(count_positions(new_pos_mask) - 1)
+                second_layout.position.set_value_idx(get_position_idx(new_pos_mask))
             # the second col
             else:
-                current_layout_value_idx = current_layout.position.get_value_idx()
-                self.memory.append(current_layout_value_idx)
+                current_layout_value_mask = current_layout.position.get_value_mask()
+                self.memory.append(current_layout_value_mask)
                 while True:
-                    second_layout.number.sample()
-                    second_layout.position.sample(second_layout.number.get_value())
+                    second_layout.number.sample(self.rng)
+                    second_layout.position.sample(
+                        self.rng, second_layout.number.get_value()
+                    )
+                    second_layout_value_mask = second_layout.position.get_value_mask()
                     # if UNION, not a subset; otherwise not clearly a union
                     if self.value > 0:
-                        if not (
-                            set(current_layout_value_idx)
-                            >= set(second_layout.position.get_value_idx())
-                        ):
+                        if second_layout_value_mask & ~current_layout_value_mask:
                             break
                     # if DIFF, not a subset; otherwise no entities left
                     else:
-                        if not (
-                            set(current_layout_value_idx)
-                            <= set(second_layout.position.get_value_idx())
-                        ):
+                        if current_layout_value_mask & ~second_layout_value_mask:
                             break
             pos = second_layout.position.get_value()
             del second_layout.children[:]
@@ -253,7 +242,7 @@ class Arithmetic(Rule):
                 entity.name = str(i)
                 entity.bbox = pos[i]
                 if not current_layout.uniformity.get_value():
-                    entity.resample()
+                    entity.resample(self.rng)
                 second_layout.insert(entity)
         elif self.attr == "Size":
             if len(self.memory) > 0:
@@ -270,15 +259,13 @@ class Arithmetic(Rule):
                         - current_layout.children[0].size.get_value_level()
                         - 1
                     )
-                for entity in second_layout.children:
-                    entity.size.set_value_level(new_size_value_level)
+                second_layout.set_value_levels("Size", new_size_value_level)
             else:
                 # make sure of value consistency
                 old_value_level = current_layout.children[0].size.get_value_level()
                 self.memory.append(old_value_level)
                 if not current_layout.uniformity.get_value():
-                    for entity in current_layout.children:
-                        entity.size.set_value_level(old_value_level)
+                    current_layout.set_value_levels("Size", old_value_level)
                 if self.value > 0:
                     size_max_level_orig = (
                         sum(current_layout.entity_constraint["Size"]) + 1
@@ -303,7 +290,7 @@ class Arithmetic(Rule):
                 the_child.reset_constraint(
                     "Size", new_size_min_level, new_size_max_level
                 )
-                the_child.size.sample()
+                the_child.size.sample(self.rng)
                 new_size_value_level = the_child.size.get_value_level()
                 for idx in range(1, len(second_layout.children)):
                     entity = second_layout.children[idx]
@@ -325,8 +312,7 @@ class Arithmetic(Rule):
                         first_layout_color_level
                         - current_layout.children[0].color.get_value_level()
                     )
-                for entity in second_layout.children:
-                    entity.color.set_value_level(new_color_value_level)
+                second_layout.set_value_levels("Color", new_color_value_level)
             else:
                 # Logic here: C_12 and C_22 could not be both 0, otherwise it's impossible to distinguish + and -
                 # If C_12 == 0, we set an alarm
@@ -340,15 +326,18 @@ class Arithmetic(Rule):
                 reset_current_layout = False
                 if self.color_count == 3 and self.color_white_alarm:
                     if self.value > 0 and old_value_level == COLOR_MAX:
-                        old_value_level = current_layout.children[0].color.sample_new()
+                        old_value_level = current_layout.children[0].color.sample_new(
+                            self.rng
+                        )
                         reset_current_layout = True
                     if self.value < 0 and old_value_level == COLOR_MIN:
-                        old_value_level = current_layout.children[0].color.sample_new()
+                        old_value_level = current_layout.children[0].color.sample_new(
+                            self.rng
+                        )
                         reset_current_layout = True
                 self.memory.append(old_value_level)
                 if reset_current_layout or not current_layout.uniformity.get_value():
-                    for entity in current_layout.children:
-                        entity.color.set_value_level(old_value_level)
+                    current_layout.set_value_levels("Color", old_value_level)
                 if self.value > 0:
                     color_max_level_orig = sum(
                         current_layout.entity_constraint["Color"]
@@ -371,7 +360,7 @@ class Arithmetic(Rule):
                 the_child.reset_constraint(
                     "Color", new_color_min_level, new_color_max_level
                 )
-                the_child.color.sample()
+                the_child.color.sample(self.rng)
                 new_color_value_level = the_child.color.get_value_level()
                 # the first time you apply this rule and get C_12 == 0
                 # set the alarm
@@ -382,7 +371,7 @@ class Arithmetic(Rule):
                     and self.color_white_alarm
                     and new_color_value_level == 0
                 ):
-                    new_color_value_level = the_child.color.sample_new()
+                    new_color_value_level = the_child.color.sample_new(self.rng)
                     the_child.color.set_value_level(new_color_value_level)
                 for idx in range(1, len(second_layout.children)):
                     entity = second_layout.children[idx]
@@ -398,8 +387,10 @@ class Arithmetic(Rule):
 class Distribute_Three(Rule):
     """Ternay operator. Three values across the columns form a fixed set."""
 
-    def __init__(self, name, attr, param, component_idx):
-        super(Distribute_Three, self).__init__(name, attr, param, component_idx)
+    def __init__(self, name, attr, param, component_idx, rng, value=None):
+        super(Distribute_Three, self).__init__(
+            name, attr, param, component_idx, rng, value
+        )
         self.value_levels = []
         self.count = 0
 
@@ -420,12 +411,12 @@ class Distribute_Three(Rule):
                 current_value_level = current_layout.number.get_value_level()
                 idx = all_value_levels.index(current_value_level)
                 all_value_levels.pop(idx)
-                three_value_levels = np.random.choice(all_value_levels, 2, False)
+                three_value_levels = self.rng.choice(all_value_levels, 2, False)
                 three_value_levels = np.insert(
                     three_value_levels, 0, current_value_level
                 )
                 self.value_levels.append(three_value_levels[[0, 1, 2]])
-                if np.random.uniform() >= 0.5:
+                if self.rng.uniform() >= 0.5:
                     self.value_levels.append(three_value_levels[[1, 2, 0]])
                     self.value_levels.append(three_value_levels[[2, 0, 1]])
                 else:
@@ -436,7 +427,7 @@ class Distribute_Three(Rule):
                 row, col = divmod(self.count, 2)
                 if col == 0:
                     current_layout.number.set_value_level(self.value_levels[row][0])
-                    current_layout.resample()
+                    current_layout.resample(self.rng)
                     second_aot = copy.deepcopy(aot)
                     second_layout = (
                         second_aot.children[0].children[self.component_idx].children[0]
@@ -444,7 +435,7 @@ class Distribute_Three(Rule):
                     second_layout.number.set_value_level(self.value_levels[row][1])
                 else:
                     second_layout.number.set_value_level(self.value_levels[row][2])
-            second_layout.position.sample(second_layout.number.get_value())
+            second_layout.position.sample(self.rng, second_layout.number.get_value())
             pos = second_layout.position.get_value()
             del second_layout.children[:]
             for i in range(len(pos)):
@@ -452,7 +443,7 @@ class Distribute_Three(Rule):
                 entity.name = str(i)
                 entity.bbox = pos[i]
                 if not current_layout.uniformity.get_value():
-                    entity.resample()
+                    entity.resample(self.rng)
                 second_layout.insert(entity)
             self.count = (self.count + 1) % 6
         elif self.attr == "Position":
@@ -460,11 +451,11 @@ class Distribute_Three(Rule):
                 # sample new does not change value_level/value_idx
                 num = current_layout.number.get_value()
                 pos_0 = current_layout.position.get_value_idx()
-                pos_1 = current_layout.position.sample_new(num)
-                pos_2 = current_layout.position.sample_new(num, [pos_1])
+                pos_1 = current_layout.position.sample_new(self.rng, num)
+                pos_2 = current_layout.position.sample_new(self.rng, num, [pos_1])
                 three_value_levels = np.array([pos_0, pos_1, pos_2])
                 self.value_levels.append(three_value_levels[[0, 1, 2]])
-                if np.random.uniform() >= 0.5:
+                if self.rng.uniform() >= 0.5:
                     self.value_levels.append(three_value_levels[[1, 2, 0]])
                     self.value_levels.append(three_value_levels[[2, 0, 1]])
                 else:
@@ -477,7 +468,7 @@ class Distribute_Three(Rule):
                     current_layout.number.set_value_level(
                         len(self.value_levels[row][0]) - 1
                     )
-                    current_layout.resample()
+                    current_layout.resample(self.rng)
                     current_layout.position.set_value_idx(self.value_levels[row][0])
                     pos = current_layout.position.get_value()
                     for i in range(len(pos)):
@@ -503,32 +494,27 @@ class Distribute_Three(Rule):
                 )
                 # if np.random.uniform() >= 0.5 and 0 not in all_value_levels:
                 #     all_value_levels.insert(0, 0)
-                three_value_levels = np.random.choice(all_value_levels, 3, False)
-                np.random.shuffle(three_value_levels)
+                three_value_levels = self.rng.choice(all_value_levels, 3, False)
+                self.rng.shuffle(three_value_levels)
                 self.value_levels.append(three_value_levels[[0, 1, 2]])
-                if np.random.uniform() >= 0.5:
+                if self.rng.uniform() >= 0.5:
                     self.value_levels.append(three_value_levels[[1, 2, 0]])
                     self.value_levels.append(three_value_levels[[2, 0, 1]])
                 else:
                     self.value_levels.append(three_value_levels[[2, 0, 1]])
                     self.value_levels.append(three_value_levels[[1, 2, 0]])
-                for entity in current_layout.children:
-                    entity.type.set_value_level(self.value_levels[0][0])
-                for entity in second_layout.children:
-                    entity.type.set_value_level(self.value_levels[0][1])
+                current_layout.set_value_levels("Type", self.value_levels[0][0])
+                second_layout.set_value_levels("Type", self.value_levels[0][1])
             else:
                 row, col = divmod(self.count, 2)
                 if col == 0:
                     value_level = self.value_levels[row][0]
-                    for entity in current_layout.children:
-                        entity.type.set_value_level(value_level)
+                    current_layout.set_value_levels("Type", value_level)
                     value_level = self.value_levels[row][1]
-                    for entity in second_layout.children:
-                        entity.type.set_value_level(value_level)
+                    second_layout.set_value_levels("Type", value_level)
                 else:
                     value_level = self.value_levels[row][2]
-                    for entity in second_layout.children:
-                        entity.type.set_value_level(value_level)
+                    second_layout.set_value_levels("Type", value_level)
             self.count = (self.count + 1) % 6
         elif self.attr == "Size":
             if self.count == 0:
@@ -536,31 +522,26 @@ class Distribute_Three(Rule):
                     current_layout.entity_constraint["Size"][0],
                     current_layout.entity_constraint["Size"][1] + 1,
                 )
-                three_value_levels = np.random.choice(all_value_levels, 3, False)
+                three_value_levels = self.rng.choice(all_value_levels, 3, False)
                 self.value_levels.append(three_value_levels[[0, 1, 2]])
-                if np.random.uniform() >= 0.5:
+                if self.rng.uniform() >= 0.5:
                     self.value_levels.append(three_value_levels[[1, 2, 0]])
                     self.value_levels.append(three_value_levels[[2, 0, 1]])
                 else:
                     self.value_levels.append(three_value_levels[[2, 0, 1]])
                     self.value_levels.append(three_value_levels[[1, 2, 0]])
-                for entity in current_layout.children:
-                    entity.size.set_value_level(self.value_levels[0][0])
-                for entity in second_layout.children:
-                    entity.size.set_value_level(self.value_levels[0][1])
+                current_layout.set_value_levels("Size", self.value_levels[0][0])
+                second_layout.set_value_levels("Size", self.value_levels[0][1])
             else:
                 row, col = divmod(self.count, 2)
                 if col == 0:
                     value_level = self.value_levels[row][0]
-                    for entity in current_layout.children:
-                        entity.size.set_value_level(value_level)
+                    current_layout.set_value_levels("Size", value_level)
                     value_level = self.value_levels[row][1]
-                    for entity in second_layout.children:
-                        entity.size.set_value_level(value_level)
+                    second_layout.set_value_levels("Size", value_level)
                 else:
                     value_level = self.value_levels[row][2]
-                    for entity in second_layout.children:
-                        entity.size.set_value_level(value_level)
+                    second_layout.set_value_levels("Size", value_level)
             self.count = (self.count + 1) % 6
         elif self.attr == "Color":
             if self.count == 0:
@@ -568,31 +549,26 @@ class Distribute_Three(Rule):
                     current_layout.entity_constraint["Color"][0],
                     current_layout.entity_constraint["Color"][1] + 1,
                 )
-                three_value_levels = np.random.choice(all_value_levels, 3, False)
+                three_value_levels = self.rng.choice(all_value_levels, 3, False)
                 self.value_levels.append(three_value_levels[[0, 1, 2]])
-                if np.random.uniform() >= 0.5:
+                if self.rng.uniform() >= 0.5:
                     self.value_levels.append(three_value_levels[[1, 2, 0]])
                     self.value_levels.append(three_value_levels[[2, 0, 1]])
                 else:
                     self.value_levels.append(three_value_levels[[2, 0, 1]])
                     self.value_levels.append(three_value_levels[[1, 2, 0]])
-                for entity in current_layout.children:
-                    entity.color.set_value_level(self.value_levels[0][0])
-                for entity in second_layout.children:
-                    entity.color.set_value_level(self.value_levels[0][1])
+                current_layout.set_value_levels("Color", self.value_levels[0][0])
+                second_layout.set_value_levels("Color", self.value_levels[0][1])
             else:
                 row, col = divmod(self.count, 2)
                 if col == 0:
                     value_level = self.value_levels[row][0]
-                    for entity in current_layout.children:
-                        entity.color.set_value_level(value_level)
+                    current_layout.set_value_levels("Color", value_level)
                     value_level = self.value_levels[row][1]
-                    for entity in second_layout.children:
-                        entity.color.set_value_level(value_level)
+                    second_layout.set_value_levels("Color", value_level)
                 else:
                     value_level = self.value_levels[row][2]
-                    for entity in second_layout.children:
-                        entity.color.set_value_level(value_level)
+                    second_layout.set_value_levels("Color", value_level)
             self.count = (self.count + 1) % 6
         else:
             raise ValueError("Unsupported attriubute")
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 
+import functools
 import xml.etree.ElementTree as ET
 
 import cv2
@@ -8,6 +9,19 @@ import numpy as np
 from const import DEFAULT_WIDTH, IMAGE_SIZE
 from rendering import render_entity
 
+# Max number of entities whose real bbox and run-length encoded mask are kept in
+# memory. Like rendered images, they depend only on the bbox and attribute values
+# of an entity, which take a small number of distinct values.
+METADATA_CACHE_SIZE = 16384
+
+# Max number of full-resolution masks kept in memory by get_mask (~200 KB each)
+MASK_CACHE_SIZE = 256
+
+# Margin in pixels around the real bbox of an entity, within which masks cropped
+# to the real bbox are encoded. Real bboxes of shapes are within 3 pixels of their
+# masks, but those of the lines of meshes don't contain them.
+CROP_MARGIN = 4
+
 
 class Bunch:
     """Dummy class"""
@@ -17,6 +31,14 @@ class Bunch:
 
 
 def get_real_bbox(entity_bbox, entity_type, entity_size, entity_angle):
+    """Bounding box of an entity after rotation, computed once for each distinct entity."""
+    return list(
+        _get_real_bbox(tuple(entity_bbox), entity_type, entity_size, entity_angle)
+    )
+
+
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
+def _get_real_bbox(entity_bbox, entity_type, entity_size, entity_angle):
     assert entity_type != "none"
     center = (int(entity_bbox[1] * IMAGE_SIZE), int(entity_bbox[0] * IMAGE_SIZE))
     M = cv2.getRotationMatrix2D(center, entity_angle, 1)
@@ -132,10 +154,34 @@ def get_real_bbox(entity_bbox, entity_type, entity_size, entity_angle):
             max_x - min_x + delta,
             max_y - min_y + delta,
         ]
-    return list(np.round(real_bbox, 4))
+    return tuple(np.round(real_bbox, 4))
 
 
 def get_mask(entity_bbox, entity_type, entity_size, entity_angle):
+    """Mask of an entity. Masks are cached and returned as read-only arrays
+    shared between calls.
+    """
+    return _get_mask(tuple(entity_bbox), entity_type, entity_size, entity_angle)
+
+
+def get_mask_rle(entity_bbox, entity_type, entity_size, entity_angle):
+    """Run-length encoding of the mask of an entity, computed once for each distinct entity."""
+    return _get_mask_rle(tuple(entity_bbox), entity_type, entity_size, entity_angle)
+
+
+@functools.lru_cache(maxsize=MASK_CACHE_SIZE)
+def _get_mask(*entity_values):
+    mask = render_mask(*entity_values)
+    mask.flags.writeable = False
+    return mask
+
+
+@functools.lru_cache(maxsize=METADATA_CACHE_SIZE)
+def _get_mask_rle(*entity_values):
+    return rle_encode(render_mask(*entity_values))
+
+
+def render_mask(entity_bbox, entity_type, entity_size, entity_angle):
     dummy_entity = Bunch()
     dummy_entity.bbox = entity_bbox
     dummy_entity.type = Bunch(get_value=lambda: entity_type)
@@ -146,31 +192,100 @@ def get_mask(entity_bbox, entity_type, entity_size, entity_angle):
     return mask
 
 
+def get_crop_window(real_bbox, shape=(IMAGE_SIZE, IMAGE_SIZE)):
+    """Window of the pixels around the real bbox of an entity, within which cropped masks
+    are encoded. The window is CROP_MARGIN pixels larger than the real bbox on each side.
+    Arguments:
+        real_bbox(list of float): real bbox of the entity, as returned by get_real_bbox
+        shape(tuple of int): height and width of the mask
+    Returns:
+        window(tuple of int): top, left, bottom and right of the window, the last two exclusive
+    """
+    height, width = shape
+    center_y, center_x, box_height, box_width = real_bbox[:4]
+    top = int(np.floor((center_y - box_height / 2) * height)) - CROP_MARGIN
+    left = int(np.floor((center_x - box_width / 2) * width)) - CROP_MARGIN
+    bottom = int(np.ceil((center_y + box_height / 2) * height)) + CROP_MARGIN
+    right = int(np.ceil((center_x + box_width / 2) * width)) + CROP_MARGIN
+    return max(top, 0), max(left, 0), min(bottom, height), min(right, width)
+
+
+def get_runs(img, real_bbox=None):
+    """Run lengths of a mask, as (start, length) pairs with 1-based starts, where each
+    run starts and ends at a change of value of the pixels in a row-major order.
+    Arguments:
+        img(np.ndarray): the mask
+        real_bbox(list of float): if given, only the window of img returned by
+            get_crop_window is encoded, with starts relative to the window
+    Returns:
+        runs(np.ndarray): starts and lengths of the runs, interleaved
+    """
+    if real_bbox is not None:
+        top, left, bottom, right = get_crop_window(real_bbox, img.shape)
+        crop = img[top:bottom, left:right]
+        if np.count_nonzero(crop) != np.count_nonzero(img):
+            raise ValueError(
+                "The mask extends beyond the window {} of real bbox {}".format(
+                    (top, left, bottom, right), real_bbox
+                )
+            )
+        img = crop
+    pixels = np.concatenate([[0], np.ravel(img), [0]])
+    runs = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    runs[1::2] -= runs[:-1:2]
+    return runs
+
+
 # ref: https://www.kaggle.com/stainsby/fast-tested-rle
 # ref: https://www.kaggle.com/paulorzp/run-length-encode-and-decode
-def rle_encode(img):
+def rle_encode(img, real_bbox=None):
     """
     img: numpy array, 1 - mask, 0 - background
+    real_bbox: if given, the mask is cropped to the real bbox of the entity, see get_runs
     Returns run length as string formated
     """
-    pixels = img.flatten()
-    pixels = np.concatenate([[0], pixels, [0]])
-    runs = np.where(pixels[1:] != pixels[:-1])[0] + 1
-    runs[1::2] -= runs[:-1:2]
-    return "[" + ",".join(str(x) for x in runs) + "]"
+    return "[" + ",".join(map(str, get_runs(img, real_bbox).tolist())) + "]"
 
 
-def rle_decode(mask_rle, shape):
+def rle_encode_binary(img, real_bbox=None):
+    """Binary alternative of rle_encode, with the same runs stored in an array.
+    Returns:
+        runs(np.ndarray): runs as np.uint16, or np.uint32 for masks of 2 ** 16 pixels or more
     """
-    mask_rle: run-length as string formated (start length)
+    dtype = np.uint16 if img.size < 2**16 else np.uint32
+    return get_runs(img, real_bbox).astype(dtype)
+
+
+def rle_decode(mask_rle, shape, real_bbox=None):
+    """
+    mask_rle: run-length as string formated (start length), or an array from rle_encode_binary
     shape: (height,width) of array to return
+    real_bbox: the real bbox the mask was cropped to when encoded, if any
     Returns numpy array, 1 - mask, 0 - background
     """
-    s = mask_rle[1:-1].split(",")
-    starts, lengths = [np.asarray(x, dtype=int) for x in (s[0:][::2], s[1:][::2])]
-    starts -= 1
+    if isinstance(mask_rle, str):
+        values = mask_rle[1:-1].split(",") if mask_rle[1:-1] else []
+        runs = np.fromiter(map(int, values), np.int64)
+    else:
+        runs = np.asarray(mask_rle, np.int64)
+    if real_bbox is None:
+        top, left, bottom, right = 0, 0, shape[0], shape[1]
+    else:
+        top, left, bottom, right = get_crop_window(real_bbox, shape)
+    num_runs = len(runs) // 2
+    starts = runs[0 : 2 * num_runs : 2] - 1
+    lengths = runs[1 : 2 * num_runs : 2]
     ends = starts + lengths
-    img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
-    for lo, hi in zip(starts, ends):
-        img[lo:hi] = 1
-    return img.reshape(shape)
+    # lengths of the background before each run and after the last one, interleaved
+    # with lengths of the runs
+    repeats = np.empty(2 * num_runs + 1, np.int64)
+    repeats[0:-1:2] = starts - np.concatenate([[0], ends[:-1]])
+    repeats[1::2] = lengths
+    repeats[-1] = (bottom - top) * (right - left) - (ends[-1] if num_runs else 0)
+    values = np.zeros(2 * num_runs + 1, np.uint8)
+    values[1::2] = 1
+    img = np.zeros(shape, dtype=np.uint8)
+    img[top:bottom, left:right] = np.repeat(values, repeats).reshape(
+        bottom - top, right - left
+    )
+    return img
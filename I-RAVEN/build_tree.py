@@ -336,3 +336,15 @@ def build_in_distribute_four_out_center_single(add_mesh=False):
     root.insert(struct)
 
     return root
+
+
+# Builders of the configuration trees, keyed by the name of the configuration
+CONFIGURATIONS = {
+    "center_single": build_center_single,
+    "distribute_four": build_distribute_four,
+    "distribute_nine": build_distribute_nine,
+    "left_center_single_right_center_single": build_left_center_single_right_center_single,
+    "up_center_single_down_center_single": build_up_center_single_down_center_single,
+    "in_center_single_out_center_single": build_in_center_single_out_center_single,
+    "in_distribute_four_out_center_single": build_in_distribute_four_out_center_single,
+}
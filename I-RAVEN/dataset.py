@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+
+import glob
+import os
+import re
+import struct
+import zipfile
+
+import numpy as np
+
+from storage import SHARDS_HEADER_FILENAME, SPLITS, ShardReader, decode_structure
+
+NPZ_PATTERN = re.compile(r"RAVEN_(\d+)_(train|val|test)\.npz$")
+
+# Size of the fixed part of a zip local file header
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def memmap_npz(path):
+    """Load the arrays of an .npz file. Arrays stored without compression are
+    memory-mapped read-only instead of being read into memory, so processes
+    reading the same file share its pages.
+    Arguments:
+        path(str): path of the .npz file
+    Returns:
+        arrays(dict): arrays of the file, keyed by their name
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as zipf, open(path, "rb") as f:
+        for info in zipf.infolist():
+            key = info.filename[: -len(".npy")]
+            if info.compress_type == zipfile.ZIP_STORED:
+                # the member data follows the local header, whose extra field
+                # may differ from the one in the central directory
+                f.seek(info.header_offset)
+                local_header = f.read(ZIP_LOCAL_HEADER_SIZE)
+                name_size, extra_size = struct.unpack("<HH", local_header[26:30])
+                f.seek(
+                    info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_size + extra_size
+                )
+                version = np.lib.format.read_magic(f)
+                if version in [(1, 0), (2, 0)]:
+                    if version == (1, 0):
+                        header = np.lib.format.read_array_header_1_0(f)
+                    else:
+                        header = np.lib.format.read_array_header_2_0(f)
+                    shape, fortran_order, dtype = header
+                    if not dtype.hasobject:
+                        arrays[key] = np.memmap(
+                            path,
+                            dtype,
+                            mode="r",
+                            offset=f.tell(),
+                            shape=shape,
+                            order="F" if fortran_order else "C",
+                        )
+                        continue
+            with zipf.open(info) as member:
+                arrays[key] = np.lib.format.read_array(member, allow_pickle=False)
+    return arrays
+
+
+def find_configurations(path):
+    """Directories of configurations in a generated dataset.
+    Arguments:
+        path(str): directory of a single configuration or the whole dataset
+    """
+    if os.path.exists(os.path.join(path, SHARDS_HEADER_FILENAME)) or glob.glob(
+        os.path.join(path, "RAVEN_*.npz")
+    ):
+        return [path]
+    return [
+        os.path.join(path, name)
+        for name in sorted(os.listdir(path))
+        if os.path.isdir(os.path.join(path, name))
+    ]
+
+
+class RavenDataset(object):
+    """Random-access reader of a dataset generated by main.py in either format.
+    Items are dicts with the arrays of a sample. The image and meta_* arrays are
+    read-only views of memory-mapped files, hence data loader workers reading
+    the same dataset share the page cache instead of holding private copies.
+    """
+
+    def __init__(self, path, splits=None):
+        """
+        Arguments:
+            path(str): directory of a single configuration or the whole dataset
+            splits(list): names of the splits to read, e.g. ["train"]; all splits by default
+        """
+        if splits is None:
+            splits = SPLITS
+        self.path = os.path.expanduser(path)
+        self.splits = splits
+        # samples are described by (configuration, k, set_name)
+        self.samples = []
+        self.directories = {}
+        self.shard_readers = {}
+        for directory in find_configurations(self.path):
+            configuration = os.path.basename(directory)
+            self.directories[configuration] = directory
+            if os.path.exists(os.path.join(directory, SHARDS_HEADER_FILENAME)):
+                reader = ShardReader(directory)
+                self.shard_readers[configuration] = reader
+                for k in reader.keys():
+                    set_name = SPLITS[reader.entries[k]["split"]]
+                    if set_name in splits:
+                        self.samples.append((configuration, k, set_name))
+            else:
+                samples = []
+                for filename in os.listdir(directory):
+                    match = NPZ_PATTERN.match(filename)
+                    if match is not None and match.group(2) in splits:
+                        samples.append(
+                            (configuration, int(match.group(1)), match.group(2))
+                        )
+                self.samples += sorted(samples)
+        # memory maps are opened lazily in each process using the dataset
+        self._shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _get_shard(self, configuration, shard):
+        if (configuration, shard) not in self._shards:
+            reader = self.shard_readers[configuration]
+            self._shards[configuration, shard] = reader.memmap(shard)
+        return self._shards[configuration, shard]
+
+    def __getitem__(self, idx):
+        """
+        Returns:
+            arrays(dict): arrays of the idx-th sample, as saved by main.py
+        """
+        configuration, k, set_name = self.samples[idx]
+        if configuration in self.shard_readers:
+            entry = self.shard_readers[configuration].entries[k]
+            records = self._get_shard(configuration, int(entry["shard"]))
+            record = int(entry["record"])
+            arrays = {key: records[key][record] for key in records.dtype.names}
+            arrays["structure"] = decode_structure(arrays["structure"])
+            return arrays
+        filename = "RAVEN_{}_{}.npz".format(k, set_name)
+        return memmap_npz(os.path.join(self.directories[configuration], filename))
+
+    def get_xml(self, idx):
+        """
+        Returns:
+            dom(bytes): XML description of the idx-th sample
+        """
+        configuration, k, set_name = self.samples[idx]
+        if configuration in self.shard_readers:
+            return self.shard_readers[configuration].read_xml(k)
+        filename = "RAVEN_{}_{}.xml".format(k, set_name)
+        with open(os.path.join(self.directories[configuration], filename), "rb") as f:
+            return f.read()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from tqdm import tqdm
+
+from dataset import RavenDataset
+from serialize import check_xml_format_version, get_rule_values
+from storage import SPLITS
+
+HASH_INDEX_FILENAME = "hash_index.npy"
+
+# Entries of the index of a configuration, sorted by the hash
+HASH_INDEX_DTYPE = np.dtype([("hash", "<u8"), ("k", "<i8"), ("split", "u1")])
+
+
+def get_panel_key(panel):
+    """Symbolic state of a panel: its structure and, for each layout, the levels of Number
+    and Uniformity and the set of entities described by their positions and the levels of
+    their Type, Size and Color. Angle is left out, as it isn't governed by rules.
+    Arguments:
+        panel(ET.Element): the Panel element
+    Returns:
+        key(tuple): the state, equal to get_aot_panel_key of the AoT of the panel
+    """
+    struct = panel.find("Struct")
+    key = [struct.get("name")]
+    for component in struct.findall("Component"):
+        layout = component.find("Layout")
+        entities = sorted(
+            (
+                tuple(json.loads(entity.get("bbox"))),
+                int(entity.get("Type")),
+                int(entity.get("Size")),
+                int(entity.get("Color")),
+            )
+            for entity in layout.findall("Entity")
+        )
+        key.append(
+            (
+                component.get("name"),
+                layout.get("name"),
+                int(layout.get("Number")),
+                int(layout.get("Uniformity")),
+                tuple(entities),
+            )
+        )
+    return tuple(key)
+
+
+def get_aot_panel_key(panel):
+    """Symbolic state of a panel, see get_panel_key.
+    Arguments:
+        panel(AoTNode): the AoT of the panel
+    """
+    struct = panel.children[0]
+    key = [struct.name]
+    for component in struct.children:
+        layout = component.children[0]
+        entities = sorted(
+            (
+                tuple(entity.bbox),
+                int(entity.type.get_value_level()),
+                int(entity.size.get_value_level()),
+                int(entity.color.get_value_level()),
+            )
+            for entity in layout.children
+        )
+        key.append(
+            (
+                component.name,
+                layout.name,
+                int(layout.number.get_value_level()),
+                int(layout.uniformity.get_value_level()),
+                tuple(entities),
+            )
+        )
+    return tuple(key)
+
+
+def get_rule_key(rule):
+    """Name, attribute and sampled values of a rule.
+    Arguments:
+        rule(ET.Element): the Rule element
+    Returns:
+        key(tuple): equal to get_aot_rule_key of the rule
+    """
+    value_levels = rule.get("value_levels")
+    if value_levels is not None:
+        value_levels = json.loads(value_levels)
+    return (rule.get("name"), rule.get("attr"), int(rule.get("value")), value_levels)
+
+
+def get_aot_rule_key(rule):
+    return (rule.name, rule.attr) + get_rule_values(rule)
+
+
+def hash_keys(rule_keys, panel_keys):
+    """Canonical hash of the symbolic state of a sample: its rules with their values, the
+    states of its context panels and the set of states of its candidates. The candidates
+    are sorted, which leaves out their order and thereby the position of the answer on
+    purpose, so samples that differ only in the order of the candidates, the rotation of
+    entities or rendering details share the hash.
+    Arguments:
+        rule_keys(list of list of tuple): keys of the rules of each component
+        panel_keys(list of tuple): keys of the 8 context panels and the 8 candidates
+    Returns:
+        hash(int): 64-bit hash
+    """
+    state = (
+        tuple(map(tuple, rule_keys)),
+        tuple(panel_keys[:8]),
+        tuple(sorted(panel_keys[8:])),
+    )
+    digest = hashlib.blake2b(repr(state).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def matrix_hash(dom):
+    """Hash of the symbolic state of a sample read from its XML, see hash_keys.
+    Arguments:
+        dom(bytes): XML description of the sample
+    """
+    data = ET.fromstring(dom)
+    check_xml_format_version(data)
+    rule_keys = [
+        [get_rule_key(rule) for rule in rule_group] for rule_group in data.find("Rules")
+    ]
+    panel_keys = [get_panel_key(panel) for panel in data.find("Panels")]
+    return hash_keys(rule_keys, panel_keys)
+
+
+def aot_matrix_hash(instances, rule_groups):
+    """Hash of the symbolic state of a sample during generation, equal to matrix_hash of
+    its XML, see hash_keys.
+    Arguments:
+        instances(list of AoTNode): the 8 context panels followed by the 8 candidates
+        rule_groups(list of list of Rule): rules that apply to each component
+    """
+    rule_keys = [[get_aot_rule_key(rule) for rule in group] for group in rule_groups]
+    panel_keys = [get_aot_panel_key(panel) for panel in instances]
+    return hash_keys(rule_keys, panel_keys)
+
+
+# Per-process state of the workers used by build_index
+_worker_dataset = None
+
+
+def init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def hash_sample(idx):
+    return matrix_hash(_worker_dataset.get_xml(idx))
+
+
+def build_index(path, workers=1):
+    """Hash all the samples of a generated dataset, in either format, and save the index of
+    each configuration to its directory. Samples of different configurations differ in
+    structure, hence duplicates are only searched for within configurations.
+    Arguments:
+        path(str): directory of a single configuration or the whole dataset
+        workers(int): number of worker processes
+    Returns:
+        indices(dict): index of each configuration, sorted by the hash
+    """
+    dataset = RavenDataset(path)
+    if workers > 1:
+        with multiprocessing.Pool(
+            workers, initializer=init_worker, initargs=(dataset,)
+        ) as pool:
+            chunksize = max(1, min(64, len(dataset) // (workers * 4)))
+            hashes = list(
+                tqdm(
+                    pool.imap(hash_sample, range(len(dataset)), chunksize),
+                    total=len(dataset),
+                )
+            )
+    else:
+        init_worker(dataset)
+        hashes = [hash_sample(idx) for idx in tqdm(range(len(dataset)))]
+    entries = {}
+    for (configuration, k, set_name), value in zip(dataset.samples, hashes):
+        entries.setdefault(configuration, []).append((value, k, SPLITS.index(set_name)))
+    indices = {}
+    for configuration, configuration_entries in entries.items():
+        index = np.array(configuration_entries, HASH_INDEX_DTYPE)
+        index.sort(order=["hash", "k"])
+        np.save(
+            os.path.join(dataset.directories[configuration], HASH_INDEX_FILENAME),
+            index,
+        )
+        indices[configuration] = index
+    return indices
+
+
+def find_duplicates(index):
+    """Groups of samples that share the hash in a sorted index.
+    Arguments:
+        index(np.ndarray): entries of HASH_INDEX_DTYPE sorted by the hash
+    Returns:
+        groups(list of np.ndarray): entries of each group of duplicates
+    """
+    hashes = index["hash"]
+    is_new = np.ones(len(index) + 1, bool)
+    is_new[1:-1] = hashes[1:] != hashes[:-1]
+    starts = np.flatnonzero(is_new)
+    return [
+        index[start:end]
+        for start, end in zip(starts[:-1], starts[1:])
+        if end - start > 1
+    ]
+
+
+def describe_group(group):
+    return " = ".join(
+        f"{SPLITS[split]} {k}" for k, split in zip(group["k"], group["split"])
+    )
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="index the symbolic states of the samples of a generated I-RAVEN "
+        "dataset and report duplicates"
+    )
+    parser.add_argument(
+        "--dataset-dir",
+        type=str,
+        default="~/datasets/I-RAVEN",
+        help="path to the dataset or to a single configuration of it",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes used to hash samples",
+    )
+    parser.add_argument(
+        "--max-reported",
+        type=int,
+        default=10,
+        help="number of groups of duplicates listed for each configuration",
+    )
+    return parser
+
+
+def main(args):
+    indices = build_index(os.path.expanduser(args.dataset_dir), args.workers)
+    duplicates = {}
+    for configuration, index in indices.items():
+        groups = find_duplicates(index)
+        duplicates[configuration] = groups
+        across_splits = sum(len(np.unique(group["split"])) > 1 for group in groups)
+        print(
+            f"Duplicates of {configuration}: {len(groups)} groups of "
+            f"{sum(map(len, groups))} samples, {across_splits} of them across splits"
+        )
+        for group in groups[: args.max_reported]:
+            print(f"  {describe_group(group)}")
+    return duplicates
+
+
+if __name__ == "__main__":
+    main_arg_parser = make_parser()
+    args = main_arg_parser.parse_args()
+    duplicates = main(args)
+    sys.exit(1 if any(duplicates.values()) else 0)
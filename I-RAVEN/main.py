@@ -3,33 +3,43 @@
 
 import argparse
 import copy
+import multiprocessing
 import os
 import random
+import zlib
+from collections import Counter
 from typing import List
 from tqdm import tqdm
 
 import numpy as np
 
-from build_tree import (
-    build_center_single,
-    build_distribute_four,
-    build_distribute_nine,
-    build_in_center_single_out_center_single,
-    build_in_distribute_four_out_center_single,
-    build_left_center_single_right_center_single,
-    build_up_center_single_down_center_single,
-)
+from Attribute import NoNewValueError
+from build_tree import CONFIGURATIONS
+from dedup import aot_matrix_hash
 from matplotlib import pyplot as plt
-from const import IMAGE_SIZE
-from rendering import render_panel
-from sampling import sample_available_attributes, sample_rules
+from manifest import MANIFEST_FILENAME, Manifest
+from rendering import render_matrix
+from sampling import (
+    RULE_SAMPLING,
+    rule_sampling_stats,
+    sample_available_attributes,
+    sample_feasible_rules,
+    sample_rules,
+)
 from serialize import (
     dom_problem,
     serialize_aot,
     serialize_rules,
     serialize_modifications,
+    write_problem,
 )
 from solver import solve
+from storage import (
+    DEFAULT_SHARD_SIZE,
+    FORMATS,
+    ShardWriter,
+    write_npz_sample,
+)
 
 
 def merge_component(dst_aot, src_aot, component_idx):
@@ -37,13 +47,18 @@ def merge_component(dst_aot, src_aot, component_idx):
     dst_aot.children[0].children[component_idx] = src_component
 
 
-def separate(args, all_configs):
-    random.seed(args.seed)
-    np.random.seed(args.seed)
+def get_set_name(args, k):
+    count_num = k % 10
+    if count_num < (10 - args.val - args.test):
+        set_name = "train"
+    elif count_num < (10 - args.test):
+        set_name = "val"
+    else:
+        set_name = "test"
+    return set_name
 
-    should_render_random_mesh_component = args.mesh == 1
-    contains_mesh_component = args.mesh == 2
 
+def get_ood_attributes(args):
     ood_attribute_indices = []
     train_set_rules = []
     for i, attribute in enumerate(["position", "type", "size", "color"]):
@@ -54,274 +69,571 @@ def separate(args, all_configs):
             if attribute == "Type" and train_set_rule == "Arithmetic":
                 raise ValueError("Arithmetic on Type is unsupported")
             train_set_rules.append(train_set_rule)
+    return ood_attribute_indices, train_set_rules
+
+
+def sample_rng(seed, configuration, k, attempt=0):
+    """Create the random number generator of the k-th sample of a configuration.
+    Each sample draws from its own stream, so the generated dataset does not depend
+    on the order in which samples are produced, e.g. by a pool of workers, and
+    any single sample can be regenerated without generating the preceding ones.
+    A sample generated again after being rejected as a duplicate draws from
+    another stream for each attempt.
+    """
+    entropy = [seed, zlib.crc32(configuration.encode()), k]
+    if attempt:
+        entropy.append(attempt)
+    return np.random.default_rng(np.random.SeedSequence(entropy))
+
+
+def parse_verify(value):
+    """Fraction of the samples checked by the solver, given as "all", "none" or "sample:P"."""
+    if value == "all":
+        return 1.0
+    if value == "none":
+        return 0.0
+    if value.startswith("sample:"):
+        try:
+            fraction = float(value[len("sample:") :])
+        except ValueError:
+            fraction = None
+        if fraction is not None and 0 <= fraction <= 1:
+            return fraction
+    raise argparse.ArgumentTypeError(
+        f"expected all, none or sample:P with P between 0 and 1, got {value}"
+    )
 
-    accs = {}
-    for configuration in all_configs.keys():
-        acc = 0
-        for k in tqdm(range(args.num_samples), desc=configuration):
-            count_num = k % 10
-            if count_num < (10 - args.val - args.test):
-                set_name = "train"
-            elif count_num < (10 - args.test):
-                set_name = "val"
-            else:
-                set_name = "test"
-
-            root = all_configs[configuration]
-            # num_components can be used to determine for which components rules should be sampled
-            num_components = len(root.children[0].children)
-            while True:
-                rule_groups = sample_rules(
-                    num_components,
-                    contains_mesh_component,
-                    configuration,
-                    ood_attribute_indices,
-                    set_name,
-                    train_set_rules,
-                )
-                new_root = root.prune(rule_groups)
-                if new_root is not None:
-                    break
-
-            start_node = new_root.sample()
-
-            row_1_1 = copy.deepcopy(start_node)
-            for l in range(len(rule_groups)):
-                rule_group = rule_groups[l]
-                rule_num_pos = rule_group[0]
-                row_1_2 = rule_num_pos.apply_rule(row_1_1)
-                row_1_3 = rule_num_pos.apply_rule(row_1_2)
-                for i in range(1, len(rule_group)):
-                    rule = rule_group[i]
-                    row_1_2 = rule.apply_rule(row_1_1, row_1_2)
-                for i in range(1, len(rule_group)):
-                    rule = rule_group[i]
-                    row_1_3 = rule.apply_rule(row_1_2, row_1_3)
-                if l == 0:
-                    to_merge = [row_1_1, row_1_2, row_1_3]
-                else:
-                    merge_component(to_merge[1], row_1_2, l)
-                    merge_component(to_merge[2], row_1_3, l)
-            row_1_1, row_1_2, row_1_3 = to_merge
-
-            row_2_1 = copy.deepcopy(start_node)
-            row_2_1.resample(True)
-            for l in range(len(rule_groups)):
-                rule_group = rule_groups[l]
-                rule_num_pos = rule_group[0]
-                row_2_2 = rule_num_pos.apply_rule(row_2_1)
-                row_2_3 = rule_num_pos.apply_rule(row_2_2)
-                for i in range(1, len(rule_group)):
-                    rule = rule_group[i]
-                    row_2_2 = rule.apply_rule(row_2_1, row_2_2)
-                for i in range(1, len(rule_group)):
-                    rule = rule_group[i]
-                    row_2_3 = rule.apply_rule(row_2_2, row_2_3)
-                if l == 0:
-                    to_merge = [row_2_1, row_2_2, row_2_3]
-                else:
-                    merge_component(to_merge[1], row_2_2, l)
-                    merge_component(to_merge[2], row_2_3, l)
-            row_2_1, row_2_2, row_2_3 = to_merge
-
-            row_3_1 = copy.deepcopy(start_node)
-            row_3_1.resample(True)
-            for l in range(len(rule_groups)):
-                rule_group = rule_groups[l]
-                rule_num_pos = rule_group[0]
-                row_3_2 = rule_num_pos.apply_rule(row_3_1)
-                row_3_3 = rule_num_pos.apply_rule(row_3_2)
-                for i in range(1, len(rule_group)):
-                    rule = rule_group[i]
-                    row_3_2 = rule.apply_rule(row_3_1, row_3_2)
-                for i in range(1, len(rule_group)):
-                    rule = rule_group[i]
-                    row_3_3 = rule.apply_rule(row_3_2, row_3_3)
-                if l == 0:
-                    to_merge = [row_3_1, row_3_2, row_3_3]
-                else:
-                    merge_component(to_merge[1], row_3_2, l)
-                    merge_component(to_merge[2], row_3_3, l)
-            row_3_1, row_3_2, row_3_3 = to_merge
-
-            imgs = [
-                render_panel(row_1_1, should_render_random_mesh_component),
-                render_panel(row_1_2, should_render_random_mesh_component),
-                render_panel(row_1_3, should_render_random_mesh_component),
-                render_panel(row_2_1, should_render_random_mesh_component),
-                render_panel(row_2_2, should_render_random_mesh_component),
-                render_panel(row_2_3, should_render_random_mesh_component),
-                render_panel(row_3_1, should_render_random_mesh_component),
-                render_panel(row_3_2, should_render_random_mesh_component),
-                np.zeros((IMAGE_SIZE, IMAGE_SIZE), np.uint8),
-            ]
-            context = [
-                row_1_1,
-                row_1_2,
-                row_1_3,
-                row_2_1,
-                row_2_2,
-                row_2_3,
-                row_3_1,
-                row_3_2,
-            ]
-            modifiable_attributes = sample_available_attributes(rule_groups, row_3_3)
-            answer_AoT = copy.deepcopy(row_3_3)
-            candidates = [answer_AoT]
 
-            num_attributes_to_modify = 3
-            selected_attr = select_modifiable_attributes(
-                num_attributes_to_modify,
+def should_verify(args, configuration, k):
+    """Whether the solver checks the k-th sample of a configuration. Samples are
+    selected with a random stream separate from the one of the sample, hence the
+    content of samples doesn't depend on the fraction of verified samples.
+    """
+    if args.verify >= 1:
+        return True
+    if args.verify <= 0:
+        return False
+    seed_sequence = np.random.SeedSequence(
+        [args.seed, zlib.crc32(configuration.encode()), k], spawn_key=(1,)
+    )
+    return np.random.default_rng(seed_sequence).random() < args.verify
+
+
+def sample_matrix(args, configuration, root, rng, set_name):
+    """Sample the rules, the context panels and the answer candidates of a matrix.
+    Arguments:
+        rng(np.random.Generator): source of randomness of the sample
+        set_name(str): name of the split of the sample
+        others: as in generate_sample
+    Returns:
+        rule_groups(list of list of Rule): rules that apply to each component
+        start_node(AoTNode): the AoT sampled for the first panel
+        context(list of AoTNode): the 8 context panels
+        candidates(list of AoTNode): the answer candidates, the answer being first
+        answer_AoT(AoTNode): the correct answer
+    """
+    contains_mesh_component = args.mesh == 2
+    ood_attribute_indices, train_set_rules = get_ood_attributes(args)
+    # num_components can be used to determine for which components rules should be sampled
+    num_components = len(root.children[0].children)
+    while True:
+        if args.rule_sampling == "table":
+            rule_groups = sample_feasible_rules(
+                rng,
+                configuration,
                 contains_mesh_component,
-                modifiable_attributes,
+                ood_attribute_indices,
+                set_name,
+                train_set_rules,
+            )
+        else:
+            rule_groups = sample_rules(
+                rng,
                 num_components,
+                contains_mesh_component,
+                configuration,
+                ood_attribute_indices,
+                set_name,
+                train_set_rules,
             )
-            random.shuffle(selected_attr)
-
-            mode = None
-            # switch attribute 'Number' for convenience
-            pos = [
-                i for i in range(len(selected_attr)) if selected_attr[i][1] == "Number"
+        new_root = root.prune(rule_groups, rng)
+        if new_root is not None:
+            break
+        rule_sampling_stats["rejections"] += 1
+
+    start_node = new_root.sample(rng)
+
+    row_1_1 = copy.deepcopy(start_node)
+    for l in range(len(rule_groups)):
+        rule_group = rule_groups[l]
+        rule_num_pos = rule_group[0]
+        row_1_2 = rule_num_pos.apply_rule(row_1_1)
+        row_1_3 = rule_num_pos.apply_rule(row_1_2)
+        for i in range(1, len(rule_group)):
+            rule = rule_group[i]
+            row_1_2 = rule.apply_rule(row_1_1, row_1_2)
+        for i in range(1, len(rule_group)):
+            rule = rule_group[i]
+            row_1_3 = rule.apply_rule(row_1_2, row_1_3)
+        if l == 0:
+            to_merge = [row_1_1, row_1_2, row_1_3]
+        else:
+            merge_component(to_merge[1], row_1_2, l)
+            merge_component(to_merge[2], row_1_3, l)
+    row_1_1, row_1_2, row_1_3 = to_merge
+
+    row_2_1 = copy.deepcopy(start_node)
+    row_2_1.resample(rng, True)
+    for l in range(len(rule_groups)):
+        rule_group = rule_groups[l]
+        rule_num_pos = rule_group[0]
+        row_2_2 = rule_num_pos.apply_rule(row_2_1)
+        row_2_3 = rule_num_pos.apply_rule(row_2_2)
+        for i in range(1, len(rule_group)):
+            rule = rule_group[i]
+            row_2_2 = rule.apply_rule(row_2_1, row_2_2)
+        for i in range(1, len(rule_group)):
+            rule = rule_group[i]
+            row_2_3 = rule.apply_rule(row_2_2, row_2_3)
+        if l == 0:
+            to_merge = [row_2_1, row_2_2, row_2_3]
+        else:
+            merge_component(to_merge[1], row_2_2, l)
+            merge_component(to_merge[2], row_2_3, l)
+    row_2_1, row_2_2, row_2_3 = to_merge
+
+    row_3_1 = copy.deepcopy(start_node)
+    row_3_1.resample(rng, True)
+    for l in range(len(rule_groups)):
+        rule_group = rule_groups[l]
+        rule_num_pos = rule_group[0]
+        row_3_2 = rule_num_pos.apply_rule(row_3_1)
+        row_3_3 = rule_num_pos.apply_rule(row_3_2)
+        for i in range(1, len(rule_group)):
+            rule = rule_group[i]
+            row_3_2 = rule.apply_rule(row_3_1, row_3_2)
+        for i in range(1, len(rule_group)):
+            rule = rule_group[i]
+            row_3_3 = rule.apply_rule(row_3_2, row_3_3)
+        if l == 0:
+            to_merge = [row_3_1, row_3_2, row_3_3]
+        else:
+            merge_component(to_merge[1], row_3_2, l)
+            merge_component(to_merge[2], row_3_3, l)
+    row_3_1, row_3_2, row_3_3 = to_merge
+
+    context = [
+        row_1_1,
+        row_1_2,
+        row_1_3,
+        row_2_1,
+        row_2_2,
+        row_2_3,
+        row_3_1,
+        row_3_2,
+    ]
+    modifiable_attributes = sample_available_attributes(rule_groups, row_3_3)
+    answer_AoT = copy.deepcopy(row_3_3)
+    candidates = [answer_AoT]
+
+    num_attributes_to_modify = 3
+    selected_attr = select_modifiable_attributes(
+        num_attributes_to_modify,
+        contains_mesh_component,
+        modifiable_attributes,
+        num_components,
+        rng,
+    )
+    rng.shuffle(selected_attr)
+
+    mode = None
+    # switch attribute 'Number' for convenience
+    pos = [i for i in range(len(selected_attr)) if selected_attr[i][1] == "Number"]
+    if pos:
+        pos = pos[0]
+        selected_attr[pos], selected_attr[-1] = (
+            selected_attr[-1],
+            selected_attr[pos],
+        )
+
+        pos = [
+            i for i in range(len(selected_attr)) if selected_attr[i][1] == "Position"
+        ]
+        if pos:
+            mode = "Position-Number"
+    values = []
+    if len(selected_attr) >= 3:
+        mode_3 = None
+        if mode == "Position-Number":
+            mode_3 = "3-Position-Number"
+        for i in range(num_attributes_to_modify):
+            component_idx, attr_name, _, min_level, max_level, attr_uni = selected_attr[
+                i
             ]
-            if pos:
-                pos = pos[0]
-                selected_attr[pos], selected_attr[-1] = (
-                    selected_attr[-1],
-                    selected_attr[pos],
-                )
-
-                pos = [
-                    i
-                    for i in range(len(selected_attr))
-                    if selected_attr[i][1] == "Position"
-                ]
-                if pos:
-                    mode = "Position-Number"
-            values = []
-            if len(selected_attr) >= 3:
-                mode_3 = None
-                if mode == "Position-Number":
-                    mode_3 = "3-Position-Number"
-                for i in range(num_attributes_to_modify):
-                    component_idx, attr_name, _, min_level, max_level, attr_uni = (
-                        selected_attr[i]
-                    )
-                    value = answer_AoT.sample_new_value(
-                        component_idx, attr_name, min_level, max_level, attr_uni, mode_3
-                    )
-                    values.append(value)
-                    tmp = []
-                    for j in candidates:
-                        new_AoT = copy.deepcopy(j)
-                        new_AoT.apply_new_value(component_idx, attr_name, value)
-                        tmp.append(new_AoT)
-                    candidates += tmp
-
-            elif len(selected_attr) == 2:
-                component_idx, attr_name, min_level, max_level, attr_uni = (
-                    selected_attr[0][0],
-                    selected_attr[0][1],
-                    selected_attr[0][3],
-                    selected_attr[0][4],
-                    selected_attr[0][5],
-                )
-                value = answer_AoT.sample_new_value(
-                    component_idx, attr_name, min_level, max_level, attr_uni, None
-                )
-                values.append(value)
-                new_AoT = copy.deepcopy(answer_AoT)
+            value = answer_AoT.sample_new_value(
+                rng, component_idx, attr_name, min_level, max_level, attr_uni, mode_3
+            )
+            values.append(value)
+            tmp = []
+            for j in candidates:
+                new_AoT = copy.deepcopy(j)
+                new_AoT.apply_new_value(component_idx, attr_name, value)
+                tmp.append(new_AoT)
+            candidates += tmp
+
+    elif len(selected_attr) == 2:
+        component_idx, attr_name, min_level, max_level, attr_uni = (
+            selected_attr[0][0],
+            selected_attr[0][1],
+            selected_attr[0][3],
+            selected_attr[0][4],
+            selected_attr[0][5],
+        )
+        value = answer_AoT.sample_new_value(
+            rng, component_idx, attr_name, min_level, max_level, attr_uni, None
+        )
+        values.append(value)
+        new_AoT = copy.deepcopy(answer_AoT)
+        new_AoT.apply_new_value(component_idx, attr_name, value)
+        candidates.append(new_AoT)
+        component_idx, attr_name, min_level, max_level, attr_uni = (
+            selected_attr[1][0],
+            selected_attr[1][1],
+            selected_attr[1][3],
+            selected_attr[1][4],
+            selected_attr[1][5],
+        )
+        if mode == "Position-Number":
+            ran, qu = 6, 1
+        else:
+            ran, qu = 3, 2
+        for i in range(ran):
+            value = answer_AoT.sample_new_value(
+                rng, component_idx, attr_name, min_level, max_level, attr_uni, None
+            )
+            values.append(value)
+            for j in range(qu):
+                new_AoT = copy.deepcopy(candidates[j])
                 new_AoT.apply_new_value(component_idx, attr_name, value)
                 candidates.append(new_AoT)
-                component_idx, attr_name, min_level, max_level, attr_uni = (
-                    selected_attr[1][0],
-                    selected_attr[1][1],
-                    selected_attr[1][3],
-                    selected_attr[1][4],
-                    selected_attr[1][5],
-                )
-                if mode == "Position-Number":
-                    ran, qu = 6, 1
-                else:
-                    ran, qu = 3, 2
-                for i in range(ran):
-                    value = answer_AoT.sample_new_value(
-                        component_idx, attr_name, min_level, max_level, attr_uni, None
-                    )
-                    values.append(value)
-                    for j in range(qu):
-                        new_AoT = copy.deepcopy(candidates[j])
-                        new_AoT.apply_new_value(component_idx, attr_name, value)
-                        candidates.append(new_AoT)
-
-            elif len(selected_attr) == 1:
-                component_idx, attr_name, min_level, max_level, attr_uni = (
-                    selected_attr[0][0],
-                    selected_attr[0][1],
-                    selected_attr[0][3],
-                    selected_attr[0][4],
-                    selected_attr[0][5],
-                )
-                for i in range(7):
-                    value = answer_AoT.sample_new_value(
-                        component_idx, attr_name, min_level, max_level, attr_uni, None
-                    )
-                    values.append(value)
-                    new_AoT = copy.deepcopy(answer_AoT)
-                    new_AoT.apply_new_value(component_idx, attr_name, value)
-                    candidates.append(new_AoT)
-
-            random.shuffle(candidates)
-            answers = []
-            mods = []
-            for candidate in candidates:
-                answers.append(
-                    render_panel(candidate, should_render_random_mesh_component)
-                )
-                mods.append(candidate.modified_attr)
-
-            # imsave(generate_matrix_answer(imgs + answers), "/media/dsg3/hs/RAVEN_image/experiments2/{}/{}.jpg".format(key, k))
-
-            image = imgs[0:8] + answers
-            target = candidates.index(answer_AoT)
-            predicted = solve(rule_groups, context, candidates)
-            is_mesh_present = start_node.children[0].children[-1].name == "Mesh"
-            max_components = len(start_node.children[0].children)
-            meta_matrix, meta_target = serialize_rules(rule_groups, is_mesh_present)
-            structure, meta_structure = serialize_aot(start_node)
-            modifications_matrix = serialize_modifications(
-                mods, is_mesh_present, max_components
+
+    elif len(selected_attr) == 1:
+        component_idx, attr_name, min_level, max_level, attr_uni = (
+            selected_attr[0][0],
+            selected_attr[0][1],
+            selected_attr[0][3],
+            selected_attr[0][4],
+            selected_attr[0][5],
+        )
+        for i in range(7):
+            value = answer_AoT.sample_new_value(
+                rng, component_idx, attr_name, min_level, max_level, attr_uni, None
             )
-            np.savez(
-                "{}/{}/RAVEN_{}_{}.npz".format(
-                    args.save_dir, configuration, k, set_name
-                ),
-                image=image,
-                target=target,
-                predict=target,
-                meta_matrix=meta_matrix,
-                meta_target=meta_target,
-                structure=structure,
-                meta_structure=meta_structure,
-                meta_answer_mods=modifications_matrix,
+            values.append(value)
+            new_AoT = copy.deepcopy(answer_AoT)
+            new_AoT.apply_new_value(component_idx, attr_name, value)
+            candidates.append(new_AoT)
+
+    return rule_groups, start_node, context, candidates, answer_AoT
+
+
+def generate_sample(args, configuration, root, k, attempt=0):
+    """Generate the k-th sample of a configuration.
+    Arguments:
+        args(argparse.Namespace): generation settings
+        configuration(str): name of the configuration
+        root(Root): the AoT of the configuration
+        k(int): index of the sample
+        attempt(int): number of earlier samples rejected as duplicates, see sample_rng
+    Returns:
+        is_correct(bool): whether the solver selected the correct answer;
+            None if the sample isn't verified, see should_verify
+        arrays(dict): arrays of the sample
+        problem(tuple): the 16 panels and the rule groups of the sample, from which
+            write_problem writes its XML description, see get_xml_writer
+        resamples(int): number of matrices discarded because no new values were left
+            for their answer candidates
+        sample_hash(int): hash of the symbolic state of the sample, computed from its
+            AoT, see dedup.aot_matrix_hash
+    """
+    rng = sample_rng(args.seed, configuration, k, attempt)
+
+    should_render_random_mesh_component = args.mesh == 1
+    set_name = get_set_name(args, k)
+    # the matrix is sampled again if its answer candidates can't be generated
+    resamples = 0
+    while True:
+        try:
+            rule_groups, start_node, context, candidates, answer_AoT = sample_matrix(
+                args, configuration, root, rng, set_name
             )
+            break
+        except NoNewValueError as error:
+            if resamples >= args.max_resamples:
+                raise NoNewValueError(
+                    f"Can't generate answer candidates for sample {k} of {configuration} "
+                    f"after resampling the matrix {resamples} times: {error}"
+                ) from error
+            resamples += 1
+
+    rng.shuffle(candidates)
+    mods = [candidate.modified_attr for candidate in candidates]
+    image = render_matrix(context, candidates, should_render_random_mesh_component, rng)
+
+    # imsave(generate_matrix_answer(list(image)), "/media/dsg3/hs/RAVEN_image/experiments2/{}/{}.jpg".format(key, k))
+
+    target = candidates.index(answer_AoT)
+    is_correct = None
+    if should_verify(args, configuration, k):
+        predicted = solve(rule_groups, context, candidates, rng)
+        is_correct = target == predicted
+    is_mesh_present = start_node.children[0].children[-1].name == "Mesh"
+    max_components = len(start_node.children[0].children)
+    meta_matrix, meta_target = serialize_rules(rule_groups, is_mesh_present)
+    structure, meta_structure = serialize_aot(start_node)
+    modifications_matrix = serialize_modifications(
+        mods, is_mesh_present, max_components
+    )
+    arrays = dict(
+        image=image,
+        target=target,
+        predict=target,
+        meta_matrix=meta_matrix,
+        meta_target=meta_target,
+        structure=structure,
+        meta_structure=meta_structure,
+        meta_answer_mods=modifications_matrix,
+    )
+    problem = (context + candidates, rule_groups)
+    sample_hash = aot_matrix_hash(*problem)
+
+    # show_rpm(image)
+    # print_rule(meta_matrix)
+
+    return is_correct, arrays, problem, resamples, sample_hash
+
+
+def get_xml_writer(problem):
+    """Function which writes the XML description of a sample to a binary file.
+    Arguments:
+        problem(tuple or bytes): the panels and rules of the sample, as returned by
+            generate_sample, or its XML description if it was generated by a worker
+    """
+    if isinstance(problem, bytes):
+        return lambda file: file.write(problem)
+    return lambda file: write_problem(file, *problem)
+
+
+def save_sample(args, configuration, root, k, attempt=0):
+    """Generate the k-th sample of a configuration and save it to args.save_dir
+    as .npz and .xml files.
+    Returns:
+        is_correct(bool): as in generate_sample
+        files(dict): checksums of the written files, keyed by the filename
+        resamples(int): as in generate_sample
+        sample_hash(int): as in generate_sample
+    """
+    is_correct, arrays, problem, resamples, sample_hash = generate_sample(
+        args, configuration, root, k, attempt
+    )
+    directory = os.path.join(args.save_dir, configuration)
+    files = write_npz_sample(
+        directory, k, get_set_name(args, k), arrays, get_xml_writer(problem)
+    )
+    return is_correct, files, resamples, sample_hash
+
+
+def process_sample(args, configuration, root, k, attempt=0):
+    """Samples in the npz format are saved by the process that generated them,
+    while samples written to shards are returned to the main process. Both are
+    hashed by the process that generated them. Workers count rule sampling in
+    their own copies of rule_sampling_stats, hence the counts of the sample are
+    returned along with it."""
+    start = rule_sampling_stats.copy()
+    if args.format == "npz":
+        result = save_sample(args, configuration, root, k, attempt)
+    else:
+        result = generate_sample(args, configuration, root, k, attempt)
+    stats = rule_sampling_stats.copy()
+    stats.subtract(start)
+    return result, stats
+
+
+# Per-process state of the workers used by separate
+_worker_args = None
+_worker_configs = None
+
+
+def init_worker(args, all_configs):
+    global _worker_args, _worker_configs
+    _worker_args = args
+    _worker_configs = all_configs
 
-            with open(
-                "{}/{}/RAVEN_{}_{}.xml".format(
-                    args.save_dir, configuration, k, set_name
-                ),
-                "wb",
-            ) as f:
-                dom = dom_problem(context + candidates, rule_groups)
-                f.write(dom)
 
-            # show_rpm(image)
-            # print_rule(meta_matrix)
+def generate_sample_in_worker(task):
+    configuration, k = task
+    result, stats = process_sample(
+        _worker_args, configuration, _worker_configs[configuration], k
+    )
+    if _worker_args.format == "shards":
+        # samples are sent to the main process as their XML rather than their AoTs,
+        # which are much larger to pickle
+        is_correct, arrays, problem, resamples, sample_hash = result
+        result = is_correct, arrays, dom_problem(*problem), resamples, sample_hash
+    return result, stats
+
 
-            if target == predicted:
-                acc += 1
+def separate(args, all_configs):
+    if args.workers > 1:
+        with multiprocessing.Pool(
+            args.workers, initializer=init_worker, initargs=(args, all_configs)
+        ) as pool:
+            return generate_configurations(args, all_configs, pool)
+    return generate_configurations(args, all_configs)
+
+
+def get_generation_settings(args):
+    """Settings which determine the content of the generated samples."""
+    names = [
+        "seed",
+        "mesh",
+        "val",
+        "test",
+        "format",
+        "rule_sampling",
+        "reject_duplicates",
+    ]
+    for attribute in ["position", "type", "size", "color"]:
+        names += [attribute, f"{attribute}_train_set_rule"]
+    return {name: getattr(args, name) for name in names}
+
+
+# Number of times a sample is generated again when it duplicates an earlier one,
+# before generation fails
+MAX_DUPLICATE_ATTEMPTS = 100
+
+
+def generate_configurations(args, all_configs, pool=None):
+    accs = {}
+    settings = get_generation_settings(args)
+    for configuration in all_configs.keys():
+        manifest = Manifest(
+            os.path.join(args.save_dir, configuration, MANIFEST_FILENAME), settings
+        )
+        manifest.open(args.resume)
+        writer = None
+        if args.format == "shards":
+            writer = ShardWriter(
+                os.path.join(args.save_dir, configuration), args.shard_size
+            )
+            writer.open(args.resume)
+        try:
+            acc = 0
+            verified = 0
+            resampled = 0
+            rejected = 0
+            # counts of rule sampling of the samples generated in this run
+            sampling_stats = Counter()
+            # hashes of the samples of the configuration, see dedup.hash_keys
+            hashes = set()
+            remaining = []
+            for k in range(args.num_samples):
+                if manifest.is_complete(k):
+                    hashes.add(int(manifest.completed[k]["hash"], 16))
+                    if manifest.completed[k]["correct"] is not None:
+                        verified += 1
+                    if manifest.completed[k]["correct"]:
+                        acc += 1
+                    if manifest.completed[k].get("resamples", 0):
+                        resampled += 1
+                    if manifest.completed[k].get("attempt", 0):
+                        rejected += 1
+                else:
+                    remaining.append(k)
+            if pool is None:
+                results = (
+                    process_sample(args, configuration, all_configs[configuration], k)
+                    for k in remaining
+                )
+            else:
+                tasks = [(configuration, k) for k in remaining]
+                chunksize = max(1, min(64, len(remaining) // (args.workers * 4)))
+                results = pool.imap(generate_sample_in_worker, tasks, chunksize)
+            progress = tqdm(
+                zip(remaining, results),
+                total=args.num_samples,
+                initial=args.num_samples - len(remaining),
+                desc=configuration,
+            )
+            for k, (result, stats) in progress:
+                sampling_stats.update(stats)
+                # duplicates are generated again in the main process, which sees
+                # the samples in order, so the result doesn't depend on the workers
+                attempt = 0
+                while args.reject_duplicates and result[-1] in hashes:
+                    attempt += 1
+                    if attempt > MAX_DUPLICATE_ATTEMPTS:
+                        raise ValueError(
+                            f"Can't generate sample {k} of {configuration} different "
+                            f"from the previous samples in {MAX_DUPLICATE_ATTEMPTS} attempts"
+                        )
+                    result, stats = process_sample(
+                        args, configuration, all_configs[configuration], k, attempt
+                    )
+                    sampling_stats.update(stats)
+                if writer is None:
+                    is_correct, files, resamples, sample_hash = result
+                else:
+                    is_correct, arrays, problem, resamples, sample_hash = result
+                    files = writer.write(
+                        k, get_set_name(args, k), arrays, get_xml_writer(problem)
+                    )
+                hashes.add(sample_hash)
+                manifest.record(k, is_correct, files, resamples, sample_hash, attempt)
+                if is_correct is not None:
+                    verified += 1
+                if is_correct:
+                    acc += 1
+                if resamples:
+                    resampled += 1
+                if attempt:
+                    rejected += 1
+        finally:
+            if writer is not None:
+                writer.close()
+            manifest.close()
         # TODO: heuristics search is not implemented for the Mesh component
-        print(f"Accuracy of {configuration}: {float(acc) / args.num_samples}")
-        accs[configuration] = float(acc) / args.num_samples
+        if verified:
+            accs[configuration] = float(acc) / verified
+            print(
+                f"Accuracy of {configuration}: {accs[configuration]}"
+                + ("" if verified == args.num_samples else f" ({verified} verified)")
+            )
+        else:
+            accs[configuration] = None
+            print(f"Accuracy of {configuration}: not verified")
+        if remaining:
+            print(
+                f"Rule groups of {configuration} rejected by pruning: "
+                f"{sampling_stats['rejections']}"
+                + (
+                    f" ({sampling_stats['expected_rejections']:.1f} expected with "
+                    "rejection sampling)"
+                    if sampling_stats["samples"]
+                    else ""
+                )
+                + f" in {len(remaining)} generated samples"
+            )
+        if resampled:
+            print(
+                f"Resampled matrices of {configuration} whose answer candidates "
+                f"ran out of values: {resampled} out of {args.num_samples} samples"
+            )
+        if rejected:
+            print(
+                f"Generated again samples of {configuration} that duplicated earlier "
+                f"ones: {rejected} out of {args.num_samples} samples"
+            )
     return accs
 
 
@@ -375,6 +687,7 @@ def select_modifiable_attributes(
     contains_mesh_component: bool,
     modifiable_attributes: List,
     num_components: int,
+    rng: np.random.Generator,
 ) -> List:
     if num_attributes_to_modify < len(modifiable_attributes):
         if contains_mesh_component:
@@ -387,10 +700,10 @@ def select_modifiable_attributes(
                 for modifiable_attribute in modifiable_attributes
                 if modifiable_attribute[0] == mesh_component_idx
             ]
-            num_selected_mesh_attributes = np.random.randint(
+            num_selected_mesh_attributes = rng.integers(
                 1, len(modifiable_mesh_attributes) + 1
             )
-            selected_mesh_attribute_indices = np.random.choice(
+            selected_mesh_attribute_indices = rng.choice(
                 len(modifiable_mesh_attributes),
                 num_selected_mesh_attributes,
                 replace=False,
@@ -408,7 +721,7 @@ def select_modifiable_attributes(
             num_selected_non_mesh_attributes = (
                 num_attributes_to_modify - num_selected_mesh_attributes
             )
-            selected_non_mesh_attribute_indices = np.random.choice(
+            selected_non_mesh_attribute_indices = rng.choice(
                 len(modifiable_non_mesh_attributes),
                 num_selected_non_mesh_attributes,
                 replace=False,
@@ -419,7 +732,7 @@ def select_modifiable_attributes(
             ]
             return selected_attributes
         else:
-            idx = np.random.choice(
+            idx = rng.choice(
                 len(modifiable_attributes), num_attributes_to_modify, replace=False
             )
             return [modifiable_attributes[i] for i in idx]
@@ -467,6 +780,59 @@ def make_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         "--mesh", type=int, default=0, help="0 - no mesh, 1 - random, 2 - rules"
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes used to generate samples",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip samples recorded as complete in the manifest of a previous run",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default="npz",
+        choices=FORMATS,
+        help="npz - an .npz and an .xml file per sample, "
+        "shards - samples appended to large shard files with an index",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=DEFAULT_SHARD_SIZE,
+        help="number of samples in a shard file",
+    )
+    parser.add_argument(
+        "--rule-sampling",
+        type=str,
+        default="table",
+        choices=RULE_SAMPLING,
+        help="table - sample rules from precomputed tables of rules satisfying the constraints, "
+        "rejection - sample rules independently until they satisfy the constraints",
+    )
+    parser.add_argument(
+        "--max-resamples",
+        type=int,
+        default=0,
+        help="number of times a matrix is sampled again when no new values are left "
+        "for its answer candidates, before generation fails",
+    )
+    parser.add_argument(
+        "--reject-duplicates",
+        action="store_true",
+        help="generate a sample again when its symbolic state is the same as the one "
+        "of an earlier sample of the configuration, in any split",
+    )
+    parser.add_argument(
+        "--verify",
+        type=parse_verify,
+        default="all",
+        help="samples whose answer is checked by the solver to report the accuracy: "
+        "all, none, or sample:P for a random fraction P of them",
+    )
     parser.add_argument(
         "--configurations",
         type=str,
@@ -477,24 +843,9 @@ def make_parser() -> argparse.ArgumentParser:
 
 def main(args):
     all_configs = {
-        "center_single": build_center_single(args.mesh == 2),
-        "distribute_four": build_distribute_four(args.mesh == 2),
-        "distribute_nine": build_distribute_nine(args.mesh == 2),
-        "left_center_single_right_center_single": build_left_center_single_right_center_single(
-            args.mesh == 2
-        ),
-        "up_center_single_down_center_single": build_up_center_single_down_center_single(
-            args.mesh == 2
-        ),
-        "in_center_single_out_center_single": build_in_center_single_out_center_single(
-            args.mesh == 2
-        ),
-        "in_distribute_four_out_center_single": build_in_distribute_four_out_center_single(
-            args.mesh == 2
-        ),
-    }
-    all_configs = {
-        k: v for k, v in all_configs.items() if k in args.configurations.split(",")
+        configuration: build(args.mesh == 2)
+        for configuration, build in CONFIGURATIONS.items()
+        if configuration in args.configurations.split(",")
     }
 
     if args.seed == -1:
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+
+import hashlib
+import json
+import os
+
+# Version of the sample generator. It should be increased whenever a change
+# alters the samples generated for a given seed, such that a dataset is never
+# resumed with samples coming from a different generator. Changes of the XML
+# description of samples also increase serialize.XML_FORMAT_VERSION.
+GENERATOR_VERSION = 9
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+
+class Manifest(object):
+    """Record of the samples of a configuration that were completely written.
+    The manifest is an append-only JSON Lines file. The first line stores the
+    generation settings and each following line describes a completed sample:
+    its index, whether the solver found the answer, checksums of its files and
+    the hash of its symbolic state.
+    A line is appended only after all files of the sample have been written,
+    hence an interrupted run can be resumed from the samples that are missing.
+    """
+
+    def __init__(self, path, settings):
+        """
+        Arguments:
+            path(str): path of the manifest file
+            settings(dict): generation settings that determine the content of samples
+        """
+        self.path = path
+        self.settings = dict(settings, generator_version=GENERATOR_VERSION)
+        self.completed = {}
+        self.file = None
+
+    def open(self, resume=False):
+        """Open the manifest for recording new samples.
+        Arguments:
+            resume(bool): whether to keep the samples recorded by a previous run;
+                otherwise, the manifest is started from scratch
+        """
+        if resume and os.path.exists(self.path) and self._load():
+            self.file = open(self.path, "a")
+        else:
+            self.completed = {}
+            self.file = open(self.path, "w")
+            self._write({"settings": self.settings})
+
+    def _load(self):
+        """Load the samples recorded by a previous run.
+        Returns:
+            is_loaded(bool): False if the manifest has no complete header, which happens
+                when the previous run was interrupted right after creating it
+        """
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        try:
+            settings = json.loads(lines[0])["settings"]
+        except (IndexError, json.JSONDecodeError, KeyError, TypeError):
+            return False
+        if settings != self.settings:
+            raise ValueError(
+                f"Can't resume {self.path}: the dataset was generated with "
+                f"settings {settings}, but current settings are {self.settings}"
+            )
+        self.completed = {}
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be truncated if the previous run was interrupted
+                continue
+            self.completed[record["k"]] = record
+        return True
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+
+    def is_complete(self, k):
+        """Check whether the k-th sample was recorded and its files are in place with
+        the recorded content, such that a file that was corrupted or partially
+        overwritten after being recorded is generated again.
+        """
+        if k not in self.completed:
+            return False
+        directory = os.path.dirname(self.path)
+        for filename, checksum in self.completed[k]["files"].items():
+            path = os.path.join(directory, filename)
+            if not os.path.exists(path):
+                return False
+            size = os.path.getsize(path)
+            # the sample may be a part of a shard file
+            offset = checksum.get("offset")
+            if offset is None:
+                if size != checksum["size"]:
+                    return False
+                offset = 0
+            elif size < offset + checksum["size"]:
+                return False
+            with open(path, "rb") as f:
+                f.seek(offset)
+                data = f.read(checksum["size"])
+            if hashlib.sha256(data).hexdigest() != checksum["sha256"]:
+                return False
+        return True
+
+    def record(self, k, is_correct, files, resamples=0, sample_hash=None, attempt=0):
+        """Record a completed sample.
+        Arguments:
+            k(int): index of the sample
+            is_correct(bool): whether the solver selected the correct answer;
+                None if the sample wasn't verified
+            files(dict): checksums of the sample files, keyed by the filename;
+                data stored in a shard file also has its offset within the file
+            resamples(int): number of matrices discarded while generating the sample
+            sample_hash(int): 64-bit hash of the symbolic state of the sample
+            attempt(int): number of samples rejected as duplicates before this one
+        """
+        if is_correct is not None:
+            is_correct = bool(is_correct)
+        record = {"k": k, "correct": is_correct, "files": files}
+        if resamples:
+            record["resamples"] = resamples
+        if sample_hash is not None:
+            record["hash"] = format(sample_hash, "016x")
+        if attempt:
+            record["attempt"] = attempt
+        self.completed[k] = record
+        self._write(record)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -1,14 +1,24 @@
 # -*- coding: utf-8 -*-
 
 
+import functools
+
 import cv2
-import random
 import numpy as np
 from PIL import Image
 
 from AoT import Root
 from const import CENTER, DEFAULT_WIDTH, IMAGE_SIZE
 
+# Max number of rendered entities kept in memory by render_entity_roi.
+# Entities are cached cropped to their bounding box, which takes ~1-10 KB.
+ENTITY_CACHE_SIZE = 8192
+
+# Max difference of a pixel between rotate_entity and rotate for angles which are
+# not multiples of 90 degrees. Measured over all entities of all configurations,
+# pixels differ by at most 14 and less than 0.1% of pixels of entities differ.
+ROTATION_TOLERANCE = 16
+
 
 def imshow(array):
     image = Image.fromarray(array)
@@ -81,24 +91,122 @@ def merge_matrix_answer(matrix, answer):
     return img_grid
 
 
-def render_panel(root, add_random_mesh=False):
+def render_panel(root, add_random_mesh=False, rng=None):
     # Decompose the panel into a structure and its entities
+    # rng is only used for drawing the random mesh
+    # All layers are composited into a single buffer, where each nonzero pixel
+    # of a layer overwrites the pixels of lower layers
     assert isinstance(root, Root)
-    canvas = np.ones((IMAGE_SIZE, IMAGE_SIZE), np.uint8) * 255
     structure, entities = root.prepare()
-    structure_img = render_structure(structure)
-    background = np.zeros((IMAGE_SIZE, IMAGE_SIZE), np.uint8)
-    # note left components entities are in the lower layer
     if add_random_mesh:
-        background = layer_add(background, render_web())
-    for entity in entities:
-        entity_img = render_entity(entity)
-        background = layer_add(background, entity_img)
-    background = layer_add(background, structure_img)
-    return canvas - background
+        background = render_web(rng)
+    else:
+        background = np.zeros((IMAGE_SIZE, IMAGE_SIZE), np.uint8)
+    draw_entities(background, entities)
+    draw_structure(background, structure)
+    return np.subtract(255, background, out=background)
+
+
+def render_matrix(context, candidates, add_random_mesh=False, rng=None):
+    """Render all panels of a matrix into a single array, same as render_panel
+    called for each panel. Panels share the structure, which is drawn once for all of
+    them, and panels with the same entities are rendered only once, which is common
+    since candidates differ from the answer in a few attributes. The image of each
+    component is also rendered once and reused by all panels where the component
+    has the same entities, so a candidate which modifies a single component
+    renders only that component.
+    Arguments:
+        context(list of Root): the 8 context panels
+        candidates(list of Root): the 8 answer candidates
+        add_random_mesh(bool): whether to draw a random mesh in every panel
+        rng(np.random.Generator): random number generator used for drawing the mesh
+    Returns:
+        images(np.ndarray): uint8 array of shape (16, IMAGE_SIZE, IMAGE_SIZE)
+    """
+    panels = list(context) + list(candidates)
+    images = np.zeros((len(panels), IMAGE_SIZE, IMAGE_SIZE), np.uint8)
+    structures = set()
+    rendered = {}
+    # components seen in earlier panels, and merged images of those seen again
+    seen_components = set()
+    rendered_components = {}
+    for i, panel in enumerate(panels):
+        assert isinstance(panel, Root)
+        structure, components = panel.prepare_components()
+        structures.add(structure)
+        keys = tuple(
+            tuple(get_entity_values(entity) for entity in entities)
+            for entities in components
+        )
+        if add_random_mesh:
+            # every panel has a different mesh
+            images[i] = render_web(rng)
+        elif keys in rendered:
+            images[i] = images[rendered[keys]]
+            continue
+        else:
+            rendered[keys] = i
+        layers = []
+        for key in keys:
+            if key in rendered_components:
+                layers.append(rendered_components[key])
+                continue
+            entity_layers = [_render_entity_roi(*values) for values in key]
+            if key in seen_components:
+                # the component repeats, so its entities are merged into a single
+                # layer which is drawn by later panels at once
+                rendered_components[key] = merge_layers(entity_layers)
+                layers.append(rendered_components[key])
+            else:
+                # most components appear in a single panel, where merging would only
+                # add a copy of their entities, so they are merged once seen again
+                seen_components.add(key)
+                layers += entity_layers
+        draw_layers(images[i], layers)
+    assert len(structures) == 1
+    draw_structure(images, structures.pop())
+    return np.subtract(255, images, out=images)
+
+
+def merge_layers(layers):
+    """Composite layers into a single layer cropped to their bounding box.
+    Drawing the merged layer gives the same image as drawing the layers one by one,
+    since pixels of later layers overwrite earlier ones either way.
+    Returns:
+        layer(np.ndarray): image of the layers
+        offset(tuple): row and column of the top left corner of the bounding box
+    """
+    layers = [(layer, offset) for layer, offset in layers if layer.size > 0]
+    if len(layers) == 1:
+        return layers[0]
+    if not layers:
+        return np.zeros((0, 0), np.uint8), (0, 0)
+    y0 = min(y for _, (y, _) in layers)
+    x0 = min(x for _, (_, x) in layers)
+    y1 = max(y + layer.shape[0] for layer, (y, _) in layers)
+    x1 = max(x + layer.shape[1] for layer, (_, x) in layers)
+    img = np.zeros((y1 - y0, x1 - x0), np.uint8)
+    draw_layers(img, [(layer, (y - y0, x - x0)) for layer, (y, x) in layers])
+    return img, (y0, x0)
+
+
+def draw_entities(img, entities):
+    # note left components entities are in the lower layer
+    draw_layers(img, [render_entity_roi(entity) for entity in entities])
+
 
+def draw_layers(img, layers):
+    # Each nonzero pixel of a layer overwrites the pixels of previous layers
+    for layer, (y, x) in layers:
+        if layer.size == 0:
+            continue
+        region = img[y : y + layer.shape[0], x : x + layer.shape[1]]
+        # same as np.copyto(region, layer, where=layer > 0), but the layer itself
+        # serves as the mask; region is a view of img, which is written in place
+        cv2.copyTo(layer, layer, region)
 
-def render_web():
+
+def render_web(rng):
     nodes = [
         [(0.16, 0.16), (0.16, 0.5), (0.16, 0.83)],
         [(0.5, 0.16), (0.5, 0.5), (0.5, 0.83)],
@@ -108,11 +216,11 @@ def render_web():
     for i in range(3):
         for j in range(3):
             sp = get_web_node(nodes, i, j)
-            if i + 1 < 3 and random.uniform(0, 1) < 0.5:
+            if i + 1 < 3 and rng.uniform(0, 1) < 0.5:
                 ep = get_web_node(nodes, i + 1, j)
                 cv2.line(img, sp, ep, 255, 3)
 
-            if j + 1 < 3 and random.uniform(0, 1) < 0.5:
+            if j + 1 < 3 and rng.uniform(0, 1) < 0.5:
                 ep = get_web_node(nodes, i, j + 1)
                 cv2.line(img, sp, ep, 255, 3)
     return img
@@ -122,6 +230,16 @@ def get_web_node(nodes, i, j):
     return (int(nodes[i][j][0] * IMAGE_SIZE), int(nodes[i][j][1] * IMAGE_SIZE))
 
 
+def draw_structure(img, structure_name):
+    """Draw the lines of the structure on top of img, same as layer_add with render_structure.
+    img may also be a stack of panels, which are drawn at once.
+    """
+    if structure_name == "Left_Right":
+        img[..., :, int(0.5 * IMAGE_SIZE)] = 255
+    elif structure_name == "Up_Down":
+        img[..., int(0.5 * IMAGE_SIZE), :] = 255
+
+
 def render_structure(structure_name):
     ret = None
     if structure_name == "Left_Right":
@@ -136,11 +254,46 @@ def render_structure(structure_name):
 
 
 def render_entity(entity):
-    entity_bbox = entity.bbox
-    entity_type = entity.type.get_value()
-    entity_size = entity.size.get_value()
-    entity_color = entity.color.get_value()
-    entity_angle = entity.angle.get_value()
+    """Render an entity on an empty canvas."""
+    img = np.zeros((IMAGE_SIZE, IMAGE_SIZE), np.uint8)
+    layer, (y, x) = render_entity_roi(entity)
+    img[y : y + layer.shape[0], x : x + layer.shape[1]] = layer
+    return img
+
+
+def render_entity_roi(entity):
+    """Render an entity within its bounding box on the canvas.
+    The image of an entity depends only on its bbox and attribute values, which take
+    a small number of distinct values, so rendered images are cached and returned
+    as read-only arrays shared between calls.
+    Returns:
+        layer(np.ndarray): image of the entity cropped to its bounding box
+        offset(tuple): row and column of the top left corner of the bounding box
+    """
+    return _render_entity_roi(*get_entity_values(entity))
+
+
+def get_entity_values(entity):
+    """Values which determine the image of an entity."""
+    return (
+        tuple(entity.bbox),
+        entity.type.get_value(),
+        entity.size.get_value(),
+        entity.color.get_value(),
+        entity.angle.get_value(),
+    )
+
+
+@functools.lru_cache(maxsize=ENTITY_CACHE_SIZE)
+def _render_entity_roi(*entity_values):
+    img = draw_entity(*entity_values)
+    x, y, w, h = cv2.boundingRect(img)
+    layer = img[y : y + h, x : x + w].copy()
+    layer.flags.writeable = False
+    return layer, (y, x)
+
+
+def draw_entity(entity_bbox, entity_type, entity_size, entity_color, entity_angle):
     img = np.zeros((IMAGE_SIZE, IMAGE_SIZE), np.uint8)
 
     if entity_type == "line":
@@ -244,10 +397,10 @@ def render_entity(entity):
         # [x, y, w, h, x_c, y_c, omega]
         entity_angle = entity_bbox[6]
         center = (int(entity_bbox[5] * IMAGE_SIZE), int(entity_bbox[4] * IMAGE_SIZE))
-        img = rotate(img, entity_angle, center=center)
+        img = rotate_entity(img, entity_angle, center=center)
     # planar
     else:
-        img = rotate(img, entity_angle, center=center)
+        img = rotate_entity(img, entity_angle, center=center)
     # img = shift(img, *entity_position)
 
     return img
@@ -265,6 +418,57 @@ def rotate(img, angle, center=CENTER):
     return img
 
 
+def rotate_entity(img, angle, center):
+    """Equivalent of rotate for an image of a single entity, which only rotates
+    a square window around the center that contains the entity.
+    Rotations by multiples of 90 degrees about a pixel permute pixels, so they are
+    computed exactly with np.rot90 and the result is identical to rotate.
+    Other angles are computed with cv2.warpAffine on the window, whose fixed-point
+    coordinates are rounded differently than on the whole image, hence pixels may
+    differ from rotate by up to ROTATION_TOLERANCE.
+    """
+    if angle % 360 == 0:
+        return img
+    x, y, w, h = cv2.boundingRect(img)
+    if w == 0 or not all(isinstance(c, (int, np.integer)) for c in center):
+        return rotate(img, angle, center=center)
+    cx, cy = center
+    # distance from the center to the furthest corner of the entity
+    radius = np.hypot(max(cx - x, x + w - 1 - cx), max(cy - y, y + h - 1 - cy))
+    if angle % 90 == 0:
+        r = int(np.ceil(radius))
+        window = get_window(img, cx, cy, r)
+        window = np.rot90(window, angle // 90)
+    else:
+        # bilinear interpolation spreads the entity by up to a pixel
+        r = int(np.ceil(radius)) + 2
+        window = get_window(img, cx, cy, r)
+        M = cv2.getRotationMatrix2D((r, r), angle, 1)
+        window = cv2.warpAffine(
+            window, M, (2 * r + 1, 2 * r + 1), flags=cv2.INTER_LINEAR
+        )
+    ret = np.zeros((IMAGE_SIZE, IMAGE_SIZE), np.uint8)
+    set_window(ret, cx, cy, r, window)
+    return ret
+
+
+def get_window(img, cx, cy, r):
+    """Square window of img with the center (cx, cy) and size 2 * r + 1,
+    where pixels outside img are 0."""
+    window = np.zeros((2 * r + 1, 2 * r + 1), img.dtype)
+    y0, y1 = max(cy - r, 0), min(cy + r + 1, img.shape[0])
+    x0, x1 = max(cx - r, 0), min(cx + r + 1, img.shape[1])
+    window[y0 - cy + r : y1 - cy + r, x0 - cx + r : x1 - cx + r] = img[y0:y1, x0:x1]
+    return window
+
+
+def set_window(img, cx, cy, r, window):
+    """Inverse of get_window: copy the part of window that lies within img."""
+    y0, y1 = max(cy - r, 0), min(cy + r + 1, img.shape[0])
+    x0, x1 = max(cx - r, 0), min(cx + r + 1, img.shape[1])
+    img[y0:y1, x0:x1] = window[y0 - cy + r : y1 - cy + r, x0 - cx + r : x1 - cx + r]
+
+
 def scale(img, tx, ty, center=CENTER):
     M = np.array(
         [[tx, 0, center[0] * (1 - tx)], [0, ty, center[1] * (1 - ty)]], np.float32
@@ -1,15 +1,29 @@
 # -*- coding: utf-8 -*-
+import functools
+import itertools
+from collections import Counter
 from typing import List
 
 
 import numpy as np
 from scipy.special import comb
 
+from build_tree import CONFIGURATIONS
 from const import RULE_ATTR
 from Rule import Rule_Wrapper
 
+RULE_SAMPLING = ["table", "rejection"]
+
+# Counters of sampled rule groups in this process:
+# samples - rule groups drawn by sample_feasible_rules
+# expected_rejections - rule groups that sample_rules would be expected to draw
+#   and root.prune to reject before each of the sampled ones
+# rejections - rule groups rejected by root.prune during generation
+rule_sampling_stats = Counter()
+
 
 def sample_rules(
+    rng: np.random.Generator,
     num_components: int,
     contains_mesh_component: bool,
     configuration: str,
@@ -19,60 +33,22 @@ def sample_rules(
 ):
     """First sample # components; for each component, sample a rule on each attribute."""
     assert len(ood_attribute_indices) == len(train_set_rules)
-    is_out_of_distribution_dataset = len(ood_attribute_indices) > 0
 
     all_rules = []
     for component_idx in range(num_components):
         all_rules_component = []
         for j in range(len(RULE_ATTR)):
-
-            if is_out_of_distribution_dataset:
-
-                if j in ood_attribute_indices:
-                    train_set_rule = train_set_rules[ood_attribute_indices.index(j)]
-                    if do_enforce_train_set_rule(
-                        set_name, configuration, component_idx, j, train_set_rule
-                    ):
-                        # RULE_ATTR[1:] (Type, Size, Color) will always have a single entry matching the train set rule.
-                        # However, RULE_ATTR[0] (Number / Position) may have up to two entries matching the train set rule.
-                        idx = np.random.choice(
-                            [
-                                i
-                                for i, rule_attr in enumerate(RULE_ATTR[j])
-                                if rule_attr[0] == train_set_rule
-                            ]
-                        )
-                    else:
-                        # Enforce rule to be other than the train set rule. In attributeless datasets, the training and
-                        # validation matrices will have the missing attribute governed by the train set rule in each row,
-                        # while the testing matrices, whenever applicable, will have a rule other than the train set rule,
-                        # which governs the attribute.
-                        idx = np.random.choice(
-                            [
-                                i
-                                for i, rule in enumerate(RULE_ATTR[j])
-                                if rule[0] != train_set_rule
-                            ]
-                        )
-
-                else:
-                    # Select a random rule that will govern the attribute
-                    idx = np.random.choice(len(RULE_ATTR[j]))
-
-            else:
-
-                if (
-                    contains_mesh_component
-                    and j > 0
-                    and component_idx == num_components - 1
-                ):
-                    # For the mesh component, Type, Size, and Color (j > 0) are always Constant (the last rule for each attribute)
-                    idx = len(RULE_ATTR[j]) - 1
-
-                else:
-                    # Select a random rule that will govern the attribute
-                    idx = np.random.choice(len(RULE_ATTR[j]))
-
+            rule_indices = get_rule_indices(
+                j,
+                component_idx,
+                num_components,
+                contains_mesh_component,
+                configuration,
+                ood_attribute_indices,
+                set_name,
+                train_set_rules,
+            )
+            idx = rng.choice(rule_indices)
             name_attr_param = RULE_ATTR[j][idx]
             all_rules_component.append(
                 Rule_Wrapper(
@@ -80,12 +56,186 @@ def sample_rules(
                     name_attr_param[1],
                     name_attr_param[2],
                     component_idx=component_idx,
+                    rng=rng,
                 )
             )
         all_rules.append(all_rules_component)
     return all_rules
 
 
+def get_rule_indices(
+    j: int,
+    component_idx: int,
+    num_components: int,
+    contains_mesh_component: bool,
+    configuration: str,
+    ood_attribute_indices: List[int] = [],
+    set_name: str = "train",
+    train_set_rules: List[str] = [],
+) -> List[int]:
+    """Indices of the rules in RULE_ATTR[j] which may govern the j-th attribute of a component.
+    sample_rules selects one of them uniformly at random.
+    """
+    is_out_of_distribution_dataset = len(ood_attribute_indices) > 0
+    if is_out_of_distribution_dataset:
+
+        if j in ood_attribute_indices:
+            train_set_rule = train_set_rules[ood_attribute_indices.index(j)]
+            if do_enforce_train_set_rule(
+                set_name, configuration, component_idx, j, train_set_rule
+            ):
+                # RULE_ATTR[1:] (Type, Size, Color) will always have a single entry matching the train set rule.
+                # However, RULE_ATTR[0] (Number / Position) may have up to two entries matching the train set rule.
+                return [
+                    i
+                    for i, rule_attr in enumerate(RULE_ATTR[j])
+                    if rule_attr[0] == train_set_rule
+                ]
+            else:
+                # Enforce rule to be other than the train set rule. In attributeless datasets, the training and
+                # validation matrices will have the missing attribute governed by the train set rule in each row,
+                # while the testing matrices, whenever applicable, will have a rule other than the train set rule,
+                # which governs the attribute.
+                return [
+                    i
+                    for i, rule in enumerate(RULE_ATTR[j])
+                    if rule[0] != train_set_rule
+                ]
+
+        else:
+            # Select a random rule that will govern the attribute
+            return list(range(len(RULE_ATTR[j])))
+
+    else:
+
+        if contains_mesh_component and j > 0 and component_idx == num_components - 1:
+            # For the mesh component, Type, Size, and Color (j > 0) are always Constant (the last rule for each attribute)
+            return [len(RULE_ATTR[j]) - 1]
+
+        else:
+            # Select a random rule that will govern the attribute
+            return list(range(len(RULE_ATTR[j])))
+
+
+@functools.lru_cache(maxsize=None)
+def get_rule_tables(
+    configuration: str,
+    contains_mesh_component: bool,
+    ood_attribute_indices: tuple = (),
+    set_name: str = "train",
+    train_set_rules: tuple = (),
+):
+    """Tables of the rule groups which satisfy the constraints of each component of a
+    configuration tree, i.e. for which root.prune doesn't reject the tree.
+    Rules of different components are sampled independently and each configuration
+    tree has a single structure, so rejecting the rule groups sampled by sample_rules
+    is equivalent to sampling a group of each component from its feasible groups
+    with probabilities proportional to the ones assigned by sample_rules.
+    Tables are cached by the arguments, hence the tree is built here from the name of
+    the configuration rather than passed, such that it isn't kept by the cache.
+    Arguments:
+        configuration(str): name of the configuration, a key of CONFIGURATIONS
+        contains_mesh_component(bool): whether the tree has the Mesh component
+        others: as in sample_rules
+    Returns:
+        tables(list of tuple): for each component, its feasible rule groups as lists of
+            (name, attr, params, value), probabilities of the groups and the probability
+            that sample_rules draws a feasible group of the component
+    """
+    root = CONFIGURATIONS[configuration](contains_mesh_component)
+    assert len(root.children) == 1
+    structure = root.children[0]
+    num_components = len(structure.children)
+    tables = []
+    for component_idx, component in enumerate(structure.children):
+        attribute_rules = []
+        for j in range(len(RULE_ATTR)):
+            rule_indices = get_rule_indices(
+                j,
+                component_idx,
+                num_components,
+                contains_mesh_component,
+                configuration,
+                list(ood_attribute_indices),
+                set_name,
+                list(train_set_rules),
+            )
+            rules = []
+            for idx in rule_indices:
+                name, attr, params = RULE_ATTR[j][idx]
+                values = [None] if params is None else params
+                for value in values:
+                    probability = 1.0 / len(rule_indices) / len(values)
+                    rules.append(((name, attr, params, value), probability))
+            attribute_rules.append(rules)
+        rule_groups = []
+        probabilities = []
+        for rules in itertools.product(*attribute_rules):
+            rule_group = [
+                Rule_Wrapper(name, attr, params, component_idx, None, value)
+                for (name, attr, params, value), _ in rules
+            ]
+            if any(
+                layout.get_pruned_constraints(rule_group) is not None
+                for layout in component.children
+            ):
+                rule_groups.append([rule for rule, _ in rules])
+                probabilities.append(np.prod([probability for _, probability in rules]))
+        if len(rule_groups) == 0:
+            raise ValueError(
+                f"No rules satisfy the constraints of component {component_idx} "
+                f"of {configuration} in the {set_name} set"
+            )
+        probabilities = np.array(probabilities)
+        feasible_probability = probabilities.sum()
+        tables.append(
+            (rule_groups, probabilities / feasible_probability, feasible_probability)
+        )
+    return tables
+
+
+def sample_feasible_rules(
+    rng: np.random.Generator,
+    configuration: str,
+    contains_mesh_component: bool,
+    ood_attribute_indices: List[int] = [],
+    set_name: str = "train",
+    train_set_rules: List[str] = [],
+):
+    """Sample a rule on each attribute of each component, like sample_rules, but only among
+    the rule groups which satisfy the constraints of the configuration tree. The rules follow
+    the distribution of sample_rules conditioned on root.prune accepting them, without
+    drawing rule groups which would be rejected.
+    Arguments:
+        configuration(str): name of the configuration, see get_rule_tables
+        others: as in sample_rules
+    """
+    assert len(ood_attribute_indices) == len(train_set_rules)
+    tables = get_rule_tables(
+        configuration,
+        contains_mesh_component,
+        tuple(ood_attribute_indices),
+        set_name,
+        tuple(train_set_rules),
+    )
+    all_rules = []
+    acceptance_probability = 1.0
+    for component_idx, (rule_groups, probabilities, feasible_probability) in enumerate(
+        tables
+    ):
+        rule_group = rule_groups[rng.choice(len(rule_groups), p=probabilities)]
+        all_rules.append(
+            [
+                Rule_Wrapper(name, attr, params, component_idx, rng, value)
+                for name, attr, params, value in rule_group
+            ]
+        )
+        acceptance_probability *= feasible_probability
+    rule_sampling_stats["samples"] += 1
+    rule_sampling_stats["expected_rejections"] += 1 / acceptance_probability - 1
+    return all_rules
+
+
 def do_enforce_train_set_rule(
     set_name: str,
     configuration: str,
@@ -254,14 +404,15 @@ def sample_available_attributes(rule_groups, row_3_3):
     return ret
 
 
-def sample_attribute(attributes):
+def sample_attribute(attributes, rng):
     """Given the attr_avail list, sample one attribute to modify the value.
     If the available times becomes zero, delete it.
     Arguments:
         attributes(list of list): a flat component of available attributes
             to change the values; consisting of different component indexes
+        rng(np.random.Generator): source of randomness
     """
-    attribute_idx = np.random.choice(len(attributes))
+    attribute_idx = rng.choice(len(attributes))
     component_idx, attribute_name, _, min_level, max_level, _ = attributes[
         attribute_idx
     ]
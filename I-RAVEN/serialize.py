@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
 
 
+import io
 import json
-import xml.etree.ElementTree as ET
 
 import numpy as np
 
 from const import META_STRUCTURE_FORMAT
-from api import get_real_bbox, get_mask, rle_encode
+from api import get_mask_rle, get_real_bbox
+
+# Version of the XML description of samples, stored in the version attribute of the
+# Data element. It should be increased whenever the elements or their attributes change.
+# 1 - the format of RAVEN, without the version attribute
+# 2 - Rule elements also store the sampled values of rules, see get_rule_attributes
+XML_FORMAT_VERSION = 2
 
 
 def n_tree_serialize(aot):
@@ -110,73 +116,167 @@ def serialize_modifications(modifications, is_mesh_present=False, max_comp=2):
     return meta_matrix
 
 
-def dom_problem(instances, rule_groups):
-    data = ET.Element("Data")
-    panels = ET.SubElement(data, "Panels")
-    for i in range(len(instances)):
-        panel = instances[i]
-        panel_i = ET.SubElement(panels, "Panel")
+def escape_attribute(value):
+    """Escape an attribute value the same way as ElementTree."""
+    value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    value = value.replace('"', "&quot;").replace("\r", "&#13;")
+    return value.replace("\n", "&#10;").replace("\t", "&#09;")
+
+
+def write_tag(file, tag, attributes=(), empty=False):
+    """Write the start tag of an element, or the whole element if it is empty.
+    Arguments:
+        file(binary file): destination of the XML
+        tag(str): name of the element
+        attributes(list of tuple): names and values of the attributes, in order
+        empty(bool): whether the element has no children
+    """
+    text = "<" + tag
+    for name, value in attributes:
+        text += ' {}="{}"'.format(name, escape_attribute(value))
+    text += " />" if empty else ">"
+    file.write(text.encode("ascii", "xmlcharrefreplace"))
+
+
+def write_end_tag(file, tag):
+    file.write("</{}>".format(tag).encode("ascii"))
+
+
+def get_rule_values(rule):
+    """Sampled values of a rule that the solver relies on: the value of Progression and
+    Arithmetic, and the value levels of the rows of Distribute_Three.
+    Returns:
+        value(int): value of the rule
+        value_levels(list): value levels of each row as nested lists; None if the rule
+            has none
+    """
+    value_levels = None
+    if rule.name == "Distribute_Three":
+        value_levels = np.asarray(rule.value_levels).tolist()
+    return int(rule.value), value_levels
+
+
+def get_rule_attributes(rule):
+    """Attributes of the Rule element of a rule, see get_rule_values."""
+    value, value_levels = get_rule_values(rule)
+    attributes = [("name", rule.name), ("attr", rule.attr), ("value", str(value))]
+    if value_levels is not None:
+        attributes.append(("value_levels", json.dumps(value_levels)))
+    return attributes
+
+
+def write_problem(file, instances, rule_groups):
+    """Write the XML description of a problem without building an ElementTree.
+    The output is identical to ET.tostring of the tree that the elements form.
+    Arguments:
+        file(binary file): destination of the XML
+        instances(list of AoTNode): the 8 context panels followed by the 8 candidates
+        rule_groups(list of list of Rule): rules that apply to each component
+    """
+    write_tag(file, "Data", [("version", str(XML_FORMAT_VERSION))])
+    write_tag(file, "Panels", empty=not instances)
+    for panel in instances:
+        write_tag(file, "Panel")
         struct = panel.children[0]
-        struct_i = ET.SubElement(panel_i, "Struct")
-        struct_i.set("name", struct.name)
-        for j in range(len(struct.children)):
-            component = struct.children[j]
-            component_j = ET.SubElement(struct_i, "Component")
-            component_j.set("id", str(j))
-            component_j.set("name", component.name)
+        write_tag(file, "Struct", [("name", struct.name)], empty=not struct.children)
+        for j, component in enumerate(struct.children):
+            write_tag(file, "Component", [("id", str(j)), ("name", component.name)])
             layout = component.children[0]
-            layout_k = ET.SubElement(component_j, "Layout")
-            layout_k.set("name", layout.name)
-            layout_k.set("Number", str(layout.number.get_value_level()))
-            layout_k.set("Position", json.dumps(layout.position.values))
-            layout_k.set("Uniformity", str(layout.uniformity.get_value_level()))
-            for l in range(len(layout.children)):
-                entity = layout.children[l]
-                entity_l = ET.SubElement(layout_k, "Entity")
+            write_tag(
+                file,
+                "Layout",
+                [
+                    ("name", layout.name),
+                    ("Number", str(layout.number.get_value_level())),
+                    ("Position", json.dumps(layout.position.values)),
+                    ("Uniformity", str(layout.uniformity.get_value_level())),
+                ],
+                empty=not layout.children,
+            )
+            for entity in layout.children:
                 entity_bbox = entity.bbox
                 entity_type = entity.type.get_value()
                 entity_size = entity.size.get_value()
                 entity_angle = entity.angle.get_value()
-                entity_l.set("bbox", json.dumps(entity_bbox))
-                entity_l.set(
-                    "real_bbox",
-                    json.dumps(
-                        get_real_bbox(
-                            entity_bbox, entity_type, entity_size, entity_angle
-                        )
-                    ),
+                real_bbox = get_real_bbox(
+                    entity_bbox, entity_type, entity_size, entity_angle
                 )
-                entity_l.set(
-                    "mask",
-                    rle_encode(
-                        get_mask(entity_bbox, entity_type, entity_size, entity_angle)
-                    ),
+                mask = get_mask_rle(entity_bbox, entity_type, entity_size, entity_angle)
+                write_tag(
+                    file,
+                    "Entity",
+                    [
+                        ("bbox", json.dumps(entity_bbox)),
+                        ("real_bbox", json.dumps(real_bbox)),
+                        ("mask", mask),
+                        ("Type", str(entity.type.get_value_level())),
+                        ("Size", str(entity.size.get_value_level())),
+                        ("Color", str(entity.color.get_value_level())),
+                        ("Angle", str(entity.angle.get_value_level())),
+                    ],
+                    empty=True,
                 )
-                entity_l.set("Type", str(entity.type.get_value_level()))
-                entity_l.set("Size", str(entity.size.get_value_level()))
-                entity_l.set("Color", str(entity.color.get_value_level()))
-                entity_l.set("Angle", str(entity.angle.get_value_level()))
-    rules = ET.SubElement(data, "Rules")
-    for i in range(len(rule_groups)):
-        rule_group = rule_groups[i]
-        rule_group_i = ET.SubElement(rules, "Rule_Group")
-        rule_group_i.set("id", str(i))
-        for rule in rule_group:
-            rule_j = ET.SubElement(rule_group_i, "Rule")
-            rule_j.set("name", rule.name)
-            rule_j.set("attr", rule.attr)
+            if layout.children:
+                write_end_tag(file, "Layout")
+            write_end_tag(file, "Component")
+        if struct.children:
+            write_end_tag(file, "Struct")
+        write_end_tag(file, "Panel")
+    if instances:
+        write_end_tag(file, "Panels")
 
-    modified_attr = ET.SubElement(data, "Modified_attributes")
+    write_tag(file, "Rules", empty=not rule_groups)
+    for i, rule_group in enumerate(rule_groups):
+        write_tag(file, "Rule_Group", [("id", str(i))], empty=not rule_group)
+        for rule in rule_group:
+            write_tag(file, "Rule", get_rule_attributes(rule), empty=True)
+        if rule_group:
+            write_end_tag(file, "Rule_Group")
+    if rule_groups:
+        write_end_tag(file, "Rules")
 
+    write_tag(file, "Modified_attributes")
     for i in range(8):
         candidate = instances[i + 8]
+        write_tag(
+            file, "Candidate", [("id", str(i))], empty=not candidate.modified_attr
+        )
+        for attr in candidate.modified_attr:
+            write_tag(
+                file,
+                "Attribute",
+                [("component_id", str(attr[0])), ("name", attr[1])],
+                empty=True,
+            )
+        if candidate.modified_attr:
+            write_end_tag(file, "Candidate")
+    write_end_tag(file, "Modified_attributes")
+    write_end_tag(file, "Data")
 
-        candidate_i = ET.SubElement(modified_attr, "Candidate")
-        candidate_i.set("id", str(i))
 
-        for attr in candidate.modified_attr:
-            attr_j = ET.SubElement(candidate_i, "Attribute")
-            attr_j.set("component_id", str(attr[0]))
-            attr_j.set("name", attr[1])
+def check_xml_format_version(data):
+    """Check that an XML description of a sample was written in the current format.
+    Samples written in earlier formats lack information needed to check or hash them,
+    hence they are rejected rather than read partially.
+    Arguments:
+        data(ET.Element): the Data element
+    """
+    version = int(data.get("version", 1))
+    if version != XML_FORMAT_VERSION:
+        raise ValueError(
+            f"The XML of the sample has format version {version}, but version "
+            f"{XML_FORMAT_VERSION} is required; regenerate the dataset with the "
+            "current generator"
+        )
+
 
-    return ET.tostring(data)
+def dom_problem(instances, rule_groups):
+    """XML description of a problem, written by write_problem into memory. Samples are
+    streamed to their files by write_problem itself; this is for the places that need
+    the document as bytes, such as sending it from a worker process.
+    Returns:
+        dom(bytes): the XML document
+    """
+    file = io.BytesIO()
+    write_problem(file, instances, rule_groups)
+    return file.getvalue()
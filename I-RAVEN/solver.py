@@ -3,8 +3,10 @@
 
 import numpy as np
 
+from Attribute import get_position_mask
 
-def solve(rule_groups, context, candidates):
+
+def solve(rule_groups, context, candidates, rng):
     """Search-based Heuristic Solver.
     Arguments:
         rule_groups(list of list of Rule): rules that apply to each component
@@ -12,237 +14,206 @@ def solve(rule_groups, context, candidates):
             should be of length 8
         candidates(list of AoTNode): a list of candidate answer AoTs;
             should be of length 8
+        rng(np.random.Generator): used for breaking ties between candidates
     Returns:
         ans(int): index of the correct answer in the candidates
     """
-    satisfied = [0] * len(candidates)
-    for i in range(len(candidates)):
-        candidate = candidates[i]
-        # note that rule.component_idx should be the same as j
-        for j in range(len(rule_groups)):
-            rule_group = rule_groups[j]
-            rule_num_pos = rule_group[0]
-            satisfied[i] += check_num_pos(rule_num_pos, context, candidate)
-            regenerate = False
-            if rule_num_pos.attr == "Number" or rule_num_pos.name == "Arithmetic":
-                regenerate = True
-            rule_type = rule_group[1]
-            satisfied[i] += check_entity(
-                rule_type, context, candidate, "Type", regenerate
-            )
-            rule_size = rule_group[2]
-            satisfied[i] += check_entity(
-                rule_size, context, candidate, "Size", regenerate
-            )
-            rule_color = rule_group[3]
-            satisfied[i] += check_entity(
-                rule_color, context, candidate, "Color", regenerate
-            )
-    satisfied = np.array(satisfied)
+    satisfied = score_candidates(rule_groups, context, candidates)
     answer_set = np.where(satisfied == max(satisfied))[0]
-    return np.random.choice(answer_set)
+    return rng.choice(answer_set)
+
 
+def get_layout(panel, component_idx):
+    return panel.children[0].children[component_idx].children[0]
 
-def check_num_pos(rule_num_pos, context, candidate):
-    """Check whether Rule on layout attribute is satisfied.
+
+def score_candidates(rule_groups, context, candidates):
+    """Count the rules satisfied by each candidate. A rule is satisfied if applying it
+    to the 7th and 8th context figures gives the candidate, see score_num_pos and
+    score_entity. All the candidates are checked at once: values of the context are
+    extracted once, and values of the candidates are gathered in arrays.
     Arguments:
-        rule_num_pos(Rule): the rule to check
+        rule_groups(list of list of Rule): rules that apply to each component
         context(list of AoTNode): the 8 context figures
-        candidate(AoTNode): the candidate AoT
+        candidates(list of AoTNode): the candidate AoTs
     Returns:
-        ret(int): 0 if failure, 1 if success
+        satisfied(np.ndarray): number of satisfied rules of each candidate
     """
-    ret = 0
-    component_idx = rule_num_pos.component_idx
-    row_3_1_layout = context[6].children[0].children[component_idx].children[0]
-    row_3_2_layout = context[7].children[0].children[component_idx].children[0]
-    candidate_layout = candidate.children[0].children[component_idx].children[0]
+    satisfied = np.zeros(len(candidates), np.int64)
+    for rule_group in rule_groups:
+        rule_num_pos = rule_group[0]
+        component_idx = rule_num_pos.component_idx
+        row_3_1_layout = get_layout(context[6], component_idx)
+        row_3_2_layout = get_layout(context[7], component_idx)
+        candidate_layouts = [
+            get_layout(candidate, component_idx) for candidate in candidates
+        ]
+        satisfied += score_num_pos(
+            rule_num_pos, row_3_1_layout, row_3_2_layout, candidate_layouts
+        )
+        regenerate = False
+        if rule_num_pos.attr == "Number" or rule_num_pos.name == "Arithmetic":
+            regenerate = True
+        for rule, attr in zip(rule_group[1:], ["Type", "Size", "Color"]):
+            satisfied += score_entity(
+                rule,
+                row_3_1_layout,
+                row_3_2_layout,
+                candidate_layouts,
+                attr,
+                regenerate,
+            )
+    return satisfied
+
+
+def score_num_pos(rule_num_pos, row_3_1_layout, row_3_2_layout, candidate_layouts):
+    """Check whether Rule on layout attribute is satisfied by each candidate.
+    Arguments:
+        rule_num_pos(Rule): the rule to check
+        row_3_1_layout(Layout): the layout of the rule in the 7th context figure
+        row_3_2_layout(Layout): the layout of the rule in the 8th context figure
+        candidate_layouts(list of Layout): the layouts of the rule in the candidates
+    Returns:
+        ret(np.ndarray): 0 if failure, 1 if success, for each candidate
+    """
+    row_3_1_num = row_3_1_layout.number.get_value_level()
+    row_3_2_num = row_3_2_layout.number.get_value_level()
+    candidate_num = np.array(
+        [layout.number.get_value_level() for layout in candidate_layouts]
+    )
+    row_3_1_pos = row_3_1_layout.position.get_value_mask()
+    row_3_2_pos = row_3_2_layout.position.get_value_mask()
+    candidate_pos = np.array(
+        [layout.position.get_value_mask() for layout in candidate_layouts]
+    )
+    ret = np.zeros(len(candidate_layouts), bool)
     if rule_num_pos.name == "Constant":
-        set_row_3_1_pos = set(row_3_1_layout.position.get_value_idx())
-        set_row_3_2_pos = set(row_3_2_layout.position.get_value_idx())
-        set_candidate_pos = set(candidate_layout.position.get_value_idx())
         # note that set equal only when len(Number) equal and content equal
-        if (
-            set_candidate_pos == set_row_3_1_pos
-            and set_candidate_pos == set_row_3_2_pos
-        ):
-            ret = 1
+        ret = (candidate_pos == row_3_1_pos) & (candidate_pos == row_3_2_pos)
     elif rule_num_pos.name == "Progression":
         if rule_num_pos.attr == "Number":
-            row_3_1_num = row_3_1_layout.number.get_value_level()
-            row_3_2_num = row_3_2_layout.number.get_value_level()
-            candidate_num = candidate_layout.number.get_value_level()
-            if row_3_2_num * 2 == row_3_1_num + candidate_num:
-                ret = 1
+            ret = row_3_2_num * 2 == row_3_1_num + candidate_num
         else:
-            row_3_1_pos = row_3_1_layout.position.get_value_idx()
-            row_3_2_pos = row_3_2_layout.position.get_value_idx()
-            candidate_pos = candidate_layout.position.get_value_idx()
-            most_num = len(candidate_layout.position.values)
+            most_num = len(row_3_1_layout.position.values)
             diff = rule_num_pos.value
-            if (set((row_3_1_pos + diff) % most_num) == set(row_3_2_pos)) and (
-                set((row_3_2_pos + diff) % most_num) == set(candidate_pos)
-            ):
-                ret = 1
+            row_3_1_idx = row_3_1_layout.position.get_value_idx()
+            row_3_2_idx = row_3_2_layout.position.get_value_idx()
+            if get_position_mask((row_3_1_idx + diff) % most_num) == row_3_2_pos:
+                ret = candidate_pos == get_position_mask(
+                    (row_3_2_idx + diff) % most_num
+                )
     elif rule_num_pos.name == "Arithmetic":
         mode = rule_num_pos.value
         if rule_num_pos.attr == "Number":
             row_3_1_num = row_3_1_layout.number.get_value()
             row_3_2_num = row_3_2_layout.number.get_value()
-            candidate_num = candidate_layout.number.get_value()
-            if mode > 0 and (candidate_num == row_3_1_num + row_3_2_num):
-                ret = 1
-            if mode < 0 and (candidate_num == row_3_1_num - row_3_2_num):
-                ret = 1
+            candidate_num = np.array(
+                [layout.number.get_value() for layout in candidate_layouts]
+            )
+            if mode > 0:
+                ret = candidate_num == row_3_1_num + row_3_2_num
+            if mode < 0:
+                ret = candidate_num == row_3_1_num - row_3_2_num
         else:
-            row_3_1_pos = row_3_1_layout.position.get_value_idx()
-            row_3_2_pos = row_3_2_layout.position.get_value_idx()
-            candidate_pos = candidate_layout.position.get_value_idx()
-            if mode > 0 and (set(candidate_pos) == set(row_3_1_pos) | set(row_3_2_pos)):
-                ret = 1
-            if mode < 0 and (set(candidate_pos) == set(row_3_1_pos) - set(row_3_2_pos)):
-                ret = 1
+            if mode > 0:
+                ret = candidate_pos == row_3_1_pos | row_3_2_pos
+            if mode < 0:
+                ret = candidate_pos == row_3_1_pos & ~row_3_2_pos
     else:
         three_values = rule_num_pos.value_levels[2]
         if rule_num_pos.attr == "Number":
-            row_3_1_num = row_3_1_layout.number.get_value_level()
-            row_3_2_num = row_3_2_layout.number.get_value_level()
-            candidate_num = candidate_layout.number.get_value_level()
-            if (
-                row_3_1_num == three_values[0]
-                and row_3_2_num == three_values[1]
-                and candidate_num == three_values[2]
-            ):
-                ret = 1
+            if row_3_1_num == three_values[0] and row_3_2_num == three_values[1]:
+                ret = candidate_num == three_values[2]
         else:
-            row_3_1_pos = row_3_1_layout.position.get_value_idx()
-            row_3_2_pos = row_3_2_layout.position.get_value_idx()
-            candidate_pos = candidate_layout.position.get_value_idx()
-            if (
-                set(row_3_1_pos) == set(three_values[0])
-                and set(row_3_2_pos) == set(three_values[1])
-                and set(candidate_pos) == set(three_values[2])
-            ):
-                ret = 1
-    return ret
+            if row_3_1_pos == get_position_mask(
+                three_values[0]
+            ) and row_3_2_pos == get_position_mask(three_values[1]):
+                ret = candidate_pos == get_position_mask(three_values[2])
+    return ret.astype(np.int64)
 
 
-def check_consistency(candidate, attr, component_idx):
-    candidate_layout = candidate.children[0].children[component_idx].children[0]
-    entity_0 = candidate_layout.children[0]
-    attr_name = attr.lower()
-    entity_0_value = getattr(entity_0, attr_name).get_value_level()
-    for i in range(1, len(candidate_layout.children)):
-        entity_i = candidate_layout.children[i]
-        entity_i_value = getattr(entity_i, attr_name).get_value_level()
-        if entity_i_value != entity_0_value:
-            return False
-    return True
-
-
-def check_entity(rule, context, candidate, attr, regenerate):
-    """Check whether Rule on entity attribute is satisfied.
+def get_candidate_value_levels(candidate_layouts, attr):
+    """Value levels of an entity attribute in the layouts of the candidates.
+    Returns:
+        value_levels(np.ndarray): value levels of the entities of each layout in a row,
+            padded with zeros to the largest number of entities
+        is_entity(np.ndarray): whether each value level is one of an entity
+    """
+    rows = [layout.get_value_levels(attr) for layout in candidate_layouts]
+    num_entities = np.array([len(row) for row in rows])
+    value_levels = np.zeros((len(rows), num_entities.max()), np.int64)
+    for index, row in enumerate(rows):
+        value_levels[index, : len(row)] = row
+    is_entity = np.arange(value_levels.shape[1]) < num_entities[:, None]
+    return value_levels, is_entity
+
+
+def score_entity(
+    rule, row_3_1_layout, row_3_2_layout, candidate_layouts, attr, regenerate
+):
+    """Check whether Rule on entity attribute is satisfied by each candidate.
     Arguments:
         rule(Rule): the rule to check
-        context(list of AoTNode): the 8 context figures
-        candidate(AoTNode): the candidate AoT
         attr(str): attribute name
+        regenerate(bool): whether entities are sampled anew in each figure, as when
+            Number follows a rule or the layout follows Arithmetic, in which case a
+            non-uniform Constant doesn't compare the values of individual entities
+        others: as in score_num_pos
     Returns:
-        ret(int): 0 if failure, 1 if success
+        ret(np.ndarray): 0 if failure, 1 if success, for each candidate
     """
-    ret = 0
-    component_idx = rule.component_idx
-    row_3_1_layout = context[6].children[0].children[component_idx].children[0]
-    row_3_2_layout = context[7].children[0].children[component_idx].children[0]
-    candidate_layout = candidate.children[0].children[component_idx].children[0]
-    uni = candidate_layout.uniformity.get_value()
-    attr_name = attr.lower()
+    value_levels, is_entity = get_candidate_value_levels(candidate_layouts, attr)
+    # whether all the entities of a candidate share the value of the attribute
+    consistent = np.all((value_levels == value_levels[:, :1]) | ~is_entity, axis=1)
+    candidate_value = value_levels[:, 0]
+    row_3_1_value = row_3_1_layout.get_value_levels(attr)[0]
+    row_3_2_value = row_3_2_layout.get_value_levels(attr)[0]
     if rule.name == "Constant":
-        if uni:
-            if check_consistency(candidate, attr, component_idx):
-                if (
-                    getattr(candidate_layout.children[0], attr_name).get_value_level()
-                    == getattr(row_3_2_layout.children[0], attr_name).get_value_level()
-                ):
-                    ret = 1
-        else:
-            row_3_1_num = row_3_1_layout.number.get_value_level()
-            row_3_2_num = row_3_2_layout.number.get_value_level()
-            candidate_num = candidate_layout.number.get_value_level()
-            if (row_3_1_num == row_3_2_num) and (row_3_2_num == candidate_num):
-                if regenerate:
-                    ret = 1
-                else:
-                    flag = True
-                    for i in range(len(candidate_layout.children)):
-                        if not (
-                            getattr(
-                                candidate_layout.children[i], attr_name
-                            ).get_value_level()
-                            == getattr(
-                                row_3_2_layout.children[i], attr_name
-                            ).get_value_level()
-                        ):
-                            flag = False
-                            break
-                    if flag:
-                        ret = 1
+        uni = np.array(
+            [layout.uniformity.get_value() for layout in candidate_layouts], bool
+        )
+        ret = uni & consistent & (candidate_value == row_3_2_value)
+        row_3_1_num = row_3_1_layout.number.get_value_level()
+        row_3_2_num = row_3_2_layout.number.get_value_level()
+        candidate_num = np.array(
+            [layout.number.get_value_level() for layout in candidate_layouts]
+        )
+        if row_3_1_num == row_3_2_num:
+            if regenerate:
+                same = np.ones(len(candidate_layouts), bool)
             else:
-                ret = 1
+                row_3_2_levels = row_3_2_layout.get_value_levels(attr)
+                width = len(row_3_2_levels)
+                same = np.sum(is_entity, axis=1) == width
+                if value_levels.shape[1] >= width:
+                    same &= np.all(value_levels[:, :width] == row_3_2_levels, axis=1)
+                else:
+                    same[:] = False
+            non_uni_ret = np.where(candidate_num == row_3_2_num, same, True)
+        else:
+            non_uni_ret = np.ones(len(candidate_layouts), bool)
+        ret = np.where(uni, ret, non_uni_ret)
     elif rule.name == "Progression":
-        if check_consistency(candidate, attr, component_idx):
-            row_3_1_value = getattr(
-                row_3_1_layout.children[0], attr_name
-            ).get_value_level()
-            row_3_2_value = getattr(
-                row_3_2_layout.children[0], attr_name
-            ).get_value_level()
-            candidate_value = getattr(
-                candidate_layout.children[0], attr_name
-            ).get_value_level()
-            if row_3_2_value * 2 == row_3_1_value + candidate_value:
-                ret = 1
+        ret = consistent & (row_3_2_value * 2 == row_3_1_value + candidate_value)
     elif rule.name == "Arithmetic":
-        if check_consistency(candidate, attr, component_idx):
-            row_3_1_value = getattr(
-                row_3_1_layout.children[0], attr_name
-            ).get_value_level()
-            row_3_2_value = getattr(
-                row_3_2_layout.children[0], attr_name
-            ).get_value_level()
-            candidate_value = getattr(
-                candidate_layout.children[0], attr_name
-            ).get_value_level()
-            if rule.value > 0:
-                if attr == "Color":
-                    if candidate_value == row_3_1_value + row_3_2_value:
-                        ret = 1
-                else:
-                    if candidate_value == row_3_1_value + row_3_2_value + 1:
-                        ret = 1
-            if rule.value < 0:
-                if attr == "Color":
-                    if candidate_value == row_3_1_value - row_3_2_value:
-                        ret = 1
-                else:
-                    if candidate_value == row_3_1_value - row_3_2_value - 1:
-                        ret = 1
+        ret = np.zeros(len(candidate_layouts), bool)
+        offset = 0 if attr == "Color" else 1
+        if rule.value > 0:
+            ret = candidate_value == row_3_1_value + row_3_2_value + offset
+        if rule.value < 0:
+            ret = candidate_value == row_3_1_value - row_3_2_value - offset
+        ret = consistent & ret
     else:
-        if check_consistency(candidate, attr, component_idx):
-            row_3_1_value = getattr(
-                row_3_1_layout.children[0], attr_name
-            ).get_value_level()
-            row_3_2_value = getattr(
-                row_3_2_layout.children[0], attr_name
-            ).get_value_level()
-            candidate_value = getattr(
-                candidate_layout.children[0], attr_name
-            ).get_value_level()
-            three_values = rule.value_levels[2]
-            if (
-                row_3_1_value == three_values[0]
-                and row_3_2_value == three_values[1]
-                and candidate_value == three_values[2]
-            ):
-                ret = 1
-    return ret
+        three_values = rule.value_levels[2]
+        ret = (
+            consistent
+            & (row_3_1_value == three_values[0])
+            & (row_3_2_value == three_values[1])
+            & (candidate_value == three_values[2])
+        )
+    return ret.astype(np.int64)
+
+
+def check_consistency(candidate, attr, component_idx):
+    candidate_layout = candidate.children[0].children[component_idx].children[0]
+    return candidate_layout.is_consistent(attr)
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+
+import hashlib
+import io
+import json
+import os
+import zipfile
+
+import numpy as np
+
+SPLITS = ["train", "val", "test"]
+
+# Output formats of the generated dataset:
+# npz - a .npz and an .xml file for each sample
+# shards - samples appended to large shard files with an index
+FORMATS = ["npz", "shards"]
+
+DEFAULT_SHARD_SIZE = 1024
+
+SHARDS_HEADER_FILENAME = "shards.json"
+SHARDS_INDEX_FILENAME = "shards.idx"
+
+# Entry of the shards index: the sample with index k of the given split is stored
+# as the record-th record of the shard and its XML at xml_offset of the XML shard
+INDEX_DTYPE = np.dtype(
+    [
+        ("k", "<i8"),
+        ("split", "u1"),
+        ("shard", "<i4"),
+        ("record", "<i4"),
+        ("xml_offset", "<i8"),
+        ("xml_size", "<i8"),
+    ]
+)
+
+# Max length of the serialized structure of a sample stored in a shard record
+STRUCTURE_SIZE = 256
+
+
+def save_npz(file, **arrays):
+    """Equivalent of np.savez with fixed archive timestamps, such that
+    the same arrays always produce the same bytes.
+    """
+    with zipfile.ZipFile(file, "w", zipfile.ZIP_STORED, allowZip64=True) as zipf:
+        for key, value in arrays.items():
+            info = zipfile.ZipInfo(key + ".npy", date_time=(1980, 1, 1, 0, 0, 0))
+            with zipf.open(info, "w", force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(value), allow_pickle=True)
+
+
+def checksum(data, offset=None):
+    ret = {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+    if offset is not None:
+        ret["offset"] = offset
+    return ret
+
+
+class ChecksumWriter(object):
+    """Binary file wrapper which computes the checksum of the data written through it,
+    such that content streamed to a file doesn't have to be held in memory to be recorded.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        self.sha256.update(data)
+
+    def checksum(self, offset=None):
+        ret = {"size": self.size, "sha256": self.sha256.hexdigest()}
+        if offset is not None:
+            ret["offset"] = offset
+        return ret
+
+
+def write_file(path, data):
+    """Write the file atomically, such that an interrupted run never leaves
+    a partially written file behind.
+    Arguments:
+        path(str): destination of the file
+        data(bytes or callable): content of the file, or a function which writes it
+            to the binary file passed to it
+    Returns:
+        checksum(dict): size and sha256 digest of the content
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        writer = ChecksumWriter(f)
+        if callable(data):
+            data(writer)
+        else:
+            writer.write(data)
+    os.replace(tmp_path, path)
+    return writer.checksum()
+
+
+def write_npz_sample(directory, k, set_name, arrays, write_xml):
+    """Save a sample as RAVEN_{k}_{set_name}.npz and RAVEN_{k}_{set_name}.xml.
+    Arguments:
+        write_xml(callable): writes the XML description of the sample to the binary
+            file passed to it, such that it is streamed to the .xml file
+        others: as in ShardWriter.write
+    Returns:
+        files(dict): checksums of the written files, keyed by the filename
+    """
+    filename = "RAVEN_{}_{}".format(k, set_name)
+    files = {}
+    npz = io.BytesIO()
+    save_npz(npz, **arrays)
+    files[filename + ".npz"] = write_file(
+        os.path.join(directory, filename + ".npz"), npz.getvalue()
+    )
+    files[filename + ".xml"] = write_file(
+        os.path.join(directory, filename + ".xml"), write_xml
+    )
+    return files
+
+
+def get_record_dtype(arrays):
+    """Fixed-size record which stores all arrays of a sample.
+    The list of strings describing the structure is stored joined with '.'.
+    """
+    fields = []
+    for key, value in arrays.items():
+        value = np.asanyarray(value)
+        if key == "structure":
+            fields.append((key, "S{}".format(STRUCTURE_SIZE)))
+        else:
+            fields.append((key, value.dtype.newbyteorder("<"), value.shape))
+    return np.dtype(fields)
+
+
+def get_shard_filenames(shard):
+    return "shard_{:05d}.bin".format(shard), "shard_{:05d}.xml.bin".format(shard)
+
+
+class ShardWriter(object):
+    """Writer which appends samples to large shard files instead of creating two
+    small files for every sample. A directory of shards consists of:
+        shard_{i}.bin - fixed-size records with the arrays of up to shard_size samples
+        shard_{i}.xml.bin - concatenated XML descriptions of the same samples
+        shards.idx - array of INDEX_DTYPE entries locating every sample
+        shards.json - header with the record layout
+    Records are only appended and the index entry of a sample is written after its data,
+    so an interrupted run leaves valid shards behind.
+    """
+
+    def __init__(self, directory, shard_size=DEFAULT_SHARD_SIZE):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.record_dtype = None
+        self.shard = -1
+        self.num_records = shard_size
+        self.xml_offset = 0
+        self.shard_file = None
+        self.xml_file = None
+        self.index_file = None
+
+    def open(self, resume=False):
+        """Open the writer.
+        Arguments:
+            resume(bool): whether to keep samples of a previous run;
+                otherwise, existing shards are removed
+        """
+        header_path = os.path.join(self.directory, SHARDS_HEADER_FILENAME)
+        index_path = os.path.join(self.directory, SHARDS_INDEX_FILENAME)
+        if resume and os.path.exists(header_path):
+            with open(header_path) as f:
+                header = json.load(f)
+            self.record_dtype = np.lib.format.descr_to_dtype(header["record_dtype"])
+            # drop an index entry that was written only partially
+            index_size = os.path.getsize(index_path)
+            with open(index_path, "r+b") as f:
+                f.truncate(index_size - index_size % INDEX_DTYPE.itemsize)
+            # samples are appended to a new shard, so that partially written
+            # records of the previous run are never followed by valid ones
+            self.shard = header["num_shards"] - 1
+        else:
+            for filename in os.listdir(self.directory):
+                if filename.startswith("shard"):
+                    os.remove(os.path.join(self.directory, filename))
+            open(index_path, "wb").close()
+        self.index_file = open(index_path, "ab")
+
+    def _write_header(self):
+        header = {
+            "record_dtype": np.lib.format.dtype_to_descr(self.record_dtype),
+            "shard_size": self.shard_size,
+            "num_shards": self.shard + 1,
+        }
+        path = os.path.join(self.directory, SHARDS_HEADER_FILENAME)
+        write_file(path, json.dumps(header).encode())
+
+    def _next_shard(self):
+        self._close_shard()
+        self.shard += 1
+        self.num_records = 0
+        self.xml_offset = 0
+        shard_filename, xml_filename = get_shard_filenames(self.shard)
+        self.shard_file = open(os.path.join(self.directory, shard_filename), "wb")
+        self.xml_file = open(os.path.join(self.directory, xml_filename), "wb")
+        self._write_header()
+
+    def write(self, k, set_name, arrays, write_xml):
+        """Append a sample to the current shard.
+        Arguments:
+            k(int): index of the sample
+            set_name(str): dataset split of the sample
+            arrays(dict): arrays of the sample
+            write_xml(callable): writes the XML description of the sample to the binary
+                file passed to it, such that it is streamed to the XML shard
+        Returns:
+            files(dict): location and checksums of the written data, keyed by the filename
+        """
+        if self.record_dtype is None:
+            self.record_dtype = get_record_dtype(arrays)
+        if self.num_records == self.shard_size:
+            self._next_shard()
+        record = np.zeros((), self.record_dtype)
+        for key, value in arrays.items():
+            if key == "structure":
+                value = ".".join(value).encode()
+                assert len(value) <= STRUCTURE_SIZE
+            record[key] = value
+        data = record.tobytes()
+        self.shard_file.write(data)
+        xml_writer = ChecksumWriter(self.xml_file)
+        write_xml(xml_writer)
+        self.shard_file.flush()
+        self.xml_file.flush()
+
+        entry = np.array(
+            (
+                k,
+                SPLITS.index(set_name),
+                self.shard,
+                self.num_records,
+                self.xml_offset,
+                xml_writer.size,
+            ),
+            INDEX_DTYPE,
+        )
+        self.index_file.write(entry.tobytes())
+        self.index_file.flush()
+
+        shard_filename, xml_filename = get_shard_filenames(self.shard)
+        files = {
+            shard_filename: checksum(data, self.num_records * len(data)),
+            xml_filename: xml_writer.checksum(self.xml_offset),
+        }
+        self.num_records += 1
+        self.xml_offset += xml_writer.size
+        return files
+
+    def _close_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+            self.xml_file.close()
+            self.shard_file = None
+            self.xml_file = None
+
+    def close(self):
+        self._close_shard()
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+
+
+class ShardReader(object):
+    """Reader of a directory written by ShardWriter.
+    Samples can be accessed randomly by their index k or streamed sequentially
+    in the order in which they are stored.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, SHARDS_HEADER_FILENAME)) as f:
+            header = json.load(f)
+        self.record_dtype = np.lib.format.descr_to_dtype(header["record_dtype"])
+        index_path = os.path.join(directory, SHARDS_INDEX_FILENAME)
+        index_size = os.path.getsize(index_path)
+        index = np.fromfile(
+            index_path, INDEX_DTYPE, count=index_size // INDEX_DTYPE.itemsize
+        )
+        # a sample written more than once, e.g. after resuming, is read from its last copy
+        self.entries = {}
+        for entry in index:
+            self.entries[int(entry["k"])] = entry
+        self.index = np.array(
+            sorted(self.entries.values(), key=lambda e: (e["shard"], e["record"])),
+            INDEX_DTYPE,
+        )
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return sorted(self.entries.keys())
+
+    def memmap(self, shard):
+        """Memory-map the records of a shard without reading them.
+        A partially written record at the end of the shard is ignored.
+        """
+        shard_filename, _ = get_shard_filenames(shard)
+        path = os.path.join(self.directory, shard_filename)
+        num_records = os.path.getsize(path) // self.record_dtype.itemsize
+        return np.memmap(path, self.record_dtype, mode="r", shape=(num_records,))
+
+    def read_xml(self, k):
+        entry = self.entries[k]
+        _, xml_filename = get_shard_filenames(int(entry["shard"]))
+        with open(os.path.join(self.directory, xml_filename), "rb") as f:
+            f.seek(int(entry["xml_offset"]))
+            return f.read(int(entry["xml_size"]))
+
+    def _read(self, entry):
+        shard_filename, _ = get_shard_filenames(int(entry["shard"]))
+        with open(os.path.join(self.directory, shard_filename), "rb") as f:
+            f.seek(int(entry["record"]) * self.record_dtype.itemsize)
+            record = np.frombuffer(
+                f.read(self.record_dtype.itemsize), self.record_dtype
+            )[0]
+        return record_to_arrays(record), self.read_xml(int(entry["k"]))
+
+    def read(self, k):
+        """Read the sample with index k.
+        Returns:
+            set_name(str): dataset split of the sample
+            arrays(dict): arrays of the sample
+            dom(bytes): XML description of the sample
+        """
+        entry = self.entries[k]
+        return (SPLITS[entry["split"]],) + self._read(entry)
+
+    def stream(self):
+        """Iterate over samples sequentially, shard after shard.
+        Yields:
+            k(int), set_name(str), arrays(dict), dom(bytes)
+        """
+        for shard in np.unique(self.index["shard"]):
+            entries = self.index[self.index["shard"] == shard]
+            shard_filename, xml_filename = get_shard_filenames(int(shard))
+            records = np.fromfile(
+                os.path.join(self.directory, shard_filename), self.record_dtype
+            )
+            with open(os.path.join(self.directory, xml_filename), "rb") as f:
+                for entry in entries:
+                    f.seek(int(entry["xml_offset"]))
+                    dom = f.read(int(entry["xml_size"]))
+                    record = records[entry["record"]]
+                    yield int(entry["k"]), SPLITS[entry["split"]], record_to_arrays(
+                        record
+                    ), dom
+
+
+def decode_structure(value):
+    return np.array(value.decode().split("."))
+
+
+def record_to_arrays(record):
+    arrays = {}
+    for key in record.dtype.names:
+        value = record[key]
+        if key == "structure":
+            value = decode_structure(value)
+        arrays[key] = value
+    return arrays
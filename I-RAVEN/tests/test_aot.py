@@ -0,0 +1,151 @@
+import copy
+import pickle
+
+import numpy as np
+import pytest
+
+from Attribute import NoNewValueError, get_position_mask
+from build_tree import (
+    build_distribute_four,
+    build_distribute_nine,
+    build_in_distribute_four_out_center_single,
+)
+from const import TYPE_MAX
+from Rule import Rule_Wrapper
+
+
+def get_layouts(root):
+    return [component.children[0] for component in root.children[0].children]
+
+
+def test_deepcopy_is_independent():
+    root = build_in_distribute_four_out_center_single(True)
+    panel = root.sample(np.random.default_rng(42))
+    copied = copy.deepcopy(panel)
+    for layout, copied_layout in zip(get_layouts(panel), get_layouts(copied)):
+        assert copied_layout is not layout
+        assert copied_layout.layout_constraint == layout.layout_constraint
+        copied_layout.layout_constraint["Number"][1] = -1
+        assert layout.layout_constraint["Number"][1] != -1
+        copied_layout.sample_new_num_count[0][0] -= 1
+        copied_layout.sample_new_num_count[0][1].add(1)
+        assert layout.sample_new_num_count[0][1] == set()
+        copied_layout.position.previous_values.append(np.array([0]))
+        assert layout.position.previous_values == []
+        for entity, copied_entity in zip(layout.children, copied_layout.children):
+            assert copied_entity.type is not entity.type
+            level = entity.type.get_value_level()
+            copied_entity.type.set_value_level(level + 1)
+            assert entity.type.get_value_level() == level
+            copied_entity.reset_constraint("Size", -1, -1)
+            assert entity.entity_constraint["Size"] != [-1, -1]
+    copied.apply_new_value(0, "Type", [1])
+    assert panel.modified_attr == []
+
+
+def get_constraint_ids(layout):
+    return [id(layout.entity_constraint)] + [
+        id(entity.entity_constraint) for entity in layout.children
+    ]
+
+
+def test_deepcopy_preserves_shared_constraints():
+    root = build_distribute_nine()
+    panel = root.sample(np.random.default_rng(42))
+    layout = get_layouts(panel)[0]
+    copied_layout = get_layouts(copy.deepcopy(panel))[0]
+    ids = get_constraint_ids(layout)
+    copied_ids = get_constraint_ids(copied_layout)
+    # constraints shared by nodes of the tree are still shared in the copy
+    assert [ids.index(i) for i in ids] == [copied_ids.index(i) for i in copied_ids]
+    assert not set(ids) & set(copied_ids)
+
+
+def test_entities_without_dict():
+    root = build_distribute_nine()
+    panel = root.sample(np.random.default_rng(42))
+    layout = get_layouts(panel)[0]
+    for entity in layout.children:
+        assert not hasattr(entity, "__dict__")
+        for attr in [entity.type, entity.size, entity.color, entity.angle]:
+            assert not hasattr(attr, "__dict__")
+    copied = pickle.loads(pickle.dumps(panel))
+    for entity, copied_entity in zip(layout.children, get_layouts(copied)[0].children):
+        assert copied_entity.bbox == entity.bbox
+        assert copied_entity.entity_constraint == entity.entity_constraint
+        for attr in ["type", "size", "color", "angle"]:
+            value_level = getattr(entity, attr).get_value_level()
+            assert getattr(copied_entity, attr).get_value_level() == value_level
+
+
+def test_value_levels():
+    root = build_distribute_nine()
+    layout = get_layouts(root.sample(np.random.default_rng(42)))[0]
+    expected = [entity.size.get_value_level() for entity in layout.children]
+    np.testing.assert_array_equal(layout.get_value_levels("Size"), expected)
+    layout.set_value_levels("Size", 2)
+    assert layout.is_consistent("Size")
+    np.testing.assert_array_equal(
+        layout.get_value_levels("Size"), [2] * len(layout.children)
+    )
+    layout.set_value_levels("Color", [1, 3])
+    assert [entity.color.get_value_level() for entity in layout.children] == [
+        [1, 3][index % 2] for index in range(len(layout.children))
+    ]
+    assert layout.is_consistent("Color") == (len(layout.children) == 1)
+
+
+def test_prune_reuses_constraints():
+    root = build_in_distribute_four_out_center_single()
+    rng = np.random.default_rng(42)
+    rule_groups = [
+        [
+            Rule_Wrapper("Constant", "Number/Position", None, 0, rng),
+            Rule_Wrapper("Progression", "Type", [1], 0, rng),
+            Rule_Wrapper("Constant", "Size", None, 0, rng),
+            Rule_Wrapper("Constant", "Color", None, 0, rng),
+        ],
+        [
+            Rule_Wrapper("Constant", "Number/Position", None, 1, rng),
+            Rule_Wrapper("Constant", "Type", None, 1, rng),
+            Rule_Wrapper("Arithmetic", "Size", [1], 1, rng),
+            Rule_Wrapper("Distribute_Three", "Color", None, 1, rng),
+        ],
+    ]
+    pruned = [root.prune(rule_groups, rng) for _ in range(2)]
+    template_layouts = get_layouts(root)
+    for layout in template_layouts:
+        assert len(layout.pruned_constraints) == 1
+    layouts, other_layouts = [get_layouts(new_root) for new_root in pruned]
+    for layout, other_layout, template_layout in zip(
+        layouts, other_layouts, template_layouts
+    ):
+        assert layout.layout_constraint == other_layout.layout_constraint
+        assert layout.entity_constraint == other_layout.entity_constraint
+        assert layout.entity_constraint is not other_layout.entity_constraint
+        layout.entity_constraint["Type"][0] = -1
+        assert other_layout.entity_constraint["Type"][0] != -1
+        (cached,) = template_layout.pruned_constraints.values()
+        assert cached[1]["Type"][0] != -1
+    assert layouts[0].entity_constraint["Type"][1] == TYPE_MAX - 2
+
+
+@pytest.mark.parametrize("mode_3", [None, "3-Position-Number"])
+def test_sample_new_value_exhausts_positions(mode_3):
+    rng = np.random.default_rng(42)
+    panel = build_distribute_four().sample(rng)
+    layout = get_layouts(panel)[0]
+    min_level, max_level = layout.layout_constraint["Number"]
+    num_sets = 2 ** len(layout.position.values)
+    sets = {layout.position.get_value_mask()}
+    with pytest.raises(NoNewValueError):
+        for _ in range(num_sets):
+            value_level, _, *new_value_idxs = panel.sample_new_value(
+                rng, 0, "Number", min_level, max_level, True, mode_3
+            )
+            assert value_level != layout.number.get_value_level()
+            for new_value_idx in new_value_idxs:
+                assert len(new_value_idx) == layout.number.get_value(value_level)
+                assert get_position_mask(new_value_idx) not in sets
+                sets.add(get_position_mask(new_value_idx))
+    assert len(sets) < num_sets
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from api import (
+    get_crop_window,
+    get_mask,
+    get_mask_rle,
+    get_real_bbox,
+    render_mask,
+    rle_decode,
+    rle_encode,
+    rle_encode_binary,
+)
+
+ENTITIES = [
+    ([0.5, 0.5, 1, 1], "triangle", 0.6, -90),
+    ([0.25, 0.75, 0.5, 0.5], "square", 0.4, 45),
+    ([0.5, 0.5, 0.33, 0.33], "hexagon", 0.9, 0),
+    ([0.5, 0.5, 1, 1], "circle", 0.5, 180),
+]
+
+
+@pytest.mark.parametrize("entity_values", ENTITIES)
+def test_cached_metadata(entity_values):
+    mask = render_mask(*entity_values)
+    for _ in range(2):
+        np.testing.assert_array_equal(get_mask(*entity_values), mask)
+        assert get_mask_rle(*entity_values) == rle_encode(mask)
+    assert get_mask(*entity_values) is get_mask(*entity_values)
+    assert not get_mask(*entity_values).flags.writeable
+
+    real_bbox = get_real_bbox(*entity_values)
+    assert len(real_bbox) == 4
+    real_bbox[0] = -1
+    assert get_real_bbox(*entity_values)[0] != -1
+    bbox, *attribute_values = entity_values
+    assert get_real_bbox(tuple(bbox), *attribute_values) == get_real_bbox(
+        *entity_values
+    )
+
+
+def rle_decode_loop(mask_rle, shape):
+    s = mask_rle[1:-1].split(",")
+    starts, lengths = [np.asarray(x, dtype=int) for x in (s[0:][::2], s[1:][::2])]
+    img = np.zeros(shape[0] * shape[1], dtype=np.uint8)
+    for lo, hi in zip(starts - 1, starts - 1 + lengths):
+        img[lo:hi] = 1
+    return img.reshape(shape)
+
+
+@pytest.mark.parametrize("entity_values", ENTITIES)
+def test_rle_decode(entity_values):
+    mask = render_mask(*entity_values)
+    mask_rle = rle_encode(mask)
+    assert mask_rle.startswith("[") and mask_rle.endswith("]")
+    np.testing.assert_array_equal(
+        rle_decode(mask_rle, mask.shape), rle_decode_loop(mask_rle, mask.shape)
+    )
+    binary_mask = (mask > 0.5).astype(np.uint8)
+    np.testing.assert_array_equal(
+        rle_decode(rle_encode(binary_mask), mask.shape), binary_mask
+    )
+    runs = rle_encode_binary(binary_mask)
+    assert runs.dtype == np.uint16
+    assert rle_encode(binary_mask) == "[" + ",".join(map(str, runs)) + "]"
+    np.testing.assert_array_equal(rle_decode(runs, mask.shape), binary_mask)
+
+
+@pytest.mark.parametrize("entity_values", ENTITIES)
+def test_rle_cropped(entity_values):
+    mask = (render_mask(*entity_values) > 0).astype(np.uint8)
+    real_bbox = get_real_bbox(*entity_values)
+    top, left, bottom, right = get_crop_window(real_bbox, mask.shape)
+    assert 0 <= top < bottom <= mask.shape[0] and 0 <= left < right <= mask.shape[1]
+    for mask_rle in [rle_encode(mask, real_bbox), rle_encode_binary(mask, real_bbox)]:
+        np.testing.assert_array_equal(rle_decode(mask_rle, mask.shape, real_bbox), mask)
+    assert len(rle_encode(mask, real_bbox)) < len(rle_encode(mask))
+    mask[0, 0] = mask[-1, -1] = 1
+    with pytest.raises(ValueError):
+        rle_encode(mask, real_bbox)
+
+
+def test_rle_empty_mask():
+    mask = np.zeros((8, 8), np.uint8)
+    assert rle_encode(mask) == "[]"
+    np.testing.assert_array_equal(rle_decode("[]", mask.shape), mask)
+    np.testing.assert_array_equal(rle_decode(rle_encode_binary(mask), (8, 8)), mask)
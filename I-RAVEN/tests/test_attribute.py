@@ -0,0 +1,74 @@
+import itertools
+from collections import Counter
+from math import comb
+
+import numpy as np
+import pytest
+
+from Attribute import (
+    Position,
+    count_positions,
+    get_position_idx,
+    get_position_mask,
+    rank_combination,
+    unrank_combination,
+)
+
+
+@pytest.mark.parametrize("length", [1, 4, 9, 12])
+def test_rank_combination(length):
+    for num in range(1, length + 1):
+        combinations = list(itertools.combinations(range(length), num))
+        ranks = [rank_combination(combination) for combination in combinations]
+        assert sorted(ranks) == list(range(comb(length, num)))
+        for combination, rank in zip(combinations, ranks):
+            np.testing.assert_array_equal(unrank_combination(rank, num), combination)
+
+
+def test_position_mask():
+    rng = np.random.default_rng(42)
+    for _ in range(100):
+        value_idx = rng.permutation(9)[: rng.integers(1, 10)]
+        mask = get_position_mask(value_idx)
+        assert count_positions(mask) == len(value_idx)
+        np.testing.assert_array_equal(get_position_idx(mask), sorted(value_idx))
+    assert get_position_mask([]) == 0
+    assert get_position_idx(0).size == 0
+
+
+@pytest.mark.parametrize("length,num", [(4, 2), (9, 8), (12, 6)])
+def test_position_sample_new_exhausts_positions(length, num):
+    rng = np.random.default_rng(42)
+    position = Position("planar", list(range(length)))
+    position.sample(rng, num)
+    sets = {frozenset(position.get_value_idx())}
+    for _ in range(comb(length, num) - 1):
+        new_value_idx = position.sample_new(rng, num)
+        assert len(new_value_idx) == num
+        assert frozenset(new_value_idx) not in sets
+        sets.add(frozenset(new_value_idx))
+        position.previous_values.append(new_value_idx)
+    with pytest.raises(ValueError):
+        position.sample_new(rng, num)
+
+
+def test_position_sample_new_is_uniform():
+    rng = np.random.default_rng(42)
+    position = Position("planar", list(range(5)))
+    position.set_value_idx(np.array([0, 1]))
+    previous_values = [np.array([3, 2]), np.array([4, 0])]
+    num_samples = 20000
+    sets = Counter()
+    orders = Counter()
+    for _ in range(num_samples):
+        new_value_idx = position.sample_new(rng, 2, previous_values)
+        sets[frozenset(new_value_idx)] += 1
+        orders[new_value_idx[0] < new_value_idx[1]] += 1
+    excluded = {frozenset([0, 1]), frozenset([2, 3]), frozenset([0, 4])}
+    assert not set(sets) & excluded
+    assert len(sets) == comb(5, 2) - len(excluded)
+    expected = num_samples / len(sets)
+    for count in sets.values():
+        assert abs(count - expected) < 5 * np.sqrt(expected)
+    # positions are returned in a random order
+    assert abs(orders[True] - num_samples / 2) < 5 * np.sqrt(num_samples / 4)
@@ -0,0 +1,60 @@
+import pickle
+
+import numpy as np
+
+from dataset import RavenDataset
+from main import main, make_parser
+
+
+def generate(save_dir, *args):
+    main_arg_parser = make_parser()
+    args = [
+        "--save-dir",
+        str(save_dir),
+        "--seed",
+        "42",
+        "--num-samples",
+        "10",
+        "--configurations",
+        "center_single,distribute_four",
+    ] + list(args)
+    main(main_arg_parser.parse_args(args))
+
+
+def test_dataset(tmp_path):
+    generate(tmp_path / "npz")
+    generate(tmp_path / "shards", "--format", "shards", "--shard-size", "3")
+
+    npz_dataset = RavenDataset(str(tmp_path / "npz"))
+    shards_dataset = RavenDataset(str(tmp_path / "shards"))
+    assert len(npz_dataset) == len(shards_dataset) == 20
+    assert npz_dataset.samples == shards_dataset.samples
+    for idx in range(len(npz_dataset)):
+        configuration, k, set_name = npz_dataset.samples[idx]
+        path = tmp_path / "npz" / configuration / f"RAVEN_{k}_{set_name}"
+        expected = np.load(f"{path}.npz")
+        for dataset in [npz_dataset, pickle.loads(pickle.dumps(shards_dataset))]:
+            item = dataset[idx]
+            assert list(item) == list(expected.keys())
+            for key, value in expected.items():
+                np.testing.assert_array_equal(item[key], value)
+            # arrays are memory-mapped instead of being copied into memory
+            assert not item["image"].flags.owndata
+            assert not item["image"].flags.writeable
+            assert dataset.get_xml(idx) == path.with_suffix(".xml").read_bytes()
+
+
+def test_dataset_splits(tmp_path):
+    generate(tmp_path)
+    train = RavenDataset(str(tmp_path), splits=["train"])
+    val_test = RavenDataset(str(tmp_path), splits=["val", "test"])
+    assert len(train) == 12
+    assert len(val_test) == 8
+    assert {set_name for _, _, set_name in train.samples} == {"train"}
+    assert {set_name for _, _, set_name in val_test.samples} == {"val", "test"}
+
+    configuration = RavenDataset(str(tmp_path / "center_single"), splits=["test"])
+    assert configuration.samples == [
+        ("center_single", 8, "test"),
+        ("center_single", 9, "test"),
+    ]
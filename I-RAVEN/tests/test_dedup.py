@@ -0,0 +1,111 @@
+import json
+import shutil
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pytest
+
+from build_tree import build_distribute_four, build_in_distribute_four_out_center_single
+from dedup import (
+    HASH_INDEX_FILENAME,
+    aot_matrix_hash,
+    build_index,
+    find_duplicates,
+    matrix_hash,
+)
+from main import main, make_parser, sample_matrix, sample_rng
+from serialize import dom_problem
+
+
+def test_matrix_hash():
+    args = make_parser().parse_args(["--seed", "42"])
+    configuration = "distribute_four"
+    root = build_distribute_four()
+    doms = []
+    for k in range(2):
+        rng = sample_rng(42, configuration, k)
+        rule_groups, _, context, candidates, _ = sample_matrix(
+            args, configuration, root, rng, "train"
+        )
+        doms.append(dom_problem(context + candidates, rule_groups))
+    assert matrix_hash(doms[0]) != matrix_hash(doms[1])
+    # candidates are compared regardless of their order
+    rng.shuffle(candidates)
+    assert matrix_hash(dom_problem(context + candidates, rule_groups)) == matrix_hash(
+        doms[1]
+    )
+
+    def modify_entity(dom, attr, value):
+        data = ET.fromstring(dom)
+        data.find("Panels/Panel/Struct/Component/Layout/Entity").set(attr, value)
+        return ET.tostring(data)
+
+    assert matrix_hash(modify_entity(doms[0], "Angle", "-1")) == matrix_hash(doms[0])
+    assert matrix_hash(modify_entity(doms[0], "Color", "-1")) != matrix_hash(doms[0])
+
+    # rules are compared with their values
+    data = ET.fromstring(doms[0])
+    rule = data.find("Rules/Rule_Group/Rule")
+    rule.set("value", str(int(rule.get("value")) + 1))
+    assert matrix_hash(ET.tostring(data)) != matrix_hash(doms[0])
+
+
+@pytest.mark.parametrize("mesh", ["0", "2"])
+def test_aot_matrix_hash(mesh):
+    args = make_parser().parse_args(["--seed", "42", "--mesh", mesh])
+    configuration = "in_distribute_four_out_center_single"
+    root = build_in_distribute_four_out_center_single(mesh == "2")
+    for k in range(10):
+        rule_groups, _, context, candidates, _ = sample_matrix(
+            args, configuration, root, sample_rng(42, configuration, k), "train"
+        )
+        instances = context + candidates
+        assert aot_matrix_hash(instances, rule_groups) == matrix_hash(
+            dom_problem(instances, rule_groups)
+        )
+
+
+def test_build_index(tmp_path):
+    main_arg_parser = make_parser()
+    args = [
+        "--save-dir",
+        str(tmp_path),
+        "--seed",
+        "42",
+        "--num-samples",
+        "20",
+        "--configurations",
+        "distribute_four,in_center_single_out_center_single",
+        "--verify",
+        "none",
+    ]
+    main(main_arg_parser.parse_args(args))
+    directory = tmp_path / "distribute_four"
+    lines = (directory / "manifest.jsonl").read_text().splitlines()
+    hashes = {
+        record["k"]: int(record["hash"], 16) for record in map(json.loads, lines[1:])
+    }
+    for extension in ["npz", "xml"]:
+        for k, set_name in [(9, "test"), (11, "train")]:
+            shutil.copy(
+                directory / f"RAVEN_0_train.{extension}",
+                directory / f"RAVEN_{k}_{set_name}.{extension}",
+            )
+
+    for workers in [1, 2]:
+        indices = build_index(str(tmp_path), workers)
+        assert sorted(indices) == [
+            "distribute_four",
+            "in_center_single_out_center_single",
+        ]
+        index = indices["distribute_four"]
+        np.testing.assert_array_equal(np.load(directory / HASH_INDEX_FILENAME), index)
+        assert np.all(np.diff(index["hash"].astype(float)) >= 0)
+        assert len(index) == 20
+        for k, value in zip(index["k"], index["hash"]):
+            assert value == hashes[0 if k in [9, 11] else k]
+        groups = find_duplicates(index)
+        assert len(groups) == 1
+        assert groups[0]["k"].tolist() == [0, 9, 11]
+        assert groups[0]["split"].tolist() == [0, 2, 0]
+        assert find_duplicates(indices["in_center_single_out_center_single"]) == []
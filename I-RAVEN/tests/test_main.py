@@ -1,6 +1,19 @@
+import json
+from pathlib import Path
+
+import numpy as np
 import pytest
 
-from main import main, make_parser
+import main as main_module
+from Attribute import NoNewValueError
+from build_tree import (
+    build_center_single,
+    build_distribute_four,
+    build_distribute_nine,
+)
+from dedup import aot_matrix_hash
+from main import generate_sample, main, make_parser, save_sample
+from storage import INDEX_DTYPE, ShardReader
 
 
 @pytest.mark.parametrize(
@@ -48,3 +61,326 @@ def test_separate(params: str):
         assert (
             acc == 1.0
         ), f"Accuracy for configuration {config} is below 100%: {acc * 100}"
+
+
+def read_dataset(save_dir):
+    return {
+        path.relative_to(save_dir): path.read_bytes()
+        for path in sorted(save_dir.glob("*/RAVEN_*"))
+    }
+
+
+def test_separate_workers(tmp_path):
+    main_arg_parser = make_parser()
+    datasets = []
+    for workers in [1, 3]:
+        save_dir = tmp_path / f"workers-{workers}"
+        args = [
+            "--save-dir",
+            str(save_dir),
+            "--seed",
+            "42",
+            "--num-samples",
+            "10",
+            "--configurations",
+            "center_single,in_distribute_four_out_center_single",
+            "--workers",
+            str(workers),
+        ]
+        main(main_arg_parser.parse_args(args))
+        datasets.append(read_dataset(save_dir))
+    assert len(datasets[0]) == 40
+    assert datasets[0] == datasets[1]
+
+
+@pytest.mark.parametrize("rule_sampling", ["table", "rejection"])
+def test_separate_rule_sampling_stats(tmp_path, capsys, rule_sampling):
+    main_arg_parser = make_parser()
+    outputs = []
+    for workers in [1, 2]:
+        args = [
+            "--save-dir",
+            str(tmp_path / f"workers-{workers}"),
+            "--seed",
+            "42",
+            "--num-samples",
+            "20",
+            "--configurations",
+            "in_distribute_four_out_center_single",
+            "--rule-sampling",
+            rule_sampling,
+            "--verify",
+            "none",
+            "--workers",
+            str(workers),
+        ]
+        main(main_arg_parser.parse_args(args))
+        lines = capsys.readouterr().out.splitlines()
+        outputs.append([line for line in lines if line.startswith("Rule groups")])
+    # counts of the workers are collected by the main process
+    assert outputs[0] == outputs[1]
+    assert len(outputs[0]) == 1
+    if rule_sampling == "table":
+        assert outputs[0][0].startswith(
+            "Rule groups of in_distribute_four_out_center_single rejected by pruning: 0 ("
+        )
+        assert "expected with rejection sampling" in outputs[0][0]
+    else:
+        assert "rejected by pruning: 0" not in outputs[0][0]
+        assert "expected" not in outputs[0][0]
+    assert outputs[0][0].endswith(" in 20 generated samples")
+
+
+def test_generate_sample_regenerates_single_sample(tmp_path):
+    main_arg_parser = make_parser()
+    args = [
+        "--seed",
+        "42",
+        "--num-samples",
+        "10",
+        "--configurations",
+        "distribute_nine",
+    ]
+    args = main_arg_parser.parse_args(args + ["--save-dir", str(tmp_path / "all")])
+    main(args)
+    dataset = read_dataset(tmp_path / "all")
+
+    args.save_dir = str(tmp_path / "single")
+    (tmp_path / "single" / "distribute_nine").mkdir(parents=True)
+    save_sample(args, "distribute_nine", build_distribute_nine(), 7)
+    sample = read_dataset(tmp_path / "single")
+    assert len(sample) == 2
+    for path, content in sample.items():
+        assert dataset[path] == content
+
+
+def test_generate_sample_resamples_exhausted_matrix(monkeypatch):
+    sample_matrix = main_module.sample_matrix
+    calls = []
+
+    def exhaust_first_matrix(*args):
+        calls.append(args)
+        matrix = sample_matrix(*args)
+        if len(calls) == 1:
+            raise NoNewValueError("exhausted")
+        return matrix
+
+    monkeypatch.setattr(main_module, "sample_matrix", exhaust_first_matrix)
+    args = make_parser().parse_args(["--seed", "42"])
+    with pytest.raises(NoNewValueError, match="sample 3 of center_single"):
+        generate_sample(args, "center_single", build_center_single(), 3)
+    calls.clear()
+    args = make_parser().parse_args(["--seed", "42", "--max-resamples", "1"])
+    is_correct, _, _, resamples, _ = generate_sample(
+        args, "center_single", build_center_single(), 3
+    )
+    assert is_correct
+    assert resamples == 1
+
+
+def test_separate_resume(tmp_path):
+    main_arg_parser = make_parser()
+    args = [
+        "--save-dir",
+        str(tmp_path),
+        "--seed",
+        "42",
+        "--num-samples",
+        "10",
+        "--configurations",
+        "distribute_four",
+    ]
+    main(main_arg_parser.parse_args(args))
+    dataset = read_dataset(tmp_path)
+
+    # Simulate an interrupted run: the last samples are missing from the manifest
+    # and one of them has been written only partially
+    manifest_path = tmp_path / "distribute_four" / "manifest.jsonl"
+    lines = manifest_path.read_text().splitlines()
+    manifest_path.write_text("\n".join(lines[:7]) + "\n" + lines[7][:20])
+    filenames = list(json.loads(lines[7])["files"])
+    (tmp_path / "distribute_four" / filenames[0]).write_bytes(b"partial")
+    (tmp_path / "distribute_four" / filenames[1]).unlink()
+    # a completed sample is overwritten with data of the same size
+    filename = next(iter(json.loads(lines[3])["files"]))
+    path = tmp_path / "distribute_four" / filename
+    path.write_bytes(bytes(len(path.read_bytes())))
+    modified_time = (tmp_path / "distribute_four" / "RAVEN_0_train.npz").stat()
+
+    accs = main(main_arg_parser.parse_args(args + ["--resume"]))
+    assert accs["distribute_four"] == 1.0
+    assert read_dataset(tmp_path) == dataset
+    # completed samples are not generated again
+    assert (
+        tmp_path / "distribute_four" / "RAVEN_0_train.npz"
+    ).stat().st_mtime_ns == modified_time.st_mtime_ns
+
+    # the previous run was interrupted before writing the header of the manifest
+    manifest_path.write_text("")
+    main(main_arg_parser.parse_args(args + ["--resume"]))
+    assert read_dataset(tmp_path) == dataset
+    lines = manifest_path.read_text().splitlines()
+    assert json.loads(lines[0])["settings"]["seed"] == 42
+    assert len(lines) == 11
+    with pytest.raises(ValueError):
+        main(main_arg_parser.parse_args(args + ["--resume", "--mesh", "2"]))
+
+
+def test_separate_shards(tmp_path):
+    main_arg_parser = make_parser()
+    args = [
+        "--seed",
+        "42",
+        "--num-samples",
+        "10",
+        "--configurations",
+        "in_center_single_out_center_single",
+    ]
+    main(main_arg_parser.parse_args(args + ["--save-dir", str(tmp_path / "npz")]))
+    shards_args = args + [
+        "--save-dir",
+        str(tmp_path / "shards"),
+        "--format",
+        "shards",
+        "--shard-size",
+        "4",
+    ]
+    main(main_arg_parser.parse_args(shards_args))
+    directory = tmp_path / "shards" / "in_center_single_out_center_single"
+    assert not list(directory.glob("RAVEN_*"))
+    assert len(list(directory.glob("shard_*.bin"))) == 2 * 3
+
+    def assert_same_as_npz(reader):
+        assert len(reader) == 10
+        streamed = list(reader.stream())
+        assert [k for k, _, _, _ in streamed] == list(range(10))
+        for k, set_name, arrays, dom in streamed:
+            filename = f"RAVEN_{k}_{set_name}"
+            npz_directory = tmp_path / "npz" / "in_center_single_out_center_single"
+            assert (npz_directory / f"{filename}.xml").read_bytes() == dom
+            expected = np.load(npz_directory / f"{filename}.npz")
+            assert list(arrays) == list(expected.keys())
+            for key, value in expected.items():
+                np.testing.assert_array_equal(arrays[key], value)
+            assert reader.read(k)[2] == dom
+
+    assert_same_as_npz(ShardReader(directory))
+
+    # Simulate an interrupted run: the last samples are missing from the manifest
+    # and the index ends with a partially written entry
+    manifest_path = directory / "manifest.jsonl"
+    lines = manifest_path.read_text().splitlines()
+    manifest_path.write_text("\n".join(lines[:8]) + "\n")
+    index_path = directory / "shards.idx"
+    index_path.write_bytes(index_path.read_bytes()[: 8 * INDEX_DTYPE.itemsize + 5])
+
+    accs = main(main_arg_parser.parse_args(shards_args + ["--resume"]))
+    assert accs["in_center_single_out_center_single"] == 1.0
+    assert_same_as_npz(ShardReader(directory))
+
+
+def test_separate_verify(tmp_path):
+    main_arg_parser = make_parser()
+    args = [
+        "--seed",
+        "42",
+        "--num-samples",
+        "20",
+        "--configurations",
+        "distribute_four",
+    ]
+    main(main_arg_parser.parse_args(args + ["--save-dir", str(tmp_path / "all")]))
+    dataset = read_dataset(tmp_path / "all")
+
+    save_dir = tmp_path / "none"
+    accs = main(
+        main_arg_parser.parse_args(
+            args + ["--save-dir", str(save_dir), "--verify", "none"]
+        )
+    )
+    assert accs["distribute_four"] is None
+    # the content of samples doesn't depend on which of them are verified
+    assert read_dataset(save_dir) == dataset
+    lines = (save_dir / "distribute_four" / "manifest.jsonl").read_text().splitlines()
+    assert all(json.loads(line)["correct"] is None for line in lines[1:])
+
+    save_dir = tmp_path / "sample"
+    accs = main(
+        main_arg_parser.parse_args(
+            args + ["--save-dir", str(save_dir), "--verify", "sample:0.5"]
+        )
+    )
+    assert accs["distribute_four"] == 1.0
+    assert read_dataset(save_dir) == dataset
+    lines = (save_dir / "distribute_four" / "manifest.jsonl").read_text().splitlines()
+    verified = [json.loads(line)["correct"] is not None for line in lines[1:]]
+    assert 0 < sum(verified) < 20
+
+    for value in ["sample:2", "sample:x", "some"]:
+        with pytest.raises(SystemExit):
+            main_arg_parser.parse_args(args + ["--verify", value])
+
+
+def test_separate_reject_duplicates(tmp_path, monkeypatch):
+    # duplicates are simulated with hashes that collide often
+    monkeypatch.setattr(
+        main_module,
+        "aot_matrix_hash",
+        lambda *args: aot_matrix_hash(*args) % 16,
+    )
+    main_arg_parser = make_parser()
+    args = [
+        "--seed",
+        "42",
+        "--num-samples",
+        "12",
+        "--configurations",
+        "distribute_four",
+        "--verify",
+        "none",
+    ]
+    main(main_arg_parser.parse_args(args + ["--save-dir", str(tmp_path / "all")]))
+    dataset = read_dataset(tmp_path / "all")
+
+    args += ["--reject-duplicates"]
+    attempts = {}
+    for format in ["shards", "npz"]:
+        save_dir = tmp_path / format
+        main(
+            main_arg_parser.parse_args(
+                args + ["--save-dir", str(save_dir), "--format", format]
+            )
+        )
+        lines = (save_dir / "distribute_four" / "manifest.jsonl").read_text()
+        records = [json.loads(line) for line in lines.splitlines()[1:]]
+        assert len({record["hash"] for record in records}) == 12
+        attempts[format] = [record.get("attempt", 0) for record in records]
+    assert any(attempts["npz"])
+    # rejection doesn't depend on the format
+    assert attempts["shards"] == attempts["npz"]
+    attempts = attempts["npz"]
+    # samples that weren't rejected are the same as without rejection
+    rejected = read_dataset(tmp_path / "npz")
+    for record, attempt in zip(records, attempts):
+        for path in record["files"]:
+            path = Path("distribute_four") / path
+            assert (dataset[path] == rejected[path]) == (not attempt)
+    k = attempts.index(max(attempts))
+    parsed_args = main_arg_parser.parse_args(
+        args + ["--save-dir", str(tmp_path / "one")]
+    )
+    (tmp_path / "one" / "distribute_four").mkdir(parents=True)
+    save_sample(
+        parsed_args, "distribute_four", build_distribute_four(), k, max(attempts)
+    )
+    for path, content in read_dataset(tmp_path / "one").items():
+        assert rejected[path] == content
+
+    monkeypatch.setattr(main_module, "MAX_DUPLICATE_ATTEMPTS", 2)
+    monkeypatch.setattr(
+        main_module,
+        "aot_matrix_hash",
+        lambda *args: aot_matrix_hash(*args) % 2,
+    )
+    with pytest.raises(ValueError, match="in 2 attempts"):
+        main(main_arg_parser.parse_args(args + ["--save-dir", str(tmp_path / "few")]))
@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+
+import build_tree
+import main
+import rendering
+from build_tree import (
+    build_distribute_nine,
+    build_in_distribute_four_out_center_single,
+    build_left_center_single_right_center_single,
+)
+from const import ANGLE_VALUES, IMAGE_SIZE, SIZE_VALUES, TYPE_VALUES
+from rendering import render_matrix, render_panel
+
+
+def sample_panels(root, num_panels=50):
+    rng = np.random.default_rng(42)
+    return [root.sample(rng) for _ in range(num_panels)]
+
+
+def reference_render_panel(root, add_random_mesh=False, rng=None):
+    # Renders every layer on its own canvas and composites them with layer_add
+    canvas = np.ones((IMAGE_SIZE, IMAGE_SIZE), np.uint8) * 255
+    structure, entities = root.prepare()
+    structure_img = rendering.render_structure(structure)
+    background = np.zeros((IMAGE_SIZE, IMAGE_SIZE), np.uint8)
+    if add_random_mesh:
+        background = rendering.layer_add(background, rendering.render_web(rng))
+    for entity in entities:
+        entity_img = rendering.draw_entity(
+            entity.bbox,
+            entity.type.get_value(),
+            entity.size.get_value(),
+            entity.color.get_value(),
+            entity.angle.get_value(),
+        )
+        background = rendering.layer_add(background, entity_img)
+    background = rendering.layer_add(background, structure_img)
+    return canvas - background
+
+
+@pytest.mark.parametrize(
+    "build,add_mesh,add_random_mesh",
+    [
+        (build_distribute_nine, False, False),
+        (build_distribute_nine, True, False),
+        (build_distribute_nine, False, True),
+        (build_in_distribute_four_out_center_single, False, False),
+        (build_in_distribute_four_out_center_single, True, False),
+        (build_left_center_single_right_center_single, False, False),
+    ],
+)
+def test_render_panel(build, add_mesh, add_random_mesh):
+    panels = sample_panels(build(add_mesh))
+    rendering._render_entity_roi.cache_clear()
+    for _ in range(2):
+        for i, panel in enumerate(panels):
+            image = render_panel(panel, add_random_mesh, np.random.default_rng(i))
+            expected = reference_render_panel(
+                panel, add_random_mesh, np.random.default_rng(i)
+            )
+            np.testing.assert_array_equal(image, expected)
+    assert rendering._render_entity_roi.cache_info().hits > 0
+
+
+@pytest.mark.parametrize(
+    "add_mesh,add_random_mesh", [(False, False), (True, False), (False, True)]
+)
+def test_render_matrix(add_mesh, add_random_mesh):
+    panels = sample_panels(build_in_distribute_four_out_center_single(add_mesh), 13)
+    # candidates usually contain panels with the same entities
+    context, candidates = panels[:8], [panels[8]] * 4 + panels[9:]
+    images = render_matrix(
+        context, candidates, add_random_mesh, np.random.default_rng(0)
+    )
+    assert images.shape == (16, IMAGE_SIZE, IMAGE_SIZE)
+    assert images.dtype == np.uint8
+    rng = np.random.default_rng(0)
+    for image, panel in zip(images, context + candidates):
+        np.testing.assert_array_equal(image, render_panel(panel, add_random_mesh, rng))
+
+
+@pytest.mark.parametrize(
+    "configuration,mesh",
+    [
+        ("in_distribute_four_out_center_single", 0),
+        ("in_distribute_four_out_center_single", 2),
+        ("left_center_single_right_center_single", 0),
+    ],
+)
+def test_render_matrix_of_samples(configuration, mesh, monkeypatch):
+    # candidates differ from the answer in single components
+    matrices = []
+
+    def record_matrix(context, candidates, add_random_mesh, rng):
+        matrices.append((context, list(candidates)))
+        return render_matrix(context, candidates, add_random_mesh, rng)
+
+    monkeypatch.setattr(main, "render_matrix", record_matrix)
+    args = main.make_parser().parse_args(["--seed", "42", "--mesh", str(mesh)])
+    root = getattr(build_tree, "build_" + configuration)(mesh == 2)
+    for k in range(10):
+        main.generate_sample(args, configuration, root, k)
+    for context, candidates in matrices:
+        images = render_matrix(context, candidates)
+        for image, panel in zip(images, context + candidates):
+            np.testing.assert_array_equal(image, render_panel(panel))
+
+
+def test_render_entity_roi():
+    panel = sample_panels(build_distribute_nine(), 1)[0]
+    _, entities = panel.prepare()
+    layer, (y, x) = rendering.render_entity_roi(entities[0])
+    with pytest.raises(ValueError):
+        layer[0, 0] = 1
+    image = rendering.render_entity(entities[0])
+    assert np.count_nonzero(image) == np.count_nonzero(layer)
+    np.testing.assert_array_equal(
+        image[y : y + layer.shape[0], x : x + layer.shape[1]], layer
+    )
+
+
+@pytest.mark.parametrize("angle", ANGLE_VALUES)
+@pytest.mark.parametrize("entity_type", TYPE_VALUES[1:-1])
+def test_rotate_entity(angle, entity_type, monkeypatch):
+    bboxes = [(0.5, 0.5, 1, 1), (0.16, 0.83, 0.33, 0.33), (0.25, 0.75, 0.5, 0.5)]
+    images = [
+        rendering.draw_entity(bbox, entity_type, size, color, angle)
+        for bbox in bboxes
+        for size in SIZE_VALUES
+        for color in [0, 140]
+    ]
+
+    def rotate_image(img, angle, center):
+        return rendering.rotate(img, angle, center=center)
+
+    monkeypatch.setattr(rendering, "rotate_entity", rotate_image)
+    expected_images = [
+        rendering.draw_entity(bbox, entity_type, size, color, angle)
+        for bbox in bboxes
+        for size in SIZE_VALUES
+        for color in [0, 140]
+    ]
+    images = np.stack(images)
+    expected_images = np.stack(expected_images)
+    if angle % 90 == 0:
+        np.testing.assert_array_equal(images, expected_images)
+    else:
+        difference = np.abs(images.astype(int) - expected_images)
+        assert difference.max() <= rendering.ROTATION_TOLERANCE
+        assert np.count_nonzero(difference) <= 0.01 * np.count_nonzero(expected_images)
@@ -1,6 +1,16 @@
+from collections import Counter
+
+import numpy as np
 import pytest
 
-from sampling import do_enforce_train_set_rule
+import build_tree
+from sampling import (
+    do_enforce_train_set_rule,
+    get_rule_tables,
+    rule_sampling_stats,
+    sample_feasible_rules,
+    sample_rules,
+)
 
 
 # fmt: off
@@ -109,3 +119,95 @@ def test_do_enforce_train_set_rule(
         split, configuration, component_idx, ood_attribute_idx, train_set_rule
     )
     assert expected == actual
+
+
+def get_rule_marginals(rule_groups):
+    """Frequencies of each rule on each attribute of each component."""
+    counts = Counter()
+    for rule_group_list in rule_groups:
+        for component_idx, rule_group in enumerate(rule_group_list):
+            for j, rule in enumerate(rule_group):
+                counts[component_idx, j, rule.name, int(rule.value)] += 1
+    return {key: count / len(rule_groups) for key, count in counts.items()}
+
+
+@pytest.mark.parametrize(
+    "configuration,mesh,ood_attribute_indices,train_set_rules,set_name",
+    [
+        ("center_single", False, [], [], "train"),
+        ("distribute_four", True, [], [], "train"),
+        ("distribute_four", False, [2], ["Arithmetic"], "test"),
+    ],
+)
+def test_sample_feasible_rules(
+    configuration, mesh, ood_attribute_indices, train_set_rules, set_name
+):
+    # rules sampled from the tables follow the distribution of rejection sampling
+    root = getattr(build_tree, "build_" + configuration)(mesh)
+    num_components = len(root.children[0].children)
+    rng = np.random.default_rng(42)
+    num_samples = 4000
+    rejected = []
+    while len(rejected) < num_samples:
+        rule_groups = sample_rules(
+            rng,
+            num_components,
+            mesh,
+            configuration,
+            ood_attribute_indices,
+            set_name,
+            train_set_rules,
+        )
+        if root.prune(rule_groups, rng) is not None:
+            rejected.append(rule_groups)
+    sampled = []
+    for _ in range(num_samples):
+        rule_groups = sample_feasible_rules(
+            rng,
+            configuration,
+            mesh,
+            ood_attribute_indices,
+            set_name,
+            train_set_rules,
+        )
+        assert root.prune(rule_groups, rng) is not None
+        sampled.append(rule_groups)
+    expected = get_rule_marginals(rejected)
+    actual = get_rule_marginals(sampled)
+    assert set(actual) <= set(expected)
+    for key, p in expected.items():
+        tolerance = 5 * np.sqrt(p * (1 - p) / num_samples) + 1e-3
+        assert abs(actual.get(key, 0) - p) <= tolerance, key
+
+
+def test_rule_tables():
+    tables = get_rule_tables("in_distribute_four_out_center_single", True)
+    assert len(tables) == 3
+    # tables are cached by the name of the configuration, not by a tree
+    assert get_rule_tables("in_distribute_four_out_center_single", True) is tables
+    for rule_groups, probabilities, feasible_probability in tables:
+        assert len(rule_groups) == len(probabilities)
+        assert np.isclose(probabilities.sum(), 1)
+        assert 0 < feasible_probability <= 1
+    # the outer component admits only a few rules
+    assert tables[0][2] < 0.05
+    # rules on the mesh component are always Constant, except on Number/Position
+    assert all(
+        [rule[0] for rule in rule_group[1:]] == ["Constant"] * 3
+        for rule_group in tables[2][0]
+    )
+
+    rule_sampling_stats.clear()
+    rng = np.random.default_rng(42)
+    sample_feasible_rules(rng, "in_distribute_four_out_center_single", True)
+    acceptance_probability = np.prod([table[2] for table in tables])
+    assert rule_sampling_stats["samples"] == 1
+    assert np.isclose(
+        rule_sampling_stats["expected_rejections"], 1 / acceptance_probability - 1
+    )
+
+
+def test_rule_tables_without_feasible_rules():
+    # Color of the mesh component has a single value, hence it can't follow Progression
+    with pytest.raises(ValueError):
+        get_rule_tables("center_single", True, (3,), "train", ("Progression",))
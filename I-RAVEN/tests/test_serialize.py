@@ -0,0 +1,99 @@
+import io
+import xml.etree.ElementTree as ET
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from build_tree import build_in_distribute_four_out_center_single
+from dedup import matrix_hash
+from main import make_parser, sample_matrix, sample_rng
+from serialize import (
+    XML_FORMAT_VERSION,
+    dom_problem,
+    escape_attribute,
+    get_rule_attributes,
+    write_problem,
+    write_tag,
+)
+from verify import parse_problem
+
+
+@pytest.mark.parametrize("mesh", ["0", "2"])
+def test_dom_problem_matches_element_tree(mesh):
+    args = make_parser().parse_args(["--seed", "42", "--mesh", mesh])
+    configuration = "in_distribute_four_out_center_single"
+    root = build_in_distribute_four_out_center_single(mesh == "2")
+    rule_groups, _, context, candidates, _ = sample_matrix(
+        args, configuration, root, sample_rng(42, configuration, 0), "train"
+    )
+    dom = dom_problem(context + candidates, rule_groups)
+    # ElementTree writes back the same bytes only if they are formatted as it does
+    data = ET.fromstring(dom)
+    assert ET.tostring(data) == dom
+    assert len(data.find("Panels")) == 16
+    assert len(data.find("Rules")) == len(rule_groups)
+    file = io.BytesIO()
+    write_problem(file, context + candidates, rule_groups)
+    assert file.getvalue() == dom
+
+
+def test_write_tag_escapes_attributes():
+    value = 'a&b<c>"d"\r\n\teé'
+    element = ET.Element("Tag", name=value, empty="")
+    file = io.BytesIO()
+    write_tag(file, "Tag", [("name", value), ("empty", "")], empty=True)
+    assert file.getvalue() == ET.tostring(element)
+    assert ET.fromstring(file.getvalue()).get("name") == value
+    assert escape_attribute("[1, 2]") == "[1, 2]"
+
+
+def test_rule_element_format():
+    # the format of Rule elements is a part of XML_FORMAT_VERSION 2
+    assert XML_FORMAT_VERSION == 2
+    rules = [
+        (
+            SimpleNamespace(name="Constant", attr="Type", value=0, value_levels=[]),
+            b'<Rule name="Constant" attr="Type" value="0" />',
+        ),
+        (
+            SimpleNamespace(name="Progression", attr="Size", value=-2, value_levels=[]),
+            b'<Rule name="Progression" attr="Size" value="-2" />',
+        ),
+        (
+            SimpleNamespace(
+                name="Distribute_Three",
+                attr="Position",
+                value=0,
+                value_levels=[np.array([[0, 1], [1, 2], [0, 2]])] * 3,
+            ),
+            b'<Rule name="Distribute_Three" attr="Position" value="0" '
+            b'value_levels="[[[0, 1], [1, 2], [0, 2]], [[0, 1], [1, 2], [0, 2]], '
+            b'[[0, 1], [1, 2], [0, 2]]]" />',
+        ),
+    ]
+    for rule, expected in rules:
+        file = io.BytesIO()
+        write_tag(file, "Rule", get_rule_attributes(rule), empty=True)
+        assert file.getvalue() == expected
+
+
+def test_earlier_xml_format_rejected():
+    args = make_parser().parse_args(["--seed", "42"])
+    configuration = "in_distribute_four_out_center_single"
+    root = build_in_distribute_four_out_center_single()
+    rule_groups, _, context, candidates, _ = sample_matrix(
+        args, configuration, root, sample_rng(42, configuration, 0), "train"
+    )
+    dom = dom_problem(context + candidates, rule_groups)
+    assert dom.startswith(b'<Data version="2">')
+    # samples of earlier versions have neither the version nor the values of rules
+    data = ET.fromstring(dom)
+    del data.attrib["version"]
+    for rule in data.iter("Rule"):
+        rule.attrib = {"name": rule.get("name"), "attr": rule.get("attr")}
+    dom = ET.tostring(data)
+    with pytest.raises(ValueError, match="format version 1"):
+        parse_problem(dom)
+    with pytest.raises(ValueError, match="format version 1"):
+        matrix_hash(dom)
@@ -0,0 +1,244 @@
+import numpy as np
+import pytest
+
+from Attribute import get_position_mask
+from build_tree import (
+    build_center_single,
+    build_distribute_nine,
+    build_in_distribute_four_out_center_single,
+    build_left_center_single_right_center_single,
+)
+from main import make_parser, sample_matrix, sample_rng
+from solver import check_consistency, score_candidates, solve
+
+
+# Reference implementation of score_candidates, which checks candidates one by one
+def check_num_pos(rule_num_pos, context, candidate):
+    """Check whether Rule on layout attribute is satisfied by a single candidate.
+    Arguments:
+        rule_num_pos(Rule): the rule to check
+        context(list of AoTNode): the 8 context figures
+        candidate(AoTNode): the candidate AoT
+    Returns:
+        ret(int): 0 if failure, 1 if success
+    """
+    ret = 0
+    component_idx = rule_num_pos.component_idx
+    row_3_1_layout = context[6].children[0].children[component_idx].children[0]
+    row_3_2_layout = context[7].children[0].children[component_idx].children[0]
+    candidate_layout = candidate.children[0].children[component_idx].children[0]
+    if rule_num_pos.name == "Constant":
+        row_3_1_pos = row_3_1_layout.position.get_value_mask()
+        row_3_2_pos = row_3_2_layout.position.get_value_mask()
+        candidate_pos = candidate_layout.position.get_value_mask()
+        # note that set equal only when len(Number) equal and content equal
+        if candidate_pos == row_3_1_pos and candidate_pos == row_3_2_pos:
+            ret = 1
+    elif rule_num_pos.name == "Progression":
+        if rule_num_pos.attr == "Number":
+            row_3_1_num = row_3_1_layout.number.get_value_level()
+            row_3_2_num = row_3_2_layout.number.get_value_level()
+            candidate_num = candidate_layout.number.get_value_level()
+            if row_3_2_num * 2 == row_3_1_num + candidate_num:
+                ret = 1
+        else:
+            row_3_1_pos = row_3_1_layout.position.get_value_idx()
+            row_3_2_pos = row_3_2_layout.position.get_value_idx()
+            most_num = len(candidate_layout.position.values)
+            diff = rule_num_pos.value
+            shifted_row_3_1_pos = get_position_mask((row_3_1_pos + diff) % most_num)
+            shifted_row_3_2_pos = get_position_mask((row_3_2_pos + diff) % most_num)
+            if (
+                shifted_row_3_1_pos == row_3_2_layout.position.get_value_mask()
+                and shifted_row_3_2_pos == candidate_layout.position.get_value_mask()
+            ):
+                ret = 1
+    elif rule_num_pos.name == "Arithmetic":
+        mode = rule_num_pos.value
+        if rule_num_pos.attr == "Number":
+            row_3_1_num = row_3_1_layout.number.get_value()
+            row_3_2_num = row_3_2_layout.number.get_value()
+            candidate_num = candidate_layout.number.get_value()
+            if mode > 0 and (candidate_num == row_3_1_num + row_3_2_num):
+                ret = 1
+            if mode < 0 and (candidate_num == row_3_1_num - row_3_2_num):
+                ret = 1
+        else:
+            row_3_1_pos = row_3_1_layout.position.get_value_mask()
+            row_3_2_pos = row_3_2_layout.position.get_value_mask()
+            candidate_pos = candidate_layout.position.get_value_mask()
+            if mode > 0 and (candidate_pos == row_3_1_pos | row_3_2_pos):
+                ret = 1
+            if mode < 0 and (candidate_pos == row_3_1_pos & ~row_3_2_pos):
+                ret = 1
+    else:
+        three_values = rule_num_pos.value_levels[2]
+        if rule_num_pos.attr == "Number":
+            row_3_1_num = row_3_1_layout.number.get_value_level()
+            row_3_2_num = row_3_2_layout.number.get_value_level()
+            candidate_num = candidate_layout.number.get_value_level()
+            if (
+                row_3_1_num == three_values[0]
+                and row_3_2_num == three_values[1]
+                and candidate_num == three_values[2]
+            ):
+                ret = 1
+        else:
+            row_3_1_pos = row_3_1_layout.position.get_value_mask()
+            row_3_2_pos = row_3_2_layout.position.get_value_mask()
+            candidate_pos = candidate_layout.position.get_value_mask()
+            if (
+                row_3_1_pos == get_position_mask(three_values[0])
+                and row_3_2_pos == get_position_mask(three_values[1])
+                and candidate_pos == get_position_mask(three_values[2])
+            ):
+                ret = 1
+    return ret
+
+
+def check_entity(rule, context, candidate, attr, regenerate):
+    """Check whether Rule on entity attribute is satisfied by a single candidate.
+    Arguments:
+        rule(Rule): the rule to check
+        context(list of AoTNode): the 8 context figures
+        candidate(AoTNode): the candidate AoT
+        attr(str): attribute name
+    Returns:
+        ret(int): 0 if failure, 1 if success
+    """
+    ret = 0
+    component_idx = rule.component_idx
+    row_3_1_layout = context[6].children[0].children[component_idx].children[0]
+    row_3_2_layout = context[7].children[0].children[component_idx].children[0]
+    candidate_layout = candidate.children[0].children[component_idx].children[0]
+    uni = candidate_layout.uniformity.get_value()
+    attr_name = attr.lower()
+    if rule.name == "Constant":
+        if uni:
+            if check_consistency(candidate, attr, component_idx):
+                if (
+                    getattr(candidate_layout.children[0], attr_name).get_value_level()
+                    == getattr(row_3_2_layout.children[0], attr_name).get_value_level()
+                ):
+                    ret = 1
+        else:
+            row_3_1_num = row_3_1_layout.number.get_value_level()
+            row_3_2_num = row_3_2_layout.number.get_value_level()
+            candidate_num = candidate_layout.number.get_value_level()
+            if (row_3_1_num == row_3_2_num) and (row_3_2_num == candidate_num):
+                if regenerate:
+                    ret = 1
+                else:
+                    if np.array_equal(
+                        candidate_layout.get_value_levels(attr),
+                        row_3_2_layout.get_value_levels(attr),
+                    ):
+                        ret = 1
+            else:
+                ret = 1
+    elif rule.name == "Progression":
+        if check_consistency(candidate, attr, component_idx):
+            row_3_1_value = getattr(
+                row_3_1_layout.children[0], attr_name
+            ).get_value_level()
+            row_3_2_value = getattr(
+                row_3_2_layout.children[0], attr_name
+            ).get_value_level()
+            candidate_value = getattr(
+                candidate_layout.children[0], attr_name
+            ).get_value_level()
+            if row_3_2_value * 2 == row_3_1_value + candidate_value:
+                ret = 1
+    elif rule.name == "Arithmetic":
+        if check_consistency(candidate, attr, component_idx):
+            row_3_1_value = getattr(
+                row_3_1_layout.children[0], attr_name
+            ).get_value_level()
+            row_3_2_value = getattr(
+                row_3_2_layout.children[0], attr_name
+            ).get_value_level()
+            candidate_value = getattr(
+                candidate_layout.children[0], attr_name
+            ).get_value_level()
+            if rule.value > 0:
+                if attr == "Color":
+                    if candidate_value == row_3_1_value + row_3_2_value:
+                        ret = 1
+                else:
+                    if candidate_value == row_3_1_value + row_3_2_value + 1:
+                        ret = 1
+            if rule.value < 0:
+                if attr == "Color":
+                    if candidate_value == row_3_1_value - row_3_2_value:
+                        ret = 1
+                else:
+                    if candidate_value == row_3_1_value - row_3_2_value - 1:
+                        ret = 1
+    else:
+        if check_consistency(candidate, attr, component_idx):
+            row_3_1_value = getattr(
+                row_3_1_layout.children[0], attr_name
+            ).get_value_level()
+            row_3_2_value = getattr(
+                row_3_2_layout.children[0], attr_name
+            ).get_value_level()
+            candidate_value = getattr(
+                candidate_layout.children[0], attr_name
+            ).get_value_level()
+            three_values = rule.value_levels[2]
+            if (
+                row_3_1_value == three_values[0]
+                and row_3_2_value == three_values[1]
+                and candidate_value == three_values[2]
+            ):
+                ret = 1
+    return ret
+
+
+def score_candidates_one_by_one(rule_groups, context, candidates):
+    satisfied = [0] * len(candidates)
+    for i, candidate in enumerate(candidates):
+        for rule_group in rule_groups:
+            rule_num_pos = rule_group[0]
+            satisfied[i] += check_num_pos(rule_num_pos, context, candidate)
+            regenerate = (
+                rule_num_pos.attr == "Number" or rule_num_pos.name == "Arithmetic"
+            )
+            for rule, attr in zip(rule_group[1:], ["Type", "Size", "Color"]):
+                satisfied[i] += check_entity(rule, context, candidate, attr, regenerate)
+    return satisfied
+
+
+@pytest.mark.parametrize(
+    "configuration,build",
+    [
+        ("center_single", build_center_single),
+        ("distribute_nine", build_distribute_nine),
+        (
+            "left_center_single_right_center_single",
+            build_left_center_single_right_center_single,
+        ),
+        (
+            "in_distribute_four_out_center_single",
+            build_in_distribute_four_out_center_single,
+        ),
+    ],
+)
+@pytest.mark.parametrize("mesh", ["0", "2"])
+def test_score_candidates(configuration, build, mesh):
+    args = make_parser().parse_args(["--seed", "42", "--mesh", mesh])
+    root = build(mesh == "2")
+    for k in range(10):
+        rule_groups, _, context, candidates, _ = sample_matrix(
+            args, configuration, root, sample_rng(42, configuration, k), "train"
+        )
+        # context panels break the rules in many more ways than the candidates
+        for panels in [candidates, context]:
+            satisfied = score_candidates(rule_groups, context, panels)
+            assert satisfied.tolist() == score_candidates_one_by_one(
+                rule_groups, context, panels
+            )
+        # heuristics search is not implemented for the Mesh component
+        if mesh == "0":
+            rng = np.random.default_rng(k)
+            assert solve(rule_groups, context, candidates, rng) == 0
@@ -0,0 +1,118 @@
+import copy
+import json
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pytest
+
+from build_tree import build_in_distribute_four_out_center_single
+from main import main, make_parser, sample_matrix, sample_rng
+from serialize import dom_problem
+from solver import score_candidates
+from verify import parse_problem, verify_dataset
+
+CONFIGURATIONS = [
+    "distribute_nine",
+    "left_center_single_right_center_single",
+    "in_distribute_four_out_center_single",
+]
+
+
+def generate(save_dir, *args):
+    main_arg_parser = make_parser()
+    args = [
+        "--save-dir",
+        str(save_dir),
+        "--seed",
+        "42",
+        "--num-samples",
+        "10",
+        "--configurations",
+        ",".join(CONFIGURATIONS),
+    ] + list(args)
+    return main(main_arg_parser.parse_args(args))
+
+
+@pytest.mark.parametrize("mesh", ["0", "2"])
+def test_score_parsed_problem(mesh):
+    args = make_parser().parse_args(["--seed", "42", "--mesh", mesh])
+    configuration = "in_distribute_four_out_center_single"
+    root = build_in_distribute_four_out_center_single(mesh == "2")
+    for k in range(10):
+        rule_groups, _, context, candidates, _ = sample_matrix(
+            args, configuration, root, sample_rng(42, configuration, k), "train"
+        )
+        parsed = parse_problem(dom_problem(context + candidates, rule_groups))
+        np.testing.assert_array_equal(
+            score_candidates(*parsed),
+            score_candidates(rule_groups, context, candidates),
+        )
+
+
+@pytest.mark.parametrize("mesh", ["0", "2"])
+def test_verify_dataset(tmp_path, mesh):
+    generate(tmp_path / "npz", "--mesh", mesh)
+    generate(tmp_path / "shards", "--mesh", mesh, "--format", "shards")
+    results = [
+        verify_dataset(str(path), workers)
+        for path in [tmp_path / "npz", tmp_path / "shards"]
+        for workers in [1, 2]
+    ]
+    assert all(result == results[0] for result in results)
+    accs, failures = results[0]
+    if mesh == "0":
+        assert accs == {configuration: 1.0 for configuration in CONFIGURATIONS}
+        assert failures == {configuration: {} for configuration in CONFIGURATIONS}
+
+    # the solver breaks ties between the best candidates randomly during generation,
+    # whereas the auditor requires the answer to be the only best candidate
+    incorrect = 0
+    for configuration in CONFIGURATIONS:
+        lines = (tmp_path / "npz" / configuration / "manifest.jsonl").read_text()
+        for record in map(json.loads, lines.splitlines()[1:]):
+            failed = record["k"] in failures[configuration].get("answer", [])
+            assert record["correct"] or failed
+            incorrect += not record["correct"]
+            assert set(failures[configuration]) <= {"answer"}
+    if mesh == "2":
+        assert incorrect > 0
+
+
+def test_verify_dataset_detects_failures(tmp_path):
+    generate(tmp_path, "--verify", "none")
+    directory = tmp_path / "distribute_nine"
+    accs, _ = verify_dataset(str(directory))
+    assert accs == {"distribute_nine": 1.0}
+
+    def modify_arrays(k, key, value):
+        path = next(directory.glob(f"RAVEN_{k}_*.npz"))
+        arrays = dict(np.load(path))
+        arrays[key] = value(arrays[key])
+        np.savez(path, **arrays)
+
+    modify_arrays(3, "target", lambda target: (target + 1) % 8)
+    modify_arrays(5, "meta_matrix", lambda meta_matrix: meta_matrix[::-1])
+    # the answer is duplicated in place of another candidate
+    target = int(np.load(next(directory.glob("RAVEN_7_*.npz")))["target"])
+    path = next(directory.glob("RAVEN_7_*.xml"))
+    data = ET.fromstring(path.read_bytes())
+    panels = data.find("Panels")
+    other = 8 + (target + 1) % 8
+    panels.remove(panels[other])
+    panels.insert(other, copy.deepcopy(panels[8 + target]))
+    path.write_bytes(ET.tostring(data))
+
+    reported = []
+    accs, failures = verify_dataset(
+        str(directory), report=lambda *failure: reported.append(failure)
+    )
+    assert accs == {"distribute_nine": 0.7}
+    assert failures["distribute_nine"]["answer"] == [3, 7]
+    assert failures["distribute_nine"]["meta_matrix"] == [5]
+    assert failures["distribute_nine"]["unique"] == [7]
+    assert "consistency" not in failures["distribute_nine"]
+    assert sorted(reported) == [
+        ("distribute_nine", 3, ["answer"]),
+        ("distribute_nine", 5, ["meta_matrix"]),
+        ("distribute_nine", 7, ["answer", "unique"]),
+    ]
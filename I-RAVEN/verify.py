@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from tqdm import tqdm
+
+from Attribute import Number, Position, Uniformity
+from dataset import RavenDataset
+from serialize import check_xml_format_version, serialize_rules
+from solver import check_consistency, get_layout, score_candidates
+
+ENTITY_ATTRIBUTES = ["Type", "Size", "Color", "Angle"]
+
+# answer - the answer is the only candidate satisfying the most rules
+# meta_matrix - meta_matrix and meta_target describe the rules of the XML
+# consistency - entities of a layout share the values of the attributes with rules
+# unique - no two candidates are the same
+CHECKS = ["answer", "meta_matrix", "consistency", "unique"]
+
+
+class ParsedNode(object):
+    """Node of a panel read from the XML of a sample."""
+
+    def __init__(self, name, children):
+        self.name = name
+        self.children = children
+
+
+class ParsedLayout(object):
+    """Layout read from the XML of a sample, with the parts of Layout used by the solver."""
+
+    def __init__(self, element):
+        """
+        Arguments:
+            element(ET.Element): the Layout element
+        """
+        positions = json.loads(element.get("Position"))
+        entities = element.findall("Entity")
+        self.number = Number()
+        self.number.set_value_level(int(element.get("Number")))
+        self.uniformity = Uniformity()
+        self.uniformity.set_value_level(int(element.get("Uniformity")))
+        self.position = Position("planar", positions)
+        self.position.set_value_idx(
+            np.array(
+                [
+                    positions.index(json.loads(entity.get("bbox")))
+                    for entity in entities
+                ],
+                np.int64,
+            )
+        )
+        self.value_levels = {
+            attr: np.array([int(entity.get(attr)) for entity in entities])
+            for attr in ENTITY_ATTRIBUTES
+        }
+
+    def get_value_levels(self, attr):
+        return self.value_levels[attr]
+
+    def is_consistent(self, attr):
+        value_levels = self.get_value_levels(attr)
+        return bool(np.all(value_levels == value_levels[0]))
+
+    def get_state(self):
+        """Hashable description of the entities of the layout."""
+        return (self.position.get_value_mask(),) + tuple(
+            tuple(self.value_levels[attr].tolist()) for attr in ENTITY_ATTRIBUTES
+        )
+
+
+class ParsedRule(object):
+    """Rule read from the XML of a sample, with the attributes of Rule used by the solver."""
+
+    def __init__(self, element, component_idx):
+        """
+        Arguments:
+            element(ET.Element): the Rule element
+            component_idx(int): index of the component of the rule
+        """
+        self.name = element.get("name")
+        self.attr = element.get("attr")
+        self.component_idx = component_idx
+        self.value = int(element.get("value"))
+        value_levels = element.get("value_levels")
+        self.value_levels = [] if value_levels is None else json.loads(value_levels)
+
+
+def parse_panel(element):
+    struct = element.find("Struct")
+    components = [
+        ParsedNode(
+            component.get("name"),
+            [ParsedLayout(component.find("Layout"))],
+        )
+        for component in struct.findall("Component")
+    ]
+    return ParsedNode("Root", [ParsedNode(struct.get("name"), components)])
+
+
+def get_panel_state(panel):
+    """Hashable description of the entities of a panel."""
+    return tuple(
+        component.children[0].get_state() for component in panel.children[0].children
+    )
+
+
+def parse_problem(dom):
+    """Read the panels and the rules of a sample from its XML.
+    Arguments:
+        dom(bytes): XML description of the sample
+    Returns:
+        rule_groups(list of list of ParsedRule): rules that apply to each component
+        context(list of ParsedNode): the 8 context panels
+        candidates(list of ParsedNode): the 8 candidates
+    """
+    data = ET.fromstring(dom)
+    check_xml_format_version(data)
+    panels = [parse_panel(panel) for panel in data.find("Panels").findall("Panel")]
+    context, candidates = panels[:8], panels[8:]
+    rule_groups = []
+    for rule_group in data.find("Rules").findall("Rule_Group"):
+        component_idx = int(rule_group.get("id"))
+        rules = rule_group.findall("Rule")
+        rule_groups.append([ParsedRule(rule, component_idx) for rule in rules])
+    return rule_groups, context, candidates
+
+
+def verify_problem(dom, target):
+    """Check that the answer of a sample is the only candidate satisfying the most rules.
+    Arguments:
+        dom(bytes): XML description of the sample
+        target(int): index of the answer among the candidates
+    Returns:
+        is_correct(bool): whether the solver selects the answer without a tie
+    """
+    rule_groups, context, candidates = parse_problem(dom)
+    return is_answer_unique(rule_groups, context, candidates, target)
+
+
+def is_answer_unique(rule_groups, context, candidates, target):
+    satisfied = score_candidates(rule_groups, context, candidates)
+    if not 0 <= target < len(candidates):
+        return False
+    return bool(
+        satisfied[target] == satisfied.max()
+        and np.sum(satisfied == satisfied.max()) == 1
+    )
+
+
+def are_rules_consistent(rule_groups, panels):
+    """Whether the entities of each layout share the values of the attributes governed by
+    rules, where the solver requires it with check_consistency.
+    """
+    for rule_group in rule_groups:
+        component_idx = rule_group[0].component_idx
+        for rule, attr in zip(rule_group[1:], ["Type", "Size", "Color"]):
+            for panel in panels:
+                uni = get_layout(panel, component_idx).uniformity.get_value()
+                if rule.name != "Constant" or uni:
+                    if not check_consistency(panel, attr, component_idx):
+                        return False
+    return True
+
+
+def audit_problem(dom, arrays):
+    """Check a sample against the properties of the generated problems, see CHECKS.
+    Arguments:
+        dom(bytes): XML description of the sample
+        arrays(dict): arrays of the sample, as saved by main.py
+    Returns:
+        failed(list of str): names of the failed checks
+    """
+    rule_groups, context, candidates = parse_problem(dom)
+    target = int(arrays["target"])
+    is_mesh_present = context[0].children[0].children[-1].name == "Mesh"
+    meta_matrix, meta_target = serialize_rules(rule_groups, is_mesh_present)
+    passed = {
+        "answer": is_answer_unique(rule_groups, context, candidates, target),
+        "meta_matrix": np.array_equal(arrays["meta_matrix"], meta_matrix)
+        and np.array_equal(arrays["meta_target"], meta_target),
+        "consistency": are_rules_consistent(rule_groups, context + candidates),
+        "unique": len(set(map(get_panel_state, candidates))) == len(candidates),
+    }
+    return [name for name in CHECKS if not passed[name]]
+
+
+# Per-process state of the workers used by verify_dataset
+_worker_dataset = None
+
+
+def init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def audit_sample(idx):
+    configuration, k, _ = _worker_dataset.samples[idx]
+    failed = audit_problem(_worker_dataset.get_xml(idx), _worker_dataset[idx])
+    return configuration, k, failed
+
+
+def verify_dataset(path, workers=1, report=None):
+    """Audit all the samples of a generated dataset, in either format.
+    Arguments:
+        path(str): directory of a single configuration or the whole dataset
+        workers(int): number of worker processes
+        report(callable): called with the configuration, the index and the failed checks
+            of each failing sample as soon as it is audited
+    Returns:
+        accs(dict): fraction of the samples of each configuration that pass all checks
+        failures(dict): indices of the samples of each configuration failing each check
+    """
+    dataset = RavenDataset(path)
+    indices = range(len(dataset))
+    counts = {}
+    failures = {}
+    for configuration, _, _ in dataset.samples:
+        counts[configuration] = [0, 0]
+        failures[configuration] = {name: [] for name in CHECKS}
+
+    def collect(results):
+        for configuration, k, failed in tqdm(results, total=len(dataset)):
+            counts[configuration][1] += 1
+            if not failed:
+                counts[configuration][0] += 1
+            elif report is not None:
+                report(configuration, k, failed)
+            for name in failed:
+                failures[configuration][name].append(k)
+
+    if workers > 1:
+        with multiprocessing.Pool(
+            workers, initializer=init_worker, initargs=(dataset,)
+        ) as pool:
+            chunksize = max(1, min(64, len(dataset) // (workers * 4)))
+            collect(pool.imap_unordered(audit_sample, indices, chunksize))
+    else:
+        init_worker(dataset)
+        collect(audit_sample(idx) for idx in indices)
+    accs = {
+        configuration: float(passed) / total
+        for configuration, (passed, total) in counts.items()
+    }
+    failures = {
+        configuration: {name: sorted(ks) for name, ks in checks.items() if ks}
+        for configuration, checks in failures.items()
+    }
+    return accs, failures
+
+
+def make_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="audit the samples of a generated I-RAVEN dataset"
+    )
+    parser.add_argument(
+        "--dataset-dir",
+        type=str,
+        default="~/datasets/I-RAVEN",
+        help="path to the dataset or to a single configuration of it",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes used to audit samples",
+    )
+    return parser
+
+
+def report_failure(configuration, k, failed):
+    tqdm.write(f"Sample {k} of {configuration} fails: {', '.join(failed)}")
+
+
+def main(args):
+    accs, failures = verify_dataset(
+        os.path.expanduser(args.dataset_dir), args.workers, report_failure
+    )
+    for configuration, acc in accs.items():
+        print(f"Samples of {configuration} passing all checks: {acc}")
+        for name, ks in failures[configuration].items():
+            print(f"Samples of {configuration} failing {name}: {ks}")
+    return accs, failures
+
+
+if __name__ == "__main__":
+    main_arg_parser = make_parser()
+    args = main_arg_parser.parse_args()
+    _, failures = main(args)
+    sys.exit(1 if any(failures.values()) else 0)